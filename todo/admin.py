@@ -1,44 +1,37 @@
-import csv
-import datetime
-
 from django.contrib import admin
-from django.http import HttpResponse
+from django.http import StreamingHttpResponse
 
-from todo.models import Attachment, Comment, Task, TaskList
+from todo.models import Attachment, Comment, ImportJob, MailCheckpoint, MailTrackerLease, Task, TaskList
+from todo.operations.task_exporter import FORMATS, export_rows
 
 
-def export_to_csv(modeladmin, request, queryset):
-    opts = modeladmin.model._meta
-    content_disposition = f"attachment; filename={opts.verbose_name}.csv"
-    response = HttpResponse(content_type="text/csv")
-    response["Content-Disposition"] = content_disposition
-    writer = csv.writer(response)
-    fields = [
-        field for field in opts.get_fields() if not (field.many_to_many and not field.one_to_many)
-    ]
-    # Write a first row with header information
-    writer.writerow([field.verbose_name for field in fields])
-    # Write data rows
-    for obj in queryset:
-        data_row = []
-        for field in fields:
-            value = getattr(obj, field.name)
-            if isinstance(value, datetime.datetime):
-                value = value.strftime("%d/%m/%Y")
-            data_row.append(value)
-        writer.writerow(data_row)
+def export_tasks(queryset, fmt):
+    lines, content_type = FORMATS[fmt]
+    response = StreamingHttpResponse(lines(export_rows(queryset)), content_type=content_type)
+    response["Content-Disposition"] = f"attachment; filename=tasks.{fmt}"
     return response
 
 
+def export_to_csv(modeladmin, request, queryset):
+    return export_tasks(queryset, "csv")
+
+
 export_to_csv.short_description = "Export to CSV"
 
 
+def export_to_jsonl(modeladmin, request, queryset):
+    return export_tasks(queryset, "jsonl")
+
+
+export_to_jsonl.short_description = "Export to JSON lines"
+
+
 class TaskAdmin(admin.ModelAdmin):
     list_display = ("title", "task_list", "completed", "priority", "due_date")
     list_filter = ("task_list",)
     ordering = ("priority",)
     search_fields = ("title",)
-    actions = [export_to_csv]
+    actions = [export_to_csv, export_to_jsonl]
 
 
 class CommentAdmin(admin.ModelAdmin):
@@ -50,7 +43,23 @@ class AttachmentAdmin(admin.ModelAdmin):
     autocomplete_fields = ["added_by", "task"]
 
 
+class ImportJobAdmin(admin.ModelAdmin):
+    list_display = ("file", "created_by", "created_date", "status", "rows_processed", "total_rows")
+    list_filter = ("status",)
+
+
+class MailCheckpointAdmin(admin.ModelAdmin):
+    list_display = ("tracker", "uidvalidity", "last_uid", "updated_date")
+
+
+class MailTrackerLeaseAdmin(admin.ModelAdmin):
+    list_display = ("tracker", "owner", "expires")
+
+
 admin.site.register(TaskList)
 admin.site.register(Comment, CommentAdmin)
 admin.site.register(Task, TaskAdmin)
 admin.site.register(Attachment, AttachmentAdmin)
+admin.site.register(ImportJob, ImportJobAdmin)
+admin.site.register(MailCheckpoint, MailCheckpointAdmin)
+admin.site.register(MailTrackerLease, MailTrackerLeaseAdmin)
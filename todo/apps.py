@@ -0,0 +1,12 @@
+from django.apps import AppConfig
+
+
+class TodoConfig(AppConfig):
+    name = "todo"
+    default_auto_field = "django.db.models.AutoField"
+
+    def ready(self):
+        # Keep the search index in step with Task and Comment saves and deletes, and cached
+        # group memberships in step with membership changes.
+        from todo import signals  # noqa: F401
+        from todo.search import signals as search_signals  # noqa: F401
@@ -4,11 +4,18 @@ from django.conf import settings
 hash = {
     "TODO_ALLOW_FILE_ATTACHMENTS": True,
     "TODO_COMMENT_CLASSES": [],
+    "TODO_CSV_IMPORT_IN_BACKGROUND": False,
     "TODO_DEFAULT_ASSIGNEE": None,
+    "TODO_GROUP_CACHE_TIMEOUT": None,
     "TODO_LIMIT_FILE_ATTACHMENTS": [".jpg", ".gif", ".png", ".csv", ".pdf", ".zip"],
+    "TODO_MAIL_USER_CACHE_TIMEOUT": 300,
     "TODO_MAXIMUM_ATTACHMENT_SIZE": 5000000,
+    "TODO_PRIORITY_GAP": 1024,
     "TODO_PUBLIC_SUBMIT_REDIRECT": "/",
+    "TODO_SEARCH_BACKEND": None,
+    "TODO_SEARCH_RESULTS_PER_PAGE": 50,
     "TODO_STAFF_ONLY": True,
+    "TODO_TASKS_PER_PAGE": 100,
 }
 
 # These intentionally have no defaults (user MUST set a value if their features are used):
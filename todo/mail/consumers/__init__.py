@@ -1,9 +1,9 @@
 def tracker_consumer(**kwargs):
-    def tracker_factory(producer):
+    def tracker_factory(producer, before_commit=None):
         # the import needs to be delayed until call to enable
         # using the wrapper in the django settings
         from .tracker import tracker_consumer
 
-        return tracker_consumer(producer, **kwargs)
+        return tracker_consumer(producer, before_commit=before_commit, **kwargs)
 
     return tracker_factory
@@ -1,14 +1,14 @@
 import re
 import logging
 
+from collections import Counter, OrderedDict, defaultdict
 from email.charset import Charset as EMailCharset
 from django.db import transaction
-from django.db.models import Count
 from django.contrib.auth import get_user_model
 from django.conf import settings
 from html2text import html2text
-from email.utils import parseaddr
 from todo.models import Comment, Task, TaskList
+from todo.utils import email_user_ids
 
 logger = logging.getLogger(__name__)
 
@@ -50,122 +50,286 @@ def format_task_title(format_string, message):
 DJANGO_TODO_THREAD = re.compile(r"<thread-(\d+)@django-todo>")
 
 
-def parse_references(task_list, references):
+def split_references(references):
+    """Split a References header into the Message-IDs of other emails, and the ids of the
+    tasks whose notifications (sent by django-todo) are being answered."""
     related_messages = []
-    answer_thread = None
+    thread_ids = []
     for related_message in references.split():
         logger.info("checking reference: %r", related_message)
         match = re.match(DJANGO_TODO_THREAD, related_message)
         if match is None:
             related_messages.append(related_message)
-            continue
+        else:
+            thread_ids.append(int(match.group(1)))
+    return related_messages, thread_ids
+
+
+# Values per IN (...) lookup, well below the limits of every database backend.
+LOOKUP_CHUNK_SIZE = 500
+
+
+def find_message_tasks(task_list, message_ids):
+    """Map each of `message_ids` to the ids of the tasks in `task_list` it is a comment on."""
+    message_ids = list(message_ids)
+    message_tasks = defaultdict(set)
+    for start in range(0, len(message_ids), LOOKUP_CHUNK_SIZE):
+        comments = Comment.objects.filter(
+            task__task_list=task_list,
+            email_message_id__in=message_ids[start : start + LOOKUP_CHUNK_SIZE],
+        ).values_list("email_message_id", "task_id")
+        for message_id, task_id in comments:
+            message_tasks[message_id].add(task_id)
+    return message_tasks
+
+
+def best_task_id(related_messages, message_tasks):
+    """The task having the most email comments among `related_messages`, if any."""
+    counts = Counter(
+        task_id
+        for message_id in set(related_messages)
+        for task_id in message_tasks.get(message_id, ())
+    )
+    if not counts:
+        return None
+    return max(counts, key=lambda task_id: (counts[task_id], -task_id))
 
-        thread_id = int(match.group(1))
-        new_answer_thread = Task.objects.filter(task_list=task_list, pk=thread_id).first()
-        if new_answer_thread is not None:
-            answer_thread = new_answer_thread
 
-    if answer_thread is None:
-        logger.info("no answer thread found in references")
-    else:
-        logger.info("found an answer thread: %s", str(answer_thread))
-    return related_messages, answer_thread
+def stored_message_id(message):
+    # Due to limitations in MySQL wrt unique_together and TextField (grrr),
+    # we must use a CharField rather than TextField for message_id.
+    # In the unlikeley event that we get a VERY long inbound
+    # message_id, truncate it to the max_length of a MySQL CharField.
+    original_message_id = message["message-id"]
+    return (
+        (original_message_id[:252] + "...")
+        if len(original_message_id) > 255
+        else original_message_id
+    )
 
 
-def insert_message(task_list, message, priority, task_title_format):
+def check_headers(message):
     if "message-id" not in message:
         logger.warning("missing message id, ignoring message")
-        return
+        return False
 
     if "from" not in message:
         logger.warning('missing "From" header, ignoring message')
-        return
+        return False
 
     if "subject" not in message:
         logger.warning('missing "Subject" header, ignoring message')
-        return
+        return False
 
-    logger.info(
-        "received message:\t"
-        f"[Subject: {message['subject']}]\t"
-        f"[Message-ID: {message['message-id']}]\t"
-        f"[References: {message['references']}]\t"
-        f"[To: {message['to']}]\t"
-        f"[From: {message['from']}]"
-    )
+    return True
 
-    # Due to limitations in MySQL wrt unique_together and TextField (grrr),
-    # we must use a CharField rather than TextField for message_id.
-    # In the unlikeley event that we get a VERY long inbound
-    # message_id, truncate it to the max_length of a MySQL CharField.
-    original_message_id = message["message-id"]
-    message_id = (
-        (original_message_id[:252] + "...")
-        if len(original_message_id) > 255
-        else original_message_id
-    )
-    message_from = message["from"]
-    text = message_text(message)
-
-    related_messages, answer_thread = parse_references(task_list, message.get("references", ""))
-
-    # find the most relevant task to add a comment on.
-    # among tasks in the selected task list, find the task having the
-    # most email comments the current message references
-    best_task = (
-        Task.objects.filter(task_list=task_list, comment__email_message_id__in=related_messages)
-        .annotate(num_comments=Count("comment"))
-        .order_by("-num_comments")
-        .only("id")
-        .first()
-    )
 
-    # if no related comment is found but a thread message-id
-    # (generated by django-todo) could be found, use it
-    if best_task is None and answer_thread is not None:
-        best_task = answer_thread
+def insert_message(task_list, message, priority, task_title_format):
+    insert_messages(task_list, [message], priority, task_title_format)
+
 
+class SeenMessageIds:
+    """
+    The Message-IDs of the last `size` emails added by this worker, so that emails delivered
+    again can be dropped before querying the database. Ones forgotten since still aren't
+    added twice; they just cost the usual lookups.
+    """
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.message_ids = OrderedDict()
+
+    def __contains__(self, message_id):
+        if message_id not in self.message_ids:
+            return False
+        self.message_ids.move_to_end(message_id)
+        return True
+
+    def __len__(self):
+        return len(self.message_ids)
+
+    def add(self, message_id):
+        self.message_ids[message_id] = None
+        self.message_ids.move_to_end(message_id)
+        if len(self.message_ids) > self.size:
+            self.message_ids.popitem(last=False)
+
+
+def insert_messages(
+    task_list, messages, priority, task_title_format, seen=None, before_commit=None
+):
+    """Add `messages` to `task_list` in a single transaction, as comments on the tasks they
+    answer or on new tasks. Each message gets a savepoint, so one failing doesn't undo
+    the others. Messages whose Message-ID is in `seen` are skipped, and those added
+    are recorded there. `before_commit` is called last within the transaction, and may
+    raise to roll it back."""
+    entries = []
+    for message in messages:
+        try:
+            if not check_headers(message):
+                continue
+
+            if seen is not None and stored_message_id(message) in seen:
+                logger.info("already received %r, ignoring message", message["message-id"])
+                continue
+
+            logger.info(
+                "received message:\t"
+                f"[Subject: {message['subject']}]\t"
+                f"[Message-ID: {message['message-id']}]\t"
+                f"[References: {message['references']}]\t"
+                f"[To: {message['to']}]\t"
+                f"[From: {message['from']}]"
+            )
+            related_messages, thread_ids = split_references(message.get("references", ""))
+        except Exception:
+            # a message we can't make sense of mustn't hold up the rest of the batch
+            logger.exception("got exception while reading message")
+            continue
+        entries.append((message, related_messages, thread_ids))
+
+    if not entries:
+        return
+
+    batch = MessageBatch(task_list, entries)
+    added = []
     with transaction.atomic():
-        if best_task is None:
-            best_task = Task.objects.create(
+        for message, related_messages, thread_ids in entries:
+            try:
+                with transaction.atomic():
+                    batch.insert(
+                        message, related_messages, thread_ids, priority, task_title_format
+                    )
+                added.append(stored_message_id(message))
+            except Exception:
+                # ignore exceptions during insertion, in order to avoid
+                # losing the rest of the batch
+                logger.exception("got exception while inserting message")
+        if before_commit is not None:
+            before_commit()
+
+    # only once they are committed
+    if seen is not None:
+        for message_id in added:
+            seen.add(message_id)
+
+
+class MessageBatch:
+    """
+    What inserting a batch of messages into a task list needs to know, looked up for the
+    whole batch at once: the tasks answered, the tasks on which the emails (and those they
+    reference) are comments, and the users sending them.
+    """
+
+    def __init__(self, task_list, entries):
+        self.task_list = task_list
+        self.thread_tasks = Task.objects.filter(
+            task_list=task_list, pk__in={i for entry in entries for i in entry[2]}
+        ).in_bulk()
+        # the emails referenced, and the emails themselves in case they were seen before
+        message_ids = {message_id for entry in entries for message_id in entry[1]}
+        message_ids.update(stored_message_id(message) for message, *references in entries)
+        self.message_tasks = find_message_tasks(task_list, message_ids)
+        self.user_ids = match_users({message["from"] for message, *references in entries})
+
+    def insert(self, message, related_messages, thread_ids, priority, task_title_format):
+        message_id = stored_message_id(message)
+        # an email delivered again is already a comment somewhere in the list
+        if self.message_tasks.get(message_id):
+            logger.info("message already added to task %r", min(self.message_tasks[message_id]))
+            return
+
+        message_from = message["from"]
+        text = message_text(message)
+
+        # find the most relevant task to add a comment on.
+        # among tasks in the selected task list, find the task having the
+        # most email comments the current message references
+        task_id = best_task_id(related_messages, self.message_tasks)
+
+        # if no related comment is found but a thread message-id
+        # (generated by django-todo) could be found, use it
+        if task_id is None:
+            answer_threads = [i for i in thread_ids if i in self.thread_tasks]
+            if answer_threads:
+                task_id = answer_threads[-1]
+                logger.info("found an answer thread: %s", str(self.thread_tasks[task_id]))
+            else:
+                logger.info("no answer thread found in references")
+
+        if task_id is None:
+            task_id = Task.objects.create(
                 priority=priority,
                 title=format_task_title(task_title_format, message),
-                task_list=task_list,
-                created_by=match_user(message_from),
-            )
-        logger.info("using task: %r", best_task)
+                task_list=self.task_list,
+                created_by_id=self.user_ids.get(message_from),
+            ).id
+        logger.info("using task: %r", task_id)
 
-        comment, comment_created = Comment.objects.get_or_create(
-            task=best_task,
+        comment = Comment.objects.create(
+            task_id=task_id,
             email_message_id=message_id,
-            defaults={"email_from": message_from, "body": text},
-            author=match_user(message_from), # TODO: Write test for this
+            email_from=message_from,
+            body=text,
+            author_id=self.user_ids.get(message_from),
         )
-        logger.info("created comment: %r", comment)
+        logger.info("created comment: %r", comment.pk)
+
+        # later messages of the batch may answer this one
+        self.message_tasks[message_id].add(task_id)
 
 
 def tracker_consumer(
-    producer, group=None, task_list_slug=None, priority=1, task_title_format="[MAIL] {subject}"
+    producer,
+    group=None,
+    task_list_slug=None,
+    priority=1,
+    task_title_format="[MAIL] {subject}",
+    batch_size=100,
+    seen_message_ids=10000,
+    before_commit=None,
 ):
     task_list = TaskList.objects.get(group__name=group, slug=task_list_slug)
+    seen = SeenMessageIds(seen_message_ids) if seen_message_ids else None
+
+    def flush(batch):
+        # Failures of single messages are dealt with by insert_messages. Anything else, such
+        # as the database being unreachable or the tracker being stopped, leaves the batch
+        # uncommitted: it propagates before the producer is asked for more, so the messages
+        # stay on the server for the restarted tracker.
+        insert_messages(
+            task_list,
+            batch,
+            priority,
+            task_title_format,
+            seen=seen,
+            before_commit=before_commit,
+        )
+        batch.clear()
+
+    # Producers may yield None to mark the end of a batch, once they have nothing more to
+    # hand out straight away. Messages are committed then, or every `batch_size` messages.
+    batch = []
     for message in producer:
-        try:
-            insert_message(task_list, message, priority, task_title_format)
-        except Exception:
-            # ignore exceptions during insertion, in order to avoid
-            logger.exception("got exception while inserting message")
+        if message is not None:
+            batch.append(message)
+        if batch and (message is None or len(batch) >= batch_size):
+            flush(batch)
+    if batch:
+        flush(batch)
 
 
-def match_user(email):
-    """ This function takes an email and checks for a registered user."""
-
+def match_users(addresses):
+    """Map each of `addresses` to the id of its registered user (or None), if users are to
+    be matched at all."""
     if not settings.TODO_MAIL_USER_MAPPER:
-        user = None
-    else:
-        try:
-            # Find the first user that matches the email
-            user = get_user_model().objects.get(email=parseaddr(email)[1])
-        except get_user_model().DoesNotExist:
-            user = None
+        return {}
+    return email_user_ids(addresses)
 
-    return user
+
+def match_user(email):
+    """ This function takes an email and checks for a registered user."""
+    user_id = match_users([email]).get(email)
+    if user_id is None:
+        return None
+    return get_user_model().objects.filter(pk=user_id).first()
@@ -1,9 +1,11 @@
 def imap_producer(**kwargs):
-    def imap_producer_factory():
+    def imap_producer_factory(tracker_name=None):
         # the import needs to be delayed until call to enable
         # using the wrapper in the django settings
         from .imap import imap_producer
 
-        return imap_producer(**kwargs)
+        # keep track of progress under the name of the tracker, unless told otherwise
+        options = {"checkpoint": tracker_name, **kwargs}
+        return imap_producer(**options)
 
     return imap_producer_factory
@@ -2,11 +2,17 @@ import email
 import email.parser
 import imaplib
 import logging
+import re
+import select
 import time
 
 from email.policy import default
 from contextlib import contextmanager
 
+from django.utils import timezone
+
+from todo.models import MailCheckpoint
+
 logger = logging.getLogger(__name__)
 
 
@@ -16,14 +22,102 @@ def imap_check(command_tuple):
 
 
 @contextmanager
-def imap_connect(host, port, username, password):
-    conn = imaplib.IMAP4_SSL(host=host, port=port)
+def imap_connect(host, port, username, password, ssl=True):
+    imap_class = imaplib.IMAP4_SSL if ssl else imaplib.IMAP4
+    conn = imap_class(host=host, port=port)
     conn.login(username, password)
     imap_check(conn.list())
     try:
         yield conn
     finally:
-        conn.close()
+        try:
+            if conn.state == "SELECTED":
+                conn.close()
+            conn.logout()
+        except (imaplib.IMAP4.error, OSError):
+            # the connection may already be gone
+            pass
+
+
+IMAP_EXISTS = re.compile(rb"^\* \d+ EXISTS\r?$", re.MULTILINE)
+
+# How often, in seconds, a producer told when to stop checks while it waits for mail.
+STOP_CHECK_INTERVAL = 1
+
+
+def interruptible_sleep(duration, stopped=None):
+    """Sleep for `duration` seconds, returning early once `stopped()` is true. Returns
+    whether it did."""
+    if stopped is None:
+        time.sleep(duration)
+        return False
+    deadline = time.monotonic() + duration
+    while not stopped():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(remaining, STOP_CHECK_INTERVAL))
+    return True
+
+
+def imap_idle(conn, timeout, stopped=None):
+    """Wait, for at most `timeout` seconds, for the server to report new messages in the
+    selected folder. Returns True if it did. With `stopped`, the wait also ends once
+    `stopped()` is true.
+
+    imaplib has no IDLE support, so this talks to the socket directly. That's safe because
+    imaplib has fully read the response to the previous command, and nothing else is sent
+    until we end the IDLE with DONE and read its tagged response.
+    """
+    sock = conn.socket()
+    tag = conn._new_tag()
+    sock.sendall(tag + b" IDLE\r\n")
+
+    received = b""
+    untagged = b""
+    continued = False
+    changed = False
+    deadline = time.monotonic() + timeout
+    while True:
+        if continued and IMAP_EXISTS.search(received):
+            changed = True
+            break
+        if stopped is not None and stopped():
+            break
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        if stopped is not None:
+            remaining = min(remaining, STOP_CHECK_INTERVAL)
+        pending = getattr(sock, "pending", lambda: 0)()
+        if not pending and not select.select([sock], [], [], remaining)[0]:
+            continue
+        data = sock.recv(4096)
+        if not data:
+            raise imaplib.IMAP4.abort("connection closed during IDLE")
+        received += data
+        # Until the server accepts the IDLE with "+", it may still send untagged responses
+        # (which are kept, as they can announce new mail) or refuse with a tagged one.
+        while not continued and b"\n" in received[len(untagged) :]:
+            line, _, rest = received[len(untagged) :].partition(b"\n")
+            if line.startswith(b"+"):
+                continued = True
+                received = untagged + rest
+            elif line.startswith(tag + b" "):
+                raise imaplib.IMAP4.error(f"IDLE refused: {line!r}")
+            else:
+                untagged += line + b"\n"
+
+    sock.sendall(b"DONE\r\n")
+    while not re.search(rb"(^|\n)" + re.escape(tag) + rb" .*\n", received):
+        data = sock.recv(4096)
+        if not data:
+            raise imaplib.IMAP4.abort("connection closed while ending IDLE")
+        received += data
+    status = re.search(re.escape(tag) + rb" (\w+)", received).group(1)
+    if status != b"OK":
+        raise imaplib.IMAP4.error(f"IDLE failed: {received!r}")
+    return changed
 
 
 def parse_message(message):
@@ -37,11 +131,115 @@ def parse_message(message):
         return email_parser.close()
 
 
-def search_message(conn, *filters):
-    status, message_ids = conn.search(None, *filters)
-    for message_id in message_ids[0].split():
-        status, message = conn.fetch(message_id, "(RFC822)")
-        yield message_id, parse_message(message)
+def uid_set(uids):
+    """Format UIDs as a compact IMAP set, such as "1:5,7,9:10"."""
+    ranges = []
+    for uid in sorted(uids):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ",".join(str(a) if a == b else f"{a}:{b}" for a, b in ranges)
+
+
+FETCH_UID = re.compile(rb"UID (\d+)")
+FETCH_SIZE = re.compile(rb"RFC822\.SIZE (\d+)")
+
+
+def fetch_sizes(conn, uids):
+    """Map each of `uids` to the size of its message, in bytes."""
+    sizes = {}
+    typ, data = conn.uid("FETCH", uid_set(uids), "(RFC822.SIZE)")
+    imap_check((typ, data))
+    for line in data:
+        if isinstance(line, tuple):
+            line = line[0]
+        uid, size = FETCH_UID.search(line or b""), FETCH_SIZE.search(line or b"")
+        if uid and size:
+            sizes[int(uid.group(1))] = int(size.group(1))
+    return sizes
+
+
+def fetch_batches(uids, sizes, batch_size, max_bytes):
+    """Split `uids` into groups of at most `batch_size` messages and `max_bytes` bytes
+    (a message bigger than `max_bytes` gets a group of its own)."""
+    batch, batch_bytes = [], 0
+    for uid in uids:
+        size = sizes.get(uid, 0)
+        if batch and (len(batch) >= batch_size or batch_bytes + size > max_bytes):
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(uid)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+
+def search_batches(conn, *filters, after_uid=0, batch_size=100, max_bytes=20 * 1024 * 1024):
+    """Yield lists of (UID, message) for messages matching `filters` with a UID above
+    `after_uid`, one list per FETCH of at most `batch_size` messages and `max_bytes` bytes."""
+    if after_uid:
+        filters = (f"UID {after_uid + 1}:*", *filters)
+    typ, data = conn.uid("SEARCH", None, *filters)
+    imap_check((typ, data))
+    # "n:*" always matches the last message, even when its UID is below n
+    uids = [int(uid) for uid in data[0].split() if int(uid) > after_uid]
+
+    # sizes are small, so ask for plenty at a time
+    for chunk_start in range(0, len(uids), batch_size * 10):
+        chunk = uids[chunk_start : chunk_start + batch_size * 10]
+        sizes = fetch_sizes(conn, chunk)
+        for batch in fetch_batches(chunk, sizes, batch_size, max_bytes):
+            typ, data = conn.uid("FETCH", uid_set(batch), "(RFC822)")
+            imap_check((typ, data))
+            messages = []
+            for i, response_part in enumerate(data):
+                if not isinstance(response_part, tuple):
+                    continue
+                # The UID may come before the message literal or, as in "(RFC822 {n} UID x)",
+                # in the trailing part after it.
+                trailer = data[i + 1] if i + 1 < len(data) else b""
+                uid = FETCH_UID.search(response_part[0]) or (
+                    FETCH_UID.search(trailer) if isinstance(trailer, bytes) else None
+                )
+                if uid is None:
+                    logger.warning(f"skipping a FETCH response without a UID: {response_part[0]!r}")
+                    continue
+                messages.append((int(uid.group(1)), parse_message([response_part])))
+            del data
+            yield messages
+
+
+def search_message(conn, *filters, **kwargs):
+    """Yield (UID, message) for messages matching `filters`, fetched as `search_batches` does."""
+    for messages in search_batches(conn, *filters, **kwargs):
+        yield from messages
+
+
+def selected_uidvalidity(conn):
+    """The UIDVALIDITY the server reported when the current folder was selected."""
+    typ, data = conn.response("UIDVALIDITY")
+    return int(data[0]) if data and data[0] else None
+
+
+def load_checkpoint(tracker, uidvalidity):
+    """The last UID processed by `tracker`, or 0 if its folder has to be searched from the
+    start: there is no checkpoint yet, or the UIDs it refers to are no longer valid."""
+    checkpoint = MailCheckpoint.objects.filter(tracker=tracker).first()
+    if checkpoint is None:
+        return 0
+    if checkpoint.uidvalidity != uidvalidity:
+        logger.warning(f"UIDVALIDITY of {tracker} changed, searching the whole folder")
+        return 0
+    return checkpoint.last_uid
+
+
+def save_checkpoint(tracker, uidvalidity, last_uid):
+    updated = MailCheckpoint.objects.filter(tracker=tracker).update(
+        uidvalidity=uidvalidity, last_uid=last_uid, updated_date=timezone.now()
+    )
+    if not updated:
+        MailCheckpoint.objects.create(tracker=tracker, uidvalidity=uidvalidity, last_uid=last_uid)
 
 
 def imap_producer(
@@ -53,46 +251,135 @@ def imap_producer(
     password=None,
     nap_duration=1,
     input_folder="INBOX",
+    ssl=True,
+    idle=True,
+    idle_timeout=29 * 60,
+    max_nap_duration=60,
+    fetch_batch_size=100,
+    max_fetch_bytes=20 * 1024 * 1024,
+    checkpoint=None,
+    stopped=None,
 ):
     logger.debug("starting IMAP worker")
     imap_filter = "(ALL)" if process_all else "(UNSEEN)"
 
-    def process_batch():
+    # The highest UID handed to the consumer, so that messages left in the folder (with
+    # `preserve` or `process_all`) aren't processed again. With a `checkpoint` name, it is
+    # also saved to the database, and a restarted worker carries on from there.
+    position = {"uidvalidity": None, "last_uid": 0}
+
+    def process_batch(conn):
         logger.debug("starting to process batch")
-        # reconnect each time to avoid repeated failures due to a lost connection
-        with imap_connect(host, port, username, password) as conn:
-            # select the requested folder
-            imap_check(conn.select(input_folder, readonly=False))
+        received = 0
+        processed = []
+
+        def delete_processed():
+            # tag processed messages for deletion, many at a time
+            if processed:
+                conn.uid("STORE", uid_set(processed), "+FLAGS.SILENT", "(\\Deleted)")
+                processed.clear()
 
-            try:
-                for message_uid, message in search_message(conn, imap_filter):
+        batches = search_batches(
+            conn,
+            imap_filter,
+            after_uid=position["last_uid"],
+            batch_size=fetch_batch_size,
+            max_bytes=max_fetch_bytes,
+        )
+        try:
+            for messages in batches:
+                for message_uid, message in messages:
                     logger.info(f"received message {message_uid}")
+                    received += 1
                     try:
                         yield message
                     except Exception:
                         logger.exception(f"something went wrong while processing {message_uid}")
                         raise
 
-                    if not preserve:
-                        # tag the message for deletion
-                        conn.store(message_uid, "+FLAGS", "\\Deleted")
-                else:
-                    logger.debug("did not receive any message")
-            finally:
+                # Let the consumer commit the batch. The messages are only marked as done
+                # once it asks for more, so none are lost if it stops before then.
+                yield None
+
+                uids = [message_uid for message_uid, message in messages]
+                position["last_uid"] = max(uids, default=position["last_uid"])
+                if checkpoint and uids:
+                    save_checkpoint(checkpoint, position["uidvalidity"], position["last_uid"])
                 if not preserve:
-                    # flush deleted messages
-                    conn.expunge()
+                    processed.extend(uids)
+                    if len(processed) >= fetch_batch_size:
+                        delete_processed()
+            if not received:
+                logger.debug("did not receive any message")
+        finally:
+            if not preserve:
+                delete_processed()
+                # flush deleted messages
+                conn.expunge()
+        return received
+
+    def process_session():
+        with imap_connect(host, port, username, password, ssl=ssl) as conn:
+            # select the requested folder
+            imap_check(conn.select(input_folder, readonly=False))
+            nonlocal retry_nap
+            retry_nap = nap_duration
+
+            # UIDs only stay meaningful while the folder keeps its UIDVALIDITY
+            uidvalidity = selected_uidvalidity(conn)
+            if uidvalidity != position["uidvalidity"]:
+                position["uidvalidity"] = uidvalidity
+                position["last_uid"] = (
+                    load_checkpoint(checkpoint, uidvalidity) if checkpoint else 0
+                )
+
+            # servers supporting IDLE tell us about new messages as they arrive. Others
+            # are polled, over the same connection for as long as it stays healthy.
+            use_idle = idle and "IDLE" in conn.capabilities
+            if use_idle:
+                logger.debug("waiting for messages with IDLE")
+
+            nap = nap_duration
+            while True:
+                # the batch's SEARCH finds everything the server has told us about so far
+                conn.untagged_responses.pop("EXISTS", None)
+                received = yield from process_batch(conn)
+                if use_idle:
+                    if conn.untagged_responses.get("EXISTS"):
+                        # mail arrived while the batch was processed, and the server
+                        # won't announce it again during IDLE
+                        continue
+                    # the server drops idle connections after 30 minutes,
+                    # so renew the IDLE before that
+                    imap_idle(conn, idle_timeout, stopped)
+                    if stopped is not None and stopped():
+                        return
+                    continue
+
+                # sleep to avoid using too much resources, backing off
+                # while the mailbox stays empty
+                if received:
+                    nap = nap_duration
+                if interruptible_sleep(nap, stopped):
+                    return
+                nap = min(nap * 2, max_nap_duration)
+                # make sure the connection survived the nap, reconnecting if it didn't
+                imap_check(conn.noop())
 
+    retry_nap = nap_duration
     while True:
         try:
-            yield from process_batch()
+            yield from process_session()
+            # which only returns once stopped
+            return
         except (GeneratorExit, KeyboardInterrupt):
             # the generator was closed, due to the consumer
             # breaking out of the loop, or an exception occuring
             raise
         except Exception:
-            logger.exception("mail fetching went wrong, retrying")
+            logger.exception("mail fetching went wrong, reconnecting")
 
-        # sleep to avoid using too much resources
-        # TODO: get notified when a new message arrives
-        time.sleep(nap_duration)
+        # back off while the server stays unreachable
+        if interruptible_sleep(retry_nap, stopped):
+            return
+        retry_nap = min(retry_nap * 2, max_nap_duration)
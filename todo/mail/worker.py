@@ -0,0 +1,236 @@
+"""
+Running the mail trackers configured in TODO_MAIL_TRACKERS, one per process or all of them
+from a single process, optionally sharing them between several workers with leases.
+"""
+
+import inspect
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.db import IntegrityError, connections, transaction
+from django.db.models import Q
+from django.db.models.functions import Now
+
+from todo.models import MailTrackerLease
+
+logger = logging.getLogger(__name__)
+
+
+class TrackerStopped(Exception):
+    """Stops a tracker, throwing away whatever its consumer hasn't committed yet."""
+
+
+def until_set(messages, *events):
+    """Pass on `messages`, raising TrackerStopped once one of `events` is set, including
+    when the producer ends because of it."""
+    try:
+        for message in messages:
+            if any(event.is_set() for event in events):
+                raise TrackerStopped()
+            yield message
+        if any(event.is_set() for event in events):
+            raise TrackerStopped()
+    finally:
+        close = getattr(messages, "close", None)
+        if close is not None:
+            close()
+
+
+def accepted_kwargs(func, **kwargs):
+    """The part of `kwargs` that `func` accepts, so that producers and consumers written
+    without the newer optional arguments keep working."""
+    try:
+        parameters = inspect.signature(func).parameters
+    except (TypeError, ValueError):
+        return {}
+    if any(p.kind == inspect.Parameter.VAR_KEYWORD for p in parameters.values()):
+        return kwargs
+    return {key: value for key, value in kwargs.items() if key in parameters}
+
+
+def run_tracker(name, tracker, *events, before_commit=None):
+    """Feed the messages from a tracker's producer to its consumer, until either stops or
+    one of `events` is set. Producers accepting it get `stopped`, to check while waiting
+    for messages, and consumers accepting it get `before_commit`, to call within each
+    transaction before committing it."""
+    producer = tracker["producer"]
+    consumer = tracker["consumer"]
+    kwargs = {"tracker_name": name}
+    if events:
+        kwargs["stopped"] = lambda: any(event.is_set() for event in events)
+    messages = producer(**accepted_kwargs(producer, **kwargs))
+    if events:
+        messages = until_set(messages, *events)
+    consumer(messages, **accepted_kwargs(consumer, before_commit=before_commit))
+
+
+def worker_id():
+    """A name for this worker process, unique across hosts."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def acquire_lease(tracker, owner, duration):
+    """Take, or renew, the lease on `tracker` for `duration` seconds. Returns False if
+    another worker holds it. Times come from the database, so that the clocks of the
+    workers' hosts don't need to agree."""
+    expires = Now() + timedelta(seconds=duration)
+    taken = (
+        MailTrackerLease.objects.filter(tracker=tracker)
+        .filter(Q(owner=owner) | Q(expires__lte=Now()))
+        .update(owner=owner, expires=expires)
+    )
+    if taken:
+        return True
+    try:
+        with transaction.atomic():
+            MailTrackerLease.objects.create(tracker=tracker, owner=owner, expires=expires)
+    except IntegrityError:
+        return False
+    return True
+
+
+def release_lease(tracker, owner):
+    MailTrackerLease.objects.filter(tracker=tracker, owner=owner).delete()
+
+
+class Leases:
+    """
+    Runs trackers only while holding their lease, so that several workers configured with
+    the same trackers never run one twice. Leases are renewed every third of `duration`;
+    a worker that stops renewing them loses its trackers to the others after `duration`
+    seconds. Each worker runs at most `max_trackers` trackers, leaving the rest to others.
+    """
+
+    def __init__(self, owner=None, duration=15, max_trackers=None):
+        self.owner = owner or worker_id()
+        self.duration = duration
+        self.slots = threading.BoundedSemaphore(max_trackers) if max_trackers else None
+
+    def wait_for(self, tracker, stop):
+        """Wait until this worker holds the lease on `tracker` (True) or `stop` is set (False)."""
+        while not stop.is_set():
+            if self.slots is None or self.slots.acquire(blocking=False):
+                try:
+                    acquired = acquire_lease(tracker, self.owner, self.duration)
+                except Exception:
+                    logger.exception(f"couldn't take the lease on tracker {tracker}")
+                    acquired = False
+                if acquired:
+                    logger.info(f"took over tracker {tracker}")
+                    return True
+                if self.slots is not None:
+                    self.slots.release()
+            stop.wait(self.duration / 3)
+        return False
+
+    @contextmanager
+    def hold(self, tracker):
+        """Renew the lease on `tracker` in the background, yielding an event set if it is lost.
+        The lease is released on exit."""
+        lost = threading.Event()
+        done = threading.Event()
+
+        def heartbeat():
+            while not done.wait(self.duration / 3):
+                try:
+                    renewed = acquire_lease(tracker, self.owner, self.duration)
+                except Exception:
+                    logger.exception(f"couldn't renew the lease on tracker {tracker}")
+                    renewed = False
+                if not renewed:
+                    logger.warning(f"lost the lease on tracker {tracker}, stopping it")
+                    lost.set()
+                    break
+            connections.close_all()
+
+        thread = threading.Thread(target=heartbeat, name=f"mail-lease-{tracker}", daemon=True)
+        thread.start()
+        try:
+            yield lost
+        finally:
+            done.set()
+            thread.join()
+            if not lost.is_set():
+                release_lease(tracker, self.owner)
+            if self.slots is not None:
+                self.slots.release()
+
+    def checker(self, tracker, lost):
+        """A before_commit check raising TrackerStopped unless the lease on `tracker` is still
+        held. Renewing the lease within the transaction being committed means a worker
+        taking it over has to wait for that commit."""
+
+        def check():
+            if lost.is_set() or not acquire_lease(tracker, self.owner, self.duration):
+                lost.set()
+                raise TrackerStopped()
+
+        return check
+
+    def release_all(self):
+        MailTrackerLease.objects.filter(owner=self.owner).delete()
+
+
+def supervise_tracker(name, tracker, stop, backoff=1, max_backoff=60, leases=None):
+    """Run a tracker until `stop` is set, restarting it whenever it stops. Pauses between
+    restarts double, up to `max_backoff` seconds, for as long as it keeps failing quickly.
+    With `leases`, the tracker only runs while this worker holds its lease."""
+    nap = backoff
+    while not stop.is_set():
+        if leases is not None and not leases.wait_for(name, stop):
+            break
+
+        started = time.monotonic()
+        try:
+            if leases is None:
+                run_tracker(name, tracker, stop)
+            else:
+                with leases.hold(name) as lost:
+                    run_tracker(
+                        name, tracker, stop, lost, before_commit=leases.checker(name, lost)
+                    )
+            logger.warning(f"tracker {name} stopped, restarting")
+        except TrackerStopped:
+            logger.info(f"tracker {name} stopped")
+        except Exception:
+            logger.exception(f"tracker {name} failed, restarting")
+        finally:
+            # database connections belong to this thread, don't keep them while waiting
+            connections.close_all()
+
+        if time.monotonic() - started > max_backoff:
+            nap = backoff
+        stop.wait(nap)
+        nap = min(nap * 2, max_backoff)
+
+
+def supervise(trackers, stop=None, backoff=1, max_backoff=60, leases=None):
+    """Run each of `trackers` (a mapping of names to tracker configurations) in a thread
+    of its own, until `stop` is set."""
+    stop = stop or threading.Event()
+    threads = [
+        threading.Thread(
+            target=supervise_tracker,
+            args=(name, tracker, stop, backoff, max_backoff, leases),
+            name=f"mail-tracker-{name}",
+            daemon=True,
+        )
+        for name, tracker in trackers.items()
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    finally:
+        stop.set()
+        if leases is not None:
+            # hand the trackers over to other workers straight away
+            leases.release_all()
@@ -0,0 +1,38 @@
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+
+from todo.models import Task
+from todo.operations.task_exporter import FORMATS, export_rows
+
+
+class Command(BaseCommand):
+    help = """Export tasks as CSV in the format `import_csv` reads, or as JSON lines with the same
+    fields. Tasks are streamed, so any number can be exported in constant memory."""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-f", "--file", dest="file", default=None, help="File to write to (default: stdout)."
+        )
+        parser.add_argument("--format", choices=sorted(FORMATS), default="csv")
+        parser.add_argument(
+            "--group", dest="group", default=None, help="Only export tasks in this group."
+        )
+        parser.add_argument(
+            "--chunk-size", type=int, default=2000, help="Number of tasks to read at a time."
+        )
+
+    def handle(self, *args, **options):
+        tasks = Task.objects.all()
+        if options["group"]:
+            tasks = tasks.filter(task_list__group__name=options["group"])
+
+        lines = FORMATS[options["format"]][0]
+        rows = export_rows(tasks, chunk_size=options["chunk_size"])
+
+        if options["file"]:
+            with Path(options["file"]).open(mode="w", encoding="utf-8", newline="") as fileobj:
+                fileobj.writelines(lines(rows))
+        else:
+            for line in lines(rows):
+                self.stdout.write(line, ending="")
@@ -1,3 +1,4 @@
+import contextlib
 import sys
 from typing import Any
 from pathlib import Path
@@ -18,6 +19,36 @@ class Command(BaseCommand):
         parser.add_argument(
             "-f", "--file", dest="file", default=None, help="File to to inbound CSV file."
         )
+        parser.add_argument(
+            "--batch-size",
+            dest="batch_size",
+            type=int,
+            default=500,
+            help="Number of CSV rows to write per transaction (default 500).",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of processes to validate rows in (default 1). Writes stay in one process.",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Report how many tasks would be created, updated or left unchanged, "
+            "without changing anything.",
+        )
+        parser.add_argument(
+            "--stream",
+            action="store_true",
+            help="Read the file a batch at a time and report only totals, for very large files.",
+        )
+        parser.add_argument(
+            "--log",
+            dest="log",
+            default=None,
+            help="With --stream, write each row's outcome to this file (line, status, detail).",
+        )
 
     def handle(self, *args: Any, **options: Any) -> None:
         # Need a file to proceed
@@ -32,8 +63,18 @@ class Command(BaseCommand):
             sys.exit(1)
 
         # Encoding "utf-8-sig" means "ignore byte order mark (BOM), which Excel inserts when saving CSVs."
-        with filepath.open(mode="r", encoding="utf-8-sig") as fileobj:
-            importer = CSVImporter()
+        with contextlib.ExitStack() as stack:
+            fileobj = stack.enter_context(filepath.open(mode="r", encoding="utf-8-sig"))
+            log = None
+            if options["stream"] and options["log"]:
+                log = stack.enter_context(Path(options["log"]).open(mode="w", encoding="utf-8"))
+            importer = CSVImporter(
+                batch_size=options["batch_size"],
+                stream=options["stream"],
+                log=log,
+                workers=options["workers"],
+                dry_run=options["dry_run"],
+            )
             results = importer.upsert(fileobj, as_string_obj=True)
 
         # Report successes, failures and summaries
@@ -42,10 +83,19 @@ class Command(BaseCommand):
             for upsert_msg in results["upserts"]:
                 print(upsert_msg)
 
+        if results.get("changes"):
+            print("Changes (first few only):")
+            for change_msg in results["changes"]:
+                print(change_msg)
+
         # Stored errors has the form:
         # self.errors = [{3: ["Incorrect foo", "Non-existent bar"]}, {7: [...]}]
+        # plus plain strings for problems with the file as a whole, such as bad encoding.
         if results["errors"]:
             for error_dict in results["errors"]:
+                if isinstance(error_dict, str):
+                    print(f"\n{error_dict}")
+                    continue
                 for k, error_list in error_dict.items():
                     print(f"\nSkipped CSV row {k}:")
                     for msg in error_list:
@@ -0,0 +1,44 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from todo.operations.import_jobs import claim_import_job, run_import_job
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = """Process CSV files uploaded through the web importer (with TODO_CSV_IMPORT_IN_BACKGROUND
+    on). Runs until stopped, or with --once until there are no jobs left. Jobs whose worker died
+    are resumed from their last committed batch."""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once", action="store_true", help="Exit once there are no jobs waiting."
+        )
+        parser.add_argument(
+            "--sleep", type=int, default=5, help="Seconds to wait between checks for new jobs."
+        )
+        parser.add_argument(
+            "--stale",
+            type=int,
+            default=300,
+            help="Seconds without progress after which a running job is taken over.",
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=500, help="Number of CSV rows per transaction."
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            job = claim_import_job(stale_after=options["stale"])
+            if job is None:
+                if options["once"]:
+                    return
+                time.sleep(options["sleep"])
+                continue
+
+            logger.info("Starting import job %s at row %s", job.id, job.rows_processed)
+            run_import_job(job, batch_size=options["batch_size"])
+            logger.info("Import job %s %s: %s rows", job.id, job.status, job.rows_processed)
@@ -5,6 +5,8 @@ import sys
 from django.core.management.base import BaseCommand
 from django.conf import settings
 
+from todo.mail.worker import Leases, run_tracker, supervise
+
 logger = logging.getLogger(__name__)
 
 
@@ -16,7 +18,35 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument("--imap_timeout", type=int, default=30)
-        parser.add_argument("worker_name")
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Run every tracker in TODO_MAIL_TRACKERS, restarting any that stop",
+        )
+        parser.add_argument(
+            "--max-backoff",
+            type=int,
+            default=60,
+            help="Longest pause, in seconds, before restarting a failing tracker",
+        )
+        parser.add_argument(
+            "--lease",
+            action="store_true",
+            help="Share the trackers with other workers, running each on one worker at a time",
+        )
+        parser.add_argument(
+            "--lease-duration",
+            type=int,
+            default=15,
+            help="Seconds before the trackers of a stopped worker are taken over",
+        )
+        parser.add_argument(
+            "--max-trackers",
+            type=int,
+            default=None,
+            help="Most trackers to run at once, leaving the others to other workers (with --lease)",
+        )
+        parser.add_argument("worker_name", nargs="?")
 
     def handle(self, *args, **options):
         if not hasattr(settings, "TODO_MAIL_TRACKERS"):
@@ -24,18 +54,32 @@ class Command(BaseCommand):
             sys.exit(1)
 
         worker_name = options["worker_name"]
-        tracker = settings.TODO_MAIL_TRACKERS.get(worker_name, None)
-        if tracker is None:
-            logger.error("couldn't find configuration for %r in TODO_MAIL_TRACKERS", worker_name)
+        if options["all"] == bool(worker_name):
+            logger.error("give either a worker name or --all")
             sys.exit(1)
 
+        if worker_name:
+            tracker = settings.TODO_MAIL_TRACKERS.get(worker_name, None)
+            if tracker is None:
+                logger.error(
+                    "couldn't find configuration for %r in TODO_MAIL_TRACKERS", worker_name
+                )
+                sys.exit(1)
+
         # set the default socket timeout (imaplib doesn't enable configuring it)
         timeout = options["imap_timeout"]
         if timeout:
             socket.setdefaulttimeout(timeout)
 
         # run the mail polling loop
-        producer = tracker["producer"]
-        consumer = tracker["consumer"]
-
-        consumer(producer())
+        if options["lease"]:
+            trackers = {worker_name: tracker} if worker_name else settings.TODO_MAIL_TRACKERS
+            leases = Leases(
+                duration=options["lease_duration"], max_trackers=options["max_trackers"]
+            )
+            supervise(trackers, max_backoff=options["max_backoff"], leases=leases)
+        elif worker_name:
+            run_tracker(worker_name, tracker)
+        else:
+            # every tracker gets a thread (and database connection) of its own
+            supervise(settings.TODO_MAIL_TRACKERS, max_backoff=options["max_backoff"])
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+
+from todo.defaults import defaults
+from todo.models import Task, TaskList
+from todo.pagination import keyset_order
+from todo.utils import rebalance_task_priorities
+
+
+class Command(BaseCommand):
+    help = """Spread task priorities back out to TODO_PRIORITY_GAP apart in lists where
+    drag/drop moves have used up the room between neighbouring tasks. Safe to run from cron;
+    lists that still have room are left alone."""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--min-gap",
+            type=int,
+            default=None,
+            help="Rebalance lists where two neighbouring tasks are closer than this "
+            "(default: TODO_PRIORITY_GAP / 64).",
+        )
+        parser.add_argument(
+            "--all", action="store_true", help="Rebalance every list, whatever its gaps."
+        )
+
+    def handle(self, *args, **options):
+        min_gap = options["min_gap"] or max(defaults("TODO_PRIORITY_GAP") // 64, 2)
+
+        for task_list in TaskList.objects.all():
+            if options["all"] or self.is_crowded(task_list, min_gap):
+                changed = rebalance_task_priorities(task_list)
+                print(f"Rebalanced {task_list}: {changed} tasks renumbered.")
+
+    def is_crowded(self, task_list, min_gap):
+        priorities = (
+            Task.objects.filter(task_list=task_list)
+            .order_by(*keyset_order())
+            .values_list("priority", flat=True)
+        )
+        previous = 0
+        for priority in priorities.iterator():
+            if priority is None or priority - previous < min_gap:
+                return True
+            previous = priority
+        return False
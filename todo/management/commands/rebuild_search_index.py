@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from todo.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = """Rebuild the full-text search index from scratch, e.g. after loading fixtures,
+    changing TODO_SEARCH_BACKEND or bulk-editing tasks outside of django-todo."""
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        with transaction.atomic():
+            backend.rebuild()
+        print(f"Search index rebuilt using {backend.__class__.__name__}.")
@@ -0,0 +1,42 @@
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    """Create the full-text side table used by todo.search for this database, and fill it."""
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        schema_editor.execute("CREATE VIRTUAL TABLE todo_task_fts USING fts5(title, note)")
+        schema_editor.execute(
+            "INSERT INTO todo_task_fts (rowid, title, note) "
+            "SELECT id, title, COALESCE(note, '') FROM todo_task"
+        )
+    elif vendor == "postgresql":
+        schema_editor.execute(
+            "CREATE TABLE todo_tasksearch ("
+            "task_id integer PRIMARY KEY REFERENCES todo_task (id) "
+            "ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, "
+            "document tsvector NOT NULL)"
+        )
+        schema_editor.execute(
+            "CREATE INDEX todo_tasksearch_document ON todo_tasksearch USING GIN (document)"
+        )
+        schema_editor.execute(
+            "INSERT INTO todo_tasksearch (task_id, document) "
+            "SELECT id, setweight(to_tsvector('english', title), 'A') || "
+            "setweight(to_tsvector('english', COALESCE(note, '')), 'B') FROM todo_task"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        schema_editor.execute("DROP TABLE IF EXISTS todo_task_fts")
+    elif vendor == "postgresql":
+        schema_editor.execute("DROP TABLE IF EXISTS todo_tasksearch")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("todo", "0013_assigned_to_m2m")]
+
+    operations = [migrations.RunPython(create_search_index, drop_search_index)]
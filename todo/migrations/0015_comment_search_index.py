@@ -0,0 +1,42 @@
+from django.db import migrations
+
+
+def create_comment_search_index(apps, schema_editor):
+    """Create the full-text side table for comment bodies used by todo.search, and fill it."""
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        schema_editor.execute("CREATE VIRTUAL TABLE todo_comment_fts USING fts5(body)")
+        schema_editor.execute(
+            "INSERT INTO todo_comment_fts (rowid, body) SELECT id, body FROM todo_comment"
+        )
+    elif vendor == "postgresql":
+        schema_editor.execute(
+            "CREATE TABLE todo_commentsearch ("
+            "comment_id integer PRIMARY KEY REFERENCES todo_comment (id) "
+            "ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, "
+            "document tsvector NOT NULL)"
+        )
+        schema_editor.execute(
+            "CREATE INDEX todo_commentsearch_document ON todo_commentsearch USING GIN (document)"
+        )
+        schema_editor.execute(
+            "INSERT INTO todo_commentsearch (comment_id, document) "
+            "SELECT id, setweight(to_tsvector('english', body), 'C') FROM todo_comment"
+        )
+
+
+def drop_comment_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        schema_editor.execute("DROP TABLE IF EXISTS todo_comment_fts")
+    elif vendor == "postgresql":
+        schema_editor.execute("DROP TABLE IF EXISTS todo_commentsearch")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("todo", "0014_search_index")]
+
+    operations = [
+        migrations.RunPython(create_comment_search_index, drop_comment_search_index)
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('todo', '0017_mail_checkpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailTrackerLease',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tracker', models.CharField(max_length=100, unique=True)),
+                ('owner', models.CharField(max_length=255)),
+                ('expires', models.DateTimeField()),
+            ],
+        ),
+    ]
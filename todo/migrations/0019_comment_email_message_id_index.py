@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('todo', '0018_mail_tracker_lease'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='comment',
+            name='email_message_id',
+            field=models.CharField(blank=True, db_index=True, max_length=255, null=True),
+        ),
+    ]
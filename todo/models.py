@@ -5,8 +5,10 @@ import os
 import textwrap
 
 from django.conf import settings
+from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
 from django.db import DEFAULT_DB_ALIAS, models
+from django.db.models import Exists, OuterRef
 from django.db.transaction import Atomic, get_connection
 from django.urls import reverse
 from django.utils import timezone
@@ -19,6 +21,13 @@ def get_attachment_upload_dir(instance, filename):
     return "/".join(["tasks", "attachments", str(instance.task.id), filename])
 
 
+def get_import_upload_dir(instance, filename):
+    """Determine upload dir for CSV files waiting to be imported by `import_worker`.
+    """
+
+    return "/".join(["tasks", "imports", filename])
+
+
 class LockedAtomicTransaction(Atomic):
     """
     modified from https://stackoverflow.com/a/41831049
@@ -52,11 +61,42 @@ class LockedAtomicTransaction(Atomic):
                     cursor.close()
 
 
+def group_membership(user, group_ref):
+    """EXISTS subquery: is `user` a member of the group at `group_ref` in the outer query?"""
+    groups = get_user_model()._meta.get_field("groups")
+    memberships = groups.remote_field.through.objects.filter(
+        **{groups.m2m_field_name(): user.pk, groups.m2m_reverse_field_name(): OuterRef(group_ref)}
+    )
+    return Exists(memberships)
+
+
+class TaskListQuerySet(models.QuerySet):
+    def visible_to(self, user):
+        """Lists in groups `user` belongs to; superusers see every list."""
+        if user.is_superuser:
+            return self
+        if not user.is_authenticated:
+            return self.none()
+        return self.filter(group_membership(user, "group"))
+
+
+class TaskQuerySet(models.QuerySet):
+    def visible_to(self, user):
+        """Tasks in lists `user` can see; superusers see every task."""
+        if user.is_superuser:
+            return self
+        if not user.is_authenticated:
+            return self.none()
+        return self.filter(group_membership(user, "task_list__group"))
+
+
 class TaskList(models.Model):
     name = models.CharField(max_length=60)
     slug = models.SlugField(default="")
     group = models.ForeignKey(Group, on_delete=models.CASCADE)
 
+    objects = TaskListQuerySet.as_manager()
+
     def __str__(self):
         return self.name
 
@@ -90,9 +130,14 @@ class Task(models.Model):
     note = models.TextField(blank=True, null=True)
     priority = models.PositiveIntegerField(blank=True, null=True)
 
+    objects = TaskQuerySet.as_manager()
+
     # Has due date for an instance of this object passed?
     def overdue_status(self):
         "Returns whether the Tasks's due date has passed or not."
+        # Querysets for list views annotate this in the database; use it when present.
+        if hasattr(self, "is_overdue"):
+            return self.is_overdue
         if self.due_date and datetime.date.today() > self.due_date:
             return True
 
@@ -137,7 +182,8 @@ class Comment(models.Model):
     task = models.ForeignKey(Task, on_delete=models.CASCADE)
     date = models.DateTimeField(default=datetime.datetime.now)
     email_from = models.CharField(max_length=320, blank=True, null=True)
-    email_message_id = models.CharField(max_length=255, blank=True, null=True)
+    # indexed on its own for the mail tracker, which looks comments up by Message-ID
+    email_message_id = models.CharField(max_length=255, blank=True, null=True, db_index=True)
 
     body = models.TextField(blank=True)
 
@@ -182,3 +228,90 @@ class Attachment(models.Model):
 
     def __str__(self):
         return f"{self.task.id} - {self.file.name}"
+
+
+class ImportJob(models.Model):
+    """
+    A CSV file uploaded through the web importer, to be loaded by the `import_worker`
+    management command rather than during the request. Progress is saved after every
+    committed batch, so a job interrupted by a crash picks up where it left off.
+    """
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (PENDING, "Pending"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    ]
+
+    # Only the first few row errors are kept; the rest are just counted.
+    MAX_ERRORS = 100
+
+    file = models.FileField(upload_to=get_import_upload_dir, max_length=255)
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    created_date = models.DateTimeField(default=timezone.now)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    # When the current worker claimed the job. Also identifies that worker: one whose job was
+    # taken over finds it changed, and stops without committing.
+    started_date = models.DateTimeField(blank=True, null=True)
+    # Updated with every committed batch; a running job that stops updating has lost its worker.
+    updated_date = models.DateTimeField(blank=True, null=True)
+    finished_date = models.DateTimeField(blank=True, null=True)
+    total_rows = models.PositiveIntegerField(blank=True, null=True)
+    rows_processed = models.PositiveIntegerField(default=0)
+    # rows_processed when the current worker claimed the job, i.e. rows done by earlier ones.
+    resumed_from = models.PositiveIntegerField(default=0)
+    rows_upserted = models.PositiveIntegerField(default=0)
+    error_count = models.PositiveIntegerField(default=0)
+    errors = models.JSONField(default=list, blank=True)
+    message = models.TextField(blank=True)
+
+    def eta(self):
+        """Estimated seconds until the job finishes, from the current worker's rate so far, or
+        None if unknown."""
+        rows_done = self.rows_processed - self.resumed_from
+        if self.status != self.RUNNING or not self.total_rows or rows_done <= 0:
+            return None
+        elapsed = (self.updated_date - self.started_date).total_seconds()
+        remaining = max(self.total_rows - self.rows_processed, 0)
+        return round(elapsed / rows_done * remaining)
+
+    def __str__(self):
+        return f"{self.file.name} ({self.status})"
+
+    class Meta:
+        ordering = ["-created_date"]
+
+
+class MailCheckpoint(models.Model):
+    """
+    How far the IMAP producer of a mail tracker has got through its folder: the highest UID
+    handed to the consumer, valid for as long as the folder keeps the same UIDVALIDITY.
+    A restarted worker carries on from there rather than searching the whole folder again.
+    """
+
+    tracker = models.CharField(max_length=100, unique=True)
+    uidvalidity = models.BigIntegerField()
+    last_uid = models.BigIntegerField(default=0)
+    updated_date = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.tracker} ({self.uidvalidity}:{self.last_uid})"
+
+
+class MailTrackerLease(models.Model):
+    """
+    Which mail worker currently runs a tracker. The owner renews the lease while it runs;
+    once it expires, any other worker may take the tracker over.
+    """
+
+    tracker = models.CharField(max_length=100, unique=True)
+    owner = models.CharField(max_length=255)
+    expires = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.tracker} ({self.owner})"
@@ -1,28 +1,82 @@
 import codecs
 import csv
 import datetime
+import itertools
 import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
+import django
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
+from django.db import connection, transaction
+from django.db.models import Q
 
 from todo.models import Task, TaskList
+from todo.search import get_search_backend
 
 log = logging.getLogger(__name__)
 
+# Header row of an importable CSV file.
+CSV_COLUMNS = [
+    "Title",
+    "Group",
+    "Task List",
+    "Created By",
+    "Created Date",
+    "Due Date",
+    "Completed",
+    "Assigned To",
+    "Note",
+    "Priority",
+]
+
+# Task fields set from a CSV row, besides the (creator, list, title) it is matched on.
+ROW_FIELDS = ["completed", "created_date", "due_date", "note", "priority"]
+
 
 class CSVImporter:
     """Core upsert functionality for CSV import, for re-use by `import_csv` management command, web UI and tests.
     Supplies a detailed log of what was and was not imported at the end. See README for usage notes.
+
+    With `stream=True` the file is read and written a batch at a time rather than loaded whole, and
+    per-row outcomes go to `log` (a text file object) as tab-separated lines instead of being kept
+    in `upserts` and `errors`, so memory use doesn't grow with the size of the file.
+
+    With `workers` above 1, rows are validated in that many processes; writes stay in this one.
+
+    With `dry_run=True` nothing is written. Instead, the results count the tasks the file would
+    create, update and leave unchanged, with the first few of those changes in `changes`.
     """
 
-    def __init__(self):
+    # How many would-be changes a dry run lists.
+    MAX_CHANGES = 50
+
+    def __init__(self, batch_size=500, stream=False, log=None, workers=1, dry_run=False):
+        self.batch_size = batch_size
+        self.workers = workers
+        self.dry_run = dry_run
+        self.stream = stream
+        self.log = log
         self.errors = []
         self.upserts = []
         self.summaries = []
         self.line_count = 0
         self.upsert_count = 0
 
+        # Dry run results. `planned` holds the values each task would end up with so far.
+        self.create_count = 0
+        self.update_count = 0
+        self.unchanged_count = 0
+        self.changes = []
+        self.planned = {}
+
+        # In-memory lookups filled by `prefetch`, so that validating a row costs no queries.
+        self.users = {}  # username -> User (or None if no such user)
+        self.groups = {}  # group name -> Group (or None if no such group)
+        self.task_lists = {}  # (group id, list name) -> TaskList
+        self.memberships = set()  # (user id, group id)
+
     def upsert(self, fileobj, as_string_obj=False):
         """Expects a file *object*, not a file path. This is important because this has to work for both
         the management command and the web uploader; the web uploader will pass in in-memory file
@@ -45,75 +99,334 @@ class CSVImporter:
 
         # DI check: Do we have expected header row?
         header = csv_reader.fieldnames
-        expected = [
-            "Title",
-            "Group",
-            "Task List",
-            "Created By",
-            "Created Date",
-            "Due Date",
-            "Completed",
-            "Assigned To",
-            "Note",
-            "Priority",
-        ]
+        expected = CSV_COLUMNS
         if header != expected:
             self.errors.append(
                 f"Inbound data does not have expected columns.\nShould be: {expected}"
             )
             return {"summaries": self.summaries, "upserts": self.upserts, "errors": self.errors}
 
+        if self.stream:
+            rows = csv_reader
+        else:
+            try:
+                rows = list(csv_reader)
+            except UnicodeDecodeError:
+                self.errors.append("Could not decode file as UTF-8. Save your CSV as UTF-8 and try again.")
+                return {"summaries": self.summaries, "upserts": self.upserts, "errors": self.errors}
+
+        # Rows already counted (by a resumed import job) were committed last time round.
+        rows = itertools.islice(rows, self.line_count, None)
+        if self.workers > 1:
+            batches = self.validate_batches_in_parallel(rows)
+        else:
+            batches = self.validate_batches(rows)
         try:
-          rows = list(csv_reader)
+            for valid_rows in batches:
+                if self.dry_run:
+                    self.diff_rows(valid_rows)
+                    continue
+                with transaction.atomic():
+                    self.write_rows(valid_rows)
+                    self.batch_written()
         except UnicodeDecodeError:
-            self.errors.append("Could not decode file as UTF-8. Save your CSV as UTF-8 and try again.")
-            return {"summaries": self.summaries, "upserts": self.upserts, "errors": self.errors}
-
-        for row in rows:
-            self.line_count += 1
-
-            newrow = self.validate_row(row)
-            if newrow:
-                # newrow at this point is fully validated, and all FK relations exist,
-                # e.g. `newrow.get("Assigned To")`, is a Django User instance.
-                assignee = newrow.get("Assigned To") if newrow.get("Assigned To") else None
-                created_date = (
-                    newrow.get("Created Date")
-                    if newrow.get("Created Date")
-                    else datetime.datetime.today()
-                )
-                due_date = newrow.get("Due Date") if newrow.get("Due Date") else None
-                priority = newrow.get("Priority") if newrow.get("Priority") else None
-
-                obj, created = Task.objects.update_or_create(
-                    created_by=newrow.get("Created By"),
-                    task_list=newrow.get("Task List"),
-                    title=newrow.get("Title"),
-                    defaults={
-                        "completed": newrow.get("Completed"),
-                        "created_date": created_date,
-                        "due_date": due_date,
-                        "note": newrow.get("Note"),
-                        "priority": priority,
-                    },
-                )
-                if assignee:
-                    obj.assigned_to.set([assignee])
-                else:
-                    obj.assigned_to.clear()
-                self.upsert_count += 1
-                msg = (
-                    f'Upserted task {obj.id}: "{obj.title}"'
-                    f' in list "{obj.task_list}" (group "{obj.task_list.group}")'
-                )
-                self.upserts.append(msg)
+            # Only possible when streaming, in which case earlier batches are already committed.
+            self.errors.append(
+                f"Could not decode file as UTF-8 after row {self.line_count}. "
+                "Save your CSV as UTF-8 and try again."
+            )
 
         self.summaries.append(f"Processed {self.line_count} CSV rows")
+        if self.dry_run:
+            valid_count = self.create_count + self.update_count + self.unchanged_count
+            self.summaries.append(f"Would create {self.create_count} tasks")
+            self.summaries.append(f"Would update {self.update_count} tasks")
+            self.summaries.append(f"Would leave {self.unchanged_count} tasks unchanged")
+            self.summaries.append(f"Would skip {self.line_count - valid_count} rows")
+            return {
+                "summaries": self.summaries,
+                "upserts": self.upserts,
+                "errors": self.errors,
+                "changes": self.changes,
+            }
+
         self.summaries.append(f"Upserted {self.upsert_count} rows")
         self.summaries.append(f"Skipped {self.line_count - self.upsert_count} rows")
 
         return {"summaries": self.summaries, "upserts": self.upserts, "errors": self.errors}
 
+    def row_key(self, newrow):
+        """What a validated row is matched to existing tasks on: (creator, list, title)."""
+        return (newrow["Created By"].id, newrow["Task List"].id, newrow.get("Title"))
+
+    def row_values(self, newrow):
+        """The values a validated row sets on its task, besides those it is matched on."""
+        return {
+            "completed": newrow.get("Completed"),
+            "created_date": (
+                newrow.get("Created Date")
+                if newrow.get("Created Date")
+                else datetime.datetime.today()
+            ),
+            "due_date": newrow.get("Due Date") if newrow.get("Due Date") else None,
+            "note": newrow.get("Note"),
+            "priority": newrow.get("Priority") if newrow.get("Priority") else None,
+        }
+
+    def existing_tasks(self, rows):
+        """Existing tasks for a chunk of (line number, validated row) pairs, by `row_key`.
+        Over-fetches by list and title, then narrows down by creator in Python."""
+        existing = {}
+        candidates = Task.objects.filter(
+            task_list__in={row["Task List"] for line, row in rows},
+            title__in={row.get("Title") for line, row in rows},
+        ).order_by("-id")
+        for task in candidates:
+            existing[(task.created_by_id, task.task_list_id, task.title)] = task
+        return existing
+
+    def write_rows(self, rows):
+        """Upsert a chunk of (line number, validated row) pairs in one transaction, matching
+        existing tasks on (creator, list, title) as `update_or_create` would. Tasks are written
+        with `bulk_create`/`bulk_update` and assignees straight into the M2M through table."""
+        if not rows:
+            return
+
+        existing = self.existing_tasks(rows)
+        now = datetime.datetime.now()
+        tasks = {}  # key -> Task, to create or update
+        assignees = {}  # key -> User or None
+        keys = []  # (line number, key) per row, in file order, for reporting
+        for line, newrow in rows:
+            # newrow at this point is fully validated, and all FK relations exist,
+            # e.g. `newrow.get("Assigned To")`, is a Django User instance.
+            key = self.row_key(newrow)
+            task = tasks.get(key) or existing.get(key)
+            if task is None:
+                task = Task(
+                    created_by=newrow["Created By"],
+                    task_list=newrow["Task List"],
+                    title=newrow.get("Title"),
+                )
+            task.task_list = newrow["Task List"]
+            for name, value in self.row_values(newrow).items():
+                setattr(task, name, value)
+            # Task.save() stamps completed tasks; bulk writes bypass it.
+            if task.completed:
+                task.completed_date = now
+
+            tasks[key] = task
+            assignees[key] = newrow.get("Assigned To") if newrow.get("Assigned To") else None
+            keys.append((line, key))
+
+        to_create = [task for task in tasks.values() if task.pk is None]
+        to_update = [task for task in tasks.values() if task.pk is not None]
+        Assignment = Task.assigned_to.through
+
+        with transaction.atomic():
+            if connection.features.can_return_rows_from_bulk_insert:
+                Task.objects.bulk_create(to_create)
+            else:
+                # We need the new ids for the report and the assignments.
+                for task in to_create:
+                    task.save()
+            Task.objects.bulk_update(to_update, ["completed_date", *ROW_FIELDS])
+            Assignment.objects.filter(task__in=to_update).delete()
+            Assignment.objects.bulk_create(
+                [
+                    Assignment(task_id=tasks[key].id, user_id=assignee.id)
+                    for key, assignee in assignees.items()
+                    if assignee
+                ]
+            )
+
+            # Bulk writes don't send post_save, so update the search index ourselves.
+            get_search_backend().index_tasks(list(tasks.values()))
+
+        for line, key in keys:
+            self.record_upsert(line, tasks[key])
+
+    def diff_rows(self, rows):
+        """Work out what `write_rows` would do with a chunk of (line number, validated row) pairs,
+        without writing anything: each row creates a task, updates one, or leaves it unchanged.
+        Rows are compared with the database, or with an earlier row of the file for the same task.
+        """
+        if not rows:
+            return
+
+        existing = self.existing_tasks(rows)
+        assigned = {}
+        assignments = Task.assigned_to.through.objects.filter(task__in=existing.values())
+        for task_id, user_id in assignments.values_list("task_id", "user_id"):
+            assigned.setdefault(task_id, set()).add(user_id)
+
+        for line, newrow in rows:
+            key = self.row_key(newrow)
+            values = {
+                name: Task._meta.get_field(name).to_python(value)
+                for name, value in self.row_values(newrow).items()
+            }
+            assignee = newrow.get("Assigned To")
+            values["assigned_to"] = {assignee.id} if assignee else set()
+
+            if key in self.planned:
+                before = self.planned[key]
+            elif key in existing:
+                task = existing[key]
+                before = {name: getattr(task, name) for name in ROW_FIELDS}
+                # A CSV can't tell a blank note from a missing one.
+                before["note"] = task.note or ""
+                before["assigned_to"] = assigned.get(task.id, set())
+            else:
+                before = None
+            self.planned[key] = values
+
+            where = f'"{newrow.get("Title")}" in list "{newrow["Task List"]}"'
+            if before is None:
+                self.create_count += 1
+                change = f"Would create {where}"
+            else:
+                changed = [name for name in values if values[name] != before[name]]
+                if not changed:
+                    self.unchanged_count += 1
+                    continue
+                self.update_count += 1
+                change = f"Would update {where}: {', '.join(changed)}"
+            if len(self.changes) < self.MAX_CHANGES:
+                self.changes.append(f"CSV row {line}. {change}")
+
+    def validate_batches(self, rows):
+        """Validate `rows` a batch at a time, yielding each batch's valid (line number, row) pairs."""
+        for chunk in chunked(rows, self.batch_size):
+            self.prefetch(chunk)
+
+            valid_rows = []
+            for row in chunk:
+                self.line_count += 1
+                newrow = self.validate_row(row)
+                if newrow:
+                    valid_rows.append((self.line_count, newrow))
+            yield valid_rows
+
+    def validate_batches_in_parallel(self, rows):
+        """As `validate_batches`, but with the batches validated in a pool of `workers` processes.
+
+        Lookups are still prefetched here, a batch per worker at a time, and the entries each
+        batch needs are sent along with its rows, so workers never touch the database. Errors are
+        recorded and batches yielded in their original order, so writes and reports are exactly
+        as for a serial import.
+        """
+        # Spawned rather than forked, so that children don't share our database connection.
+        context = multiprocessing.get_context("spawn")
+        pool = ProcessPoolExecutor(self.workers, mp_context=context, initializer=django.setup)
+        with pool:
+            for group in chunked(rows, self.batch_size * self.workers):
+                self.prefetch(group)
+                shards = chunked(group, self.batch_size)
+                starts = range(self.line_count, self.line_count + len(group), self.batch_size)
+                jobs = [
+                    (self.lookups_for(shard), start, shard) for start, shard in zip(starts, shards)
+                ]
+
+                for valid_rows, errors, count in pool.map(validate_shard, jobs):
+                    self.line_count += count
+                    for line, row_errors in errors:
+                        self.record_errors(line, row_errors)
+                    yield valid_rows
+
+    def batch_written(self):
+        """Called in the same transaction as each batch of writes. A no-op here; import jobs
+        use it to save their progress."""
+        pass
+
+    def record_upsert(self, line, obj):
+        self.upsert_count += 1
+        if self.stream:
+            if self.log:
+                self.log.write(f"{line}\tupserted\t{obj.id}\n")
+            return
+        msg = (
+            f'Upserted task {obj.id}: "{obj.title}"'
+            f' in list "{obj.task_list}" (group "{obj.task_list.group}")'
+        )
+        self.upserts.append(msg)
+
+    def record_errors(self, line, row_errors):
+        if self.stream:
+            if self.log:
+                self.log.write(f"{line}\tskipped\t{'; '.join(row_errors)}\n")
+            return
+        self.errors.append({line: row_errors})
+
+    def prefetch(self, rows):
+        """Load every user, group, group membership and task list referenced by `rows` that we
+        haven't already loaded, in a handful of queries whatever the number of rows."""
+        usernames = {row.get(col) for row in rows for col in ("Created By", "Assigned To")}
+        usernames = {name for name in usernames if name} - self.users.keys()
+        group_names = {row.get("Group") for row in rows} - self.groups.keys()
+
+        new_users = list(get_user_model().objects.filter(username__in=usernames))
+        self.users.update({name: None for name in usernames})
+        self.users.update({user.username: user for user in new_users})
+
+        new_groups = list(Group.objects.filter(name__in=group_names))
+        self.groups.update({name: None for name in group_names})
+        self.groups.update({group.name: group for group in new_groups})
+
+        # Fetch memberships of new users in any known group, and of known users in new groups,
+        # so the set stays complete as more rows are prefetched.
+        if new_users or new_groups:
+            groups_field = get_user_model()._meta.get_field("groups")
+            user_col = groups_field.m2m_field_name()
+            group_col = groups_field.m2m_reverse_field_name()
+            known_users = [user.id for user in self.users.values() if user]
+            known_groups = [group.id for group in self.groups.values() if group]
+            new_user_ids = [user.id for user in new_users]
+            new_group_ids = [group.id for group in new_groups]
+            memberships = groups_field.remote_field.through.objects.filter(
+                Q(**{f"{user_col}__in": new_user_ids, f"{group_col}__in": known_groups})
+                | Q(**{f"{user_col}__in": known_users, f"{group_col}__in": new_group_ids})
+            )
+            self.memberships.update(memberships.values_list(f"{user_col}_id", f"{group_col}_id"))
+
+        wanted = {
+            (self.groups[row.get("Group")].id, row.get("Task List"))
+            for row in rows
+            if self.groups[row.get("Group")] is not None
+        } - self.task_lists.keys()
+        if wanted:
+            task_lists = TaskList.objects.select_related("group").filter(
+                group__in={group_id for group_id, name in wanted},
+                name__in={name for group_id, name in wanted},
+            ).order_by("-id")
+            self.task_lists.update({key: None for key in wanted})
+            # If a group has two lists with the same name, the oldest one wins.
+            self.task_lists.update({(tl.group_id, tl.name): tl for tl in task_lists})
+
+    def lookups_for(self, rows):
+        """The part of the prefetched lookups that validating `rows` reads, so that a worker
+        is sent just that rather than everything loaded so far."""
+        users = {
+            name: self.users.get(name)
+            for row in rows
+            for name in (row.get("Created By"), row.get("Assigned To"))
+            if name
+        }
+        groups = {row.get("Group"): self.groups.get(row.get("Group")) for row in rows}
+        task_lists = {}
+        memberships = set()
+        for row in rows:
+            group = groups[row.get("Group")]
+            if group is None:
+                continue
+            key = (group.id, row.get("Task List"))
+            task_lists[key] = self.task_lists.get(key)
+            for name in (row.get("Created By"), row.get("Assigned To")):
+                user = users.get(name)
+                if user and self.is_member(user, group):
+                    memberships.add((user.id, group.id))
+        return users, groups, task_lists, memberships
+
     def validate_row(self, row):
         """Perform data integrity checks and set default values. Returns a valid object for insertion, or False.
         Errors are stored for later display. Intentionally not broken up into separate validator functions because
@@ -128,7 +441,7 @@ class CSVImporter:
             msg = f"Missing required task creator."
             row_errors.append(msg)
 
-        creator = get_user_model().objects.filter(username=row.get("Created By")).first()
+        creator = self.users.get(row.get("Created By"))
         if not creator:
             msg = f"Invalid task creator {row.get('Created By')}"
             row_errors.append(msg)
@@ -137,40 +450,36 @@ class CSVImporter:
         # If specified, Assignee must exist
         assignee = None  # Perfectly valid
         if row.get("Assigned To"):
-            assigned = get_user_model().objects.filter(username=row.get("Assigned To"))
-            if assigned.exists():
-                assignee = assigned.first()
-            else:
+            assignee = self.users.get(row.get("Assigned To"))
+            if not assignee:
                 msg = f"Missing or invalid task assignee {row.get('Assigned To')}"
                 row_errors.append(msg)
 
         # #######################
         # Group must exist
-        try:
-            target_group = Group.objects.get(name=row.get("Group"))
-        except Group.DoesNotExist:
+        target_group = self.groups.get(row.get("Group"))
+        if not target_group:
             msg = f"Could not find group {row.get('Group')}."
             row_errors.append(msg)
-            target_group = None
 
         # #######################
         # Task creator must be in the target group
-        if creator and target_group not in creator.groups.all():
+        if creator and not self.is_member(creator, target_group):
             msg = f"{creator} is not in group {target_group}"
             row_errors.append(msg)
 
         # #######################
         # Assignee must be in the target group
-        if assignee and target_group not in assignee.groups.all():
+        if assignee and not self.is_member(assignee, target_group):
             msg = f"{assignee} is not in group {target_group}"
             row_errors.append(msg)
 
         # #######################
         # Task list must exist in the target group
-        try:
-            tasklist = TaskList.objects.get(name=row.get("Task List"), group=target_group)
+        tasklist = target_group and self.task_lists.get((target_group.id, row.get("Task List")))
+        if tasklist:
             row["Task List"] = tasklist
-        except TaskList.DoesNotExist:
+        else:
             msg = f"Task list {row.get('Task List')} in group {target_group} does not exist"
             row_errors.append(msg)
 
@@ -199,12 +508,15 @@ class CSVImporter:
 
         # #######################
         if row_errors:
-            self.errors.append({self.line_count: row_errors})
+            self.record_errors(self.line_count, row_errors)
             return False
 
         # No errors:
         return row
 
+    def is_member(self, user, group):
+        return group is not None and (user.id, group.id) in self.memberships
+
     def validate_date(self, datestring):
         """Inbound date string from CSV translates to a valid python date."""
         try:
@@ -212,3 +524,28 @@ class CSVImporter:
             return date_obj
         except ValueError:
             return False
+
+
+def chunked(iterable, size):
+    """Yield lists of up to `size` items from `iterable`."""
+    iterator = iter(iterable)
+    return iter(lambda: list(itertools.islice(iterator, size)), [])
+
+
+def validate_shard(job):
+    """Validate one batch of rows in a worker process. Returns the valid (line number, row) pairs,
+    the (line number, errors) pairs of invalid rows, and the number of rows seen."""
+    (users, groups, task_lists, memberships), start, rows = job
+    importer = CSVImporter()
+    importer.users, importer.groups = users, groups
+    importer.task_lists, importer.memberships = task_lists, memberships
+    importer.line_count = start
+
+    valid_rows = []
+    for row in rows:
+        importer.line_count += 1
+        newrow = importer.validate_row(row)
+        if newrow:
+            valid_rows.append((importer.line_count, newrow))
+    errors = [(line, row_errors) for error in importer.errors for line, row_errors in error.items()]
+    return valid_rows, errors, len(rows)
@@ -0,0 +1,122 @@
+import codecs
+import csv
+import datetime
+import logging
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from todo.models import ImportJob
+from todo.operations.csv_importer import CSVImporter
+
+log = logging.getLogger(__name__)
+
+
+class ImportJobLost(Exception):
+    """The job was taken over by another worker, so this one must stop."""
+
+
+class JobImporter(CSVImporter):
+    """Streaming CSVImporter that keeps its counters and errors on an ImportJob, saving them
+    with every batch so that progress can be polled and a crashed job resumed."""
+
+    def __init__(self, job, batch_size=500):
+        super().__init__(batch_size=batch_size, stream=True)
+        self.job = job
+        # Resume after the rows already committed.
+        self.line_count = job.rows_processed
+        self.upsert_count = job.rows_upserted
+
+    def record_errors(self, line, row_errors):
+        self.job.error_count += 1
+        if len(self.job.errors) < ImportJob.MAX_ERRORS:
+            self.job.errors.append({line: row_errors})
+
+    def batch_written(self):
+        self.job.rows_processed = self.line_count
+        self.job.rows_upserted = self.upsert_count
+        self.job.updated_date = timezone.now()
+        # Only while the job is still ours: if another worker took it over, raising here rolls
+        # the batch back, since that worker carries on from the progress we saved last.
+        saved = ImportJob.objects.filter(
+            pk=self.job.pk, status=ImportJob.RUNNING, started_date=self.job.started_date
+        ).update(
+            rows_processed=self.job.rows_processed,
+            rows_upserted=self.job.rows_upserted,
+            error_count=self.job.error_count,
+            errors=self.job.errors,
+            updated_date=self.job.updated_date,
+        )
+        if not saved:
+            raise ImportJobLost(f"Import job {self.job.pk} was taken over by another worker.")
+
+
+def count_rows(job):
+    """Number of data rows in the job's file, or None if it can't be read."""
+    try:
+        with job.file.open("rb") as fileobj:
+            return max(sum(1 for _ in csv.reader(codecs.iterdecode(fileobj, "utf-8-sig"))) - 1, 0)
+    except (UnicodeDecodeError, csv.Error):
+        return None
+
+
+def claim_import_job(stale_after=300):
+    """Mark the oldest waiting job as running and return it. Running jobs that haven't saved
+    any progress for `stale_after` seconds have lost their worker, and are claimed again; should
+    that worker still be alive, it stops at its next batch (see JobImporter.batch_written)."""
+    stale = timezone.now() - datetime.timedelta(seconds=stale_after)
+    with transaction.atomic():
+        job = (
+            ImportJob.objects.select_for_update(skip_locked=True)
+            .filter(
+                Q(status=ImportJob.PENDING) | Q(status=ImportJob.RUNNING, updated_date__lt=stale)
+            )
+            .order_by("created_date")
+            .first()
+        )
+        if job is None:
+            return None
+        job.status = ImportJob.RUNNING
+        job.started_date = job.updated_date = timezone.now()
+        job.resumed_from = job.rows_processed
+        job.save(update_fields=["status", "started_date", "updated_date", "resumed_from"])
+    return job
+
+
+def run_import_job(job, batch_size=500):
+    """Import a claimed job's file, carrying on from its last committed batch. Once the job is
+    done or has failed, the file is deleted."""
+    if job.total_rows is None:
+        job.total_rows = count_rows(job)
+        job.save(update_fields=["total_rows"])
+
+    importer = JobImporter(job, batch_size=batch_size)
+    try:
+        with job.file.open("rb") as fileobj:
+            results = importer.upsert(fileobj)
+    except ImportJobLost:
+        log.warning("Import job %s was taken over by another worker; stopping.", job.id)
+        return job
+    except Exception:
+        log.exception("Import job %s failed", job.id)
+        job.status = ImportJob.FAILED
+        job.message = (
+            "The import stopped unexpectedly. Rows up to the last progress update were saved."
+        )
+    else:
+        # Anything left in `errors` is about the file as a whole, not a row.
+        job.status = ImportJob.FAILED if results["errors"] else ImportJob.DONE
+        job.message = "\n".join(results["errors"])
+
+    job.finished_date = timezone.now()
+    # As in JobImporter.batch_written: a worker whose job was taken over leaves it alone.
+    finished = ImportJob.objects.filter(
+        pk=job.pk, status=ImportJob.RUNNING, started_date=job.started_date
+    ).update(status=job.status, message=job.message, finished_date=job.finished_date)
+    if not finished:
+        log.warning("Import job %s was taken over by another worker; stopping.", job.id)
+        return job
+    # Nothing reads the upload again. The name stays on the job, for the import page.
+    job.file.storage.delete(job.file.name)
+    return job
@@ -0,0 +1,76 @@
+import csv
+import json
+
+from django.db.models import OuterRef, Subquery
+
+from todo.models import Task
+from todo.operations.csv_importer import CSV_COLUMNS
+
+# Values fetched for each exported task, in CSV_COLUMNS order.
+EXPORT_FIELDS = [
+    "title",
+    "task_list__group__name",
+    "task_list__name",
+    "created_by__username",
+    "created_date",
+    "due_date",
+    "completed",
+    "assignee",
+    "note",
+    "priority",
+]
+
+
+def export_rows(queryset, chunk_size=2000):
+    """Yield a dict per task in `queryset`, keyed by CSV_COLUMNS and formatted as `CSVImporter`
+    expects, so that an export can be imported again. Tasks are read `chunk_size` at a time
+    as plain values in one query, so memory use doesn't depend on the number of tasks.
+
+    The importer takes a single assignee, so only the first (by username) is exported.
+    """
+    Assignment = Task.assigned_to.through
+    first_assignee = (
+        Assignment.objects.filter(task=OuterRef("pk"))
+        .order_by("user__username")
+        .values("user__username")[:1]
+    )
+    values = (
+        queryset.annotate(assignee=Subquery(first_assignee))
+        .order_by("pk")
+        .values_list(*EXPORT_FIELDS)
+        .iterator(chunk_size=chunk_size)
+    )
+    for row in values:
+        row = dict(zip(CSV_COLUMNS, row))
+        for column in ("Created Date", "Due Date"):
+            row[column] = row[column].strftime("%Y-%m-%d") if row[column] else ""
+        row["Completed"] = "Yes" if row["Completed"] else "No"
+        yield {column: "" if value is None else value for column, value in row.items()}
+
+
+class Echo:
+    """File-like object that hands back whatever is written to it, so that `csv.writer` can
+    produce lines for a generator instead of writing them to a buffer."""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows):
+    """Lines of CSV, header first, for the dicts from `export_rows`."""
+    writer = csv.writer(Echo())
+    yield writer.writerow(CSV_COLUMNS)
+    for row in rows:
+        yield writer.writerow([row[column] for column in CSV_COLUMNS])
+
+
+def jsonl_lines(rows):
+    """One line of JSON per dict from `export_rows`."""
+    for row in rows:
+        yield json.dumps(row) + "\n"
+
+
+FORMATS = {
+    "csv": (csv_lines, "text/csv"),
+    "jsonl": (jsonl_lines, "application/x-ndjson"),
+}
@@ -0,0 +1,143 @@
+import base64
+import json
+
+from django.core.exceptions import ValidationError
+from django.db.models import F, Q
+
+# Order in which paginated task views are shown. `id` comes last so that every row has a
+# unique position, which is what makes cursors stable.
+TASK_KEYSET_ORDERING = ("priority", "created_date", "id")
+
+
+class KeysetPage:
+    """One page of a keyset-paginated queryset, plus opaque cursors for its neighbours."""
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __bool__(self):
+        return bool(self.object_list)
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+
+def keyset_order(ordering=TASK_KEYSET_ORDERING, forward=True):
+    """order_by() arguments for walking `ordering` forwards (NULLs last) or backwards."""
+    if forward:
+        return [F(name).asc(nulls_last=True) for name in ordering]
+    return [F(name).desc(nulls_first=True) for name in ordering]
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor, fields):
+    """Turn a cursor back into field values. Returns None for anything we didn't produce."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if not isinstance(values, list) or len(values) != len(fields):
+            return None
+        return [None if v is None else field.to_python(v) for field, v in zip(fields, values)]
+    except (ValueError, TypeError, ValidationError):
+        return None
+
+
+def _keyset_filter(names, values, forward):
+    """Build the "rows strictly after (or before) this position" condition.
+
+    NULLs sort after every value, so for a NULL position nothing comes after it on that
+    column and every non-NULL value comes before it.
+    """
+    name, value = names[0], values[0]
+
+    if value is None:
+        beyond = Q(pk__in=[]) if forward else Q(**{f"{name}__isnull": False})
+        same = Q(**{f"{name}__isnull": True})
+    else:
+        if forward:
+            beyond = Q(**{f"{name}__gt": value}) | Q(**{f"{name}__isnull": True})
+        else:
+            beyond = Q(**{f"{name}__lt": value})
+        same = Q(**{name: value})
+
+    if len(names) == 1:
+        return beyond
+    return beyond | (same & _keyset_filter(names[1:], values[1:], forward))
+
+
+def adjacent(queryset, obj, forward=True, ordering=TASK_KEYSET_ORDERING):
+    """Return the row of `queryset` immediately after (or before) `obj` in `ordering`, if any."""
+    fields = [queryset.model._meta.get_field(name) for name in ordering]
+    attnames = [field.attname for field in fields]
+    values = [getattr(obj, name) for name in attnames]
+    return (
+        queryset.filter(_keyset_filter(attnames, values, forward))
+        .order_by(*keyset_order(attnames, forward))
+        .first()
+    )
+
+
+def keyset_paginate(
+    queryset, after=None, before=None, per_page=100, ordering=TASK_KEYSET_ORDERING
+):
+    """Return a KeysetPage of `queryset` in `ordering` (NULLs last, last field unique).
+
+    Pages are located by filtering on the position of the first/last row of the
+    neighbouring page instead of using OFFSET, so any page costs the same to fetch.
+    Unrecognised cursors fall back to the first page.
+    """
+    fields = [queryset.model._meta.get_field(name) for name in ordering]
+    attnames = [field.attname for field in fields]
+
+    def position(obj):
+        return [
+            None if getattr(obj, field.attname) is None else field.value_to_string(obj)
+            for field in fields
+        ]
+
+    forward_order = keyset_order(attnames, forward=True)
+    backward_order = keyset_order(attnames, forward=False)
+
+    after_values = decode_cursor(after, fields) if after else None
+    before_values = decode_cursor(before, fields) if before else None
+
+    if before_values is not None:
+        rows = list(
+            queryset.filter(_keyset_filter(attnames, before_values, forward=False))
+            .order_by(*backward_order)[: per_page + 1]
+        )
+        has_more = len(rows) > per_page
+        rows = list(reversed(rows[:per_page]))
+        has_previous, has_next = has_more, True
+    else:
+        if after_values is not None:
+            queryset = queryset.filter(_keyset_filter(attnames, after_values, forward=True))
+        rows = list(queryset.order_by(*forward_order)[: per_page + 1])
+        has_next = len(rows) > per_page
+        rows = rows[:per_page]
+        has_previous = after_values is not None
+
+    if not rows:
+        return KeysetPage(rows)
+
+    return KeysetPage(
+        rows,
+        next_cursor=encode_cursor(position(rows[-1])) if has_next else None,
+        previous_cursor=encode_cursor(position(rows[0])) if has_previous else None,
+    )
@@ -0,0 +1,25 @@
+from functools import lru_cache
+
+from django.db import connection
+from django.utils.module_loading import import_string
+
+from todo.defaults import defaults
+
+# Used when TODO_SEARCH_BACKEND is not set: pick the full-text engine native to the database.
+VENDOR_BACKENDS = {
+    "sqlite": "todo.search.backends.SQLiteSearchBackend",
+    "postgresql": "todo.search.backends.PostgresSearchBackend",
+}
+
+
+@lru_cache(maxsize=None)
+def _load_backend(path):
+    return import_string(path)()
+
+
+def get_search_backend():
+    """Return the configured search backend instance (see TODO_SEARCH_BACKEND in README)."""
+    path = defaults("TODO_SEARCH_BACKEND") or VENDOR_BACKENDS.get(
+        connection.vendor, "todo.search.backends.SimpleSearchBackend"
+    )
+    return _load_backend(path)
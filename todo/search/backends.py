@@ -0,0 +1,333 @@
+import re
+from collections import defaultdict
+
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from todo.models import Comment, Task
+
+# Highlight delimiters handed to the database. Snippets are HTML-escaped before these are
+# swapped for <mark> tags, so nothing in a task or comment can inject markup.
+HIGHLIGHT_START = "\ue000"
+HIGHLIGHT_STOP = "\ue001"
+
+
+def search_terms(query):
+    """Split free text from the search box into plain words."""
+    return re.findall(r"\w+", query or "")
+
+
+def highlight(fragment):
+    return mark_safe(
+        escape(fragment).replace(HIGHLIGHT_START, "<mark>").replace(HIGHLIGHT_STOP, "</mark>")
+    )
+
+
+class SimpleSearchBackend:
+    """Unindexed fallback for databases without a full-text backend. Matches the whole query
+    as a substring of the task title, note or comments, as django-todo always has."""
+
+    def index_tasks(self, tasks):
+        pass
+
+    def index_task(self, task):
+        self.index_tasks([task])
+
+    def remove_task(self, task_id):
+        pass
+
+    def index_comments(self, comments):
+        pass
+
+    def index_comment(self, comment):
+        self.index_comments([comment])
+
+    def remove_comment(self, comment_id):
+        pass
+
+    def rebuild(self):
+        pass
+
+    def search(self, queryset, query):
+        """Narrow `queryset` to tasks matching `query`, best matches first."""
+        matches = Task.objects.filter(
+            Q(title__icontains=query) | Q(note__icontains=query) | Q(comment__body__icontains=query)
+        )
+        return queryset.filter(id__in=matches.values("id"))
+
+    def snippets(self, task_ids, query, per_task=3):
+        """Return {task_id: [highlighted fragment, ...]} for the given tasks, best first."""
+        return {}
+
+
+class SQLiteSearchBackend(SimpleSearchBackend):
+    """Full-text search using SQLite FTS5 tables whose rowids are task and comment ids.
+    The tables are created by migrations 0014 and 0015."""
+
+    table = "todo_task_fts"
+    comment_table = "todo_comment_fts"
+    # bm25 column weights: a hit in the title counts for more than a hit in the note.
+    weights = (10.0, 1.0)
+    snippet_tokens = 12
+
+    def index_tasks(self, tasks):
+        rows = [(task.pk, task.title or "", task.note or "") for task in tasks]
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"DELETE FROM {self.table} WHERE rowid = %s", [(row[0],) for row in rows]
+            )
+            cursor.executemany(
+                f"INSERT INTO {self.table} (rowid, title, note) VALUES (%s, %s, %s)", rows
+            )
+
+    def remove_task(self, task_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.table} WHERE rowid = %s", [task_id])
+
+    def index_comments(self, comments):
+        rows = [(comment.pk, comment.body or "") for comment in comments]
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"DELETE FROM {self.comment_table} WHERE rowid = %s", [(row[0],) for row in rows]
+            )
+            cursor.executemany(
+                f"INSERT INTO {self.comment_table} (rowid, body) VALUES (%s, %s)", rows
+            )
+
+    def remove_comment(self, comment_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.comment_table} WHERE rowid = %s", [comment_id])
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.table}")
+            cursor.execute(
+                f"INSERT INTO {self.table} (rowid, title, note) "
+                f"SELECT id, title, COALESCE(note, '') FROM {Task._meta.db_table}"
+            )
+            cursor.execute(f"DELETE FROM {self.comment_table}")
+            cursor.execute(
+                f"INSERT INTO {self.comment_table} (rowid, body) "
+                f"SELECT id, body FROM {Comment._meta.db_table}"
+            )
+
+    def match_expression(self, query):
+        # Quote every term so that user input can't be read as FTS5 query syntax.
+        return " ".join('"{}"'.format(term) for term in search_terms(query))
+
+    def search(self, queryset, query):
+        match = self.match_expression(query)
+        if not match:
+            return queryset.none()
+
+        table, comments = self.table, self.comment_table
+        task_table, comment_table = Task._meta.db_table, Comment._meta.db_table
+        weights = ", ".join(str(w) for w in self.weights)
+
+        # One MATCH on each index, scored per task: a task ranks on its own text plus its
+        # best-matching comment. bm25() is lower-is-better; negate it so every backend sorts
+        # on -search_rank. Comments are looked up through todo_comment rather than storing
+        # their task in the index, so comments moved by Task.merge_into() are found on their
+        # new task.
+        hits = (
+            "SELECT task_id, SUM(score) AS score FROM ("
+            f"SELECT rowid AS task_id, -bm25({table}, {weights}) AS score "
+            f"FROM {table} WHERE {table} MATCH %s "
+            "UNION ALL "
+            f"SELECT c.task_id, MAX(-{comments}.rank) FROM {comments} "
+            f"JOIN {comment_table} c ON c.id = {comments}.rowid "
+            f"WHERE {comments} MATCH %s GROUP BY c.task_id"
+            ") GROUP BY task_id"
+        )
+        # SQLite evaluates `hits` once and joins tasks to it through an automatic index, rather
+        # than running the MATCHes again for every task.
+        return (
+            queryset.filter(id__in=RawSQL(f"SELECT task_id FROM ({hits})", [match, match]))
+            .annotate(
+                search_rank=RawSQL(
+                    f"SELECT h.score FROM ({hits}) h WHERE h.task_id = {task_table}.id",
+                    [match, match],
+                )
+            )
+            .order_by("-search_rank", "id")
+        )
+
+    def snippets(self, task_ids, query, per_task=3):
+        match = self.match_expression(query)
+        task_ids = list(task_ids)
+        if not match or not task_ids:
+            return {}
+
+        table, comments = self.table, self.comment_table
+        placeholders = ", ".join(["%s"] * len(task_ids))
+        marks = [HIGHLIGHT_START, HIGHLIGHT_STOP, "…", self.snippet_tokens]
+        found = defaultdict(list)
+        with connection.cursor() as cursor:
+            # Hits in the task note first...
+            cursor.execute(
+                f"SELECT rowid, snippet({table}, 1, %s, %s, %s, %s) FROM {table} "
+                f"WHERE {table} MATCH %s AND rowid IN ({placeholders})",
+                marks + [f"note : ({match})"] + task_ids,
+            )
+            for task_id, fragment in cursor.fetchall():
+                found[task_id].append(fragment)
+
+            # ...then the best few comment hits per task. snippet() isn't allowed alongside a
+            # window function, so pick the comments first and build their snippets after.
+            comment_table = Comment._meta.db_table
+            cursor.execute(
+                f"SELECT c.task_id, snippet({comments}, 0, %s, %s, %s, %s) FROM {comments} "
+                f"JOIN {comment_table} c ON c.id = {comments}.rowid "
+                f"WHERE {comments} MATCH %s AND {comments}.rowid IN ("
+                "SELECT id FROM ("
+                f"SELECT c.id, ROW_NUMBER() OVER ("
+                f"PARTITION BY c.task_id ORDER BY {comments}.rank) AS n "
+                f"FROM {comments} JOIN {comment_table} c ON c.id = {comments}.rowid "
+                f"WHERE {comments} MATCH %s AND c.task_id IN ({placeholders})"
+                ") WHERE n <= %s"
+                f") ORDER BY c.task_id, {comments}.rank",
+                marks + [match, match] + task_ids + [per_task],
+            )
+            for task_id, fragment in cursor.fetchall():
+                found[task_id].append(fragment)
+
+        return {
+            task_id: [highlight(fragment) for fragment in fragments[:per_task]]
+            for task_id, fragments in found.items()
+        }
+
+
+class PostgresSearchBackend(SimpleSearchBackend):
+    """Full-text search using tsvector side tables with GIN indexes, created by migrations
+    0014 and 0015. Title words are weighted above note words, and note words above comments."""
+
+    table = "todo_tasksearch"
+    comment_table = "todo_commentsearch"
+    config = "english"
+    headline_options = f"StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_STOP}, MaxFragments=1"
+
+    document_sql = (
+        "setweight(to_tsvector(%s::regconfig, %s), 'A') || "
+        "setweight(to_tsvector(%s::regconfig, %s), 'B')"
+    )
+    tsquery = "websearch_to_tsquery(%s::regconfig, %s)"
+
+    def index_tasks(self, tasks):
+        rows = [
+            (task.pk, self.config, task.title or "", self.config, task.note or "")
+            for task in tasks
+        ]
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {self.table} (task_id, document) VALUES (%s, {self.document_sql}) "
+                "ON CONFLICT (task_id) DO UPDATE SET document = EXCLUDED.document",
+                rows,
+            )
+
+    def remove_task(self, task_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.table} WHERE task_id = %s", [task_id])
+
+    def index_comments(self, comments):
+        rows = [(comment.pk, self.config, comment.body or "") for comment in comments]
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {self.comment_table} (comment_id, document) "
+                "VALUES (%s, setweight(to_tsvector(%s::regconfig, %s), 'C')) "
+                "ON CONFLICT (comment_id) DO UPDATE SET document = EXCLUDED.document",
+                rows,
+            )
+
+    def remove_comment(self, comment_id):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {self.comment_table} WHERE comment_id = %s", [comment_id]
+            )
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.table}")
+            cursor.execute(
+                f"INSERT INTO {self.table} (task_id, document) "
+                "SELECT id, setweight(to_tsvector(%s::regconfig, title), 'A') || "
+                "setweight(to_tsvector(%s::regconfig, COALESCE(note, '')), 'B') "
+                f"FROM {Task._meta.db_table}",
+                [self.config, self.config],
+            )
+            cursor.execute(f"DELETE FROM {self.comment_table}")
+            cursor.execute(
+                f"INSERT INTO {self.comment_table} (comment_id, document) "
+                "SELECT id, setweight(to_tsvector(%s::regconfig, body), 'C') "
+                f"FROM {Comment._meta.db_table}",
+                [self.config],
+            )
+
+    def search(self, queryset, query):
+        if not search_terms(query):
+            return queryset.none()
+
+        table, comments, tsquery = self.table, self.comment_table, self.tsquery
+        task_table, comment_table = Task._meta.db_table, Comment._meta.db_table
+        params = [self.config, query]
+
+        comment_hits = (
+            f"FROM {comments} JOIN {comment_table} c ON c.id = {comments}.comment_id "
+            f"WHERE {comments}.document @@ {tsquery}"
+        )
+        return (
+            queryset.filter(
+                Q(id__in=RawSQL(f"SELECT task_id FROM {table} WHERE document @@ {tsquery}", params))
+                | Q(id__in=RawSQL(f"SELECT c.task_id {comment_hits}", params))
+            )
+            .annotate(
+                search_rank=RawSQL(
+                    f"COALESCE((SELECT ts_rank(document, {tsquery}) FROM {table} "
+                    f"WHERE task_id = {task_table}.id), 0) + "
+                    f"COALESCE((SELECT MAX(ts_rank({comments}.document, {tsquery})) "
+                    f"{comment_hits} AND c.task_id = {task_table}.id), 0)",
+                    params * 3,
+                )
+            )
+            .order_by("-search_rank", "id")
+        )
+
+    def snippets(self, task_ids, query, per_task=3):
+        task_ids = list(task_ids)
+        if not search_terms(query) or not task_ids:
+            return {}
+
+        tsquery = self.tsquery
+        found = defaultdict(list)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT id, ts_headline(%s::regconfig, note, {tsquery}, %s) "
+                f"FROM {Task._meta.db_table} WHERE id = ANY(%s) "
+                f"AND to_tsvector(%s::regconfig, COALESCE(note, '')) @@ {tsquery}",
+                [self.config, self.config, query, self.headline_options, task_ids]
+                + [self.config, self.config, query],
+            )
+            for task_id, fragment in cursor.fetchall():
+                found[task_id].append(fragment)
+
+            # Only the best few comments per task are put through ts_headline().
+            cursor.execute(
+                f"SELECT task_id, ts_headline(%s::regconfig, body, {tsquery}, %s) FROM ("
+                "SELECT c.task_id, c.body, ROW_NUMBER() OVER ("
+                f"PARTITION BY c.task_id ORDER BY ts_rank(s.document, {tsquery}) DESC) AS n "
+                f"FROM {self.comment_table} s JOIN {Comment._meta.db_table} c "
+                "ON c.id = s.comment_id "
+                f"WHERE c.task_id = ANY(%s) AND s.document @@ {tsquery}"
+                ") hits WHERE n <= %s ORDER BY task_id, n",
+                [self.config, self.config, query, self.headline_options]
+                + [self.config, query, task_ids, self.config, query, per_task],
+            )
+            for task_id, fragment in cursor.fetchall():
+                found[task_id].append(fragment)
+
+        return {
+            task_id: [highlight(fragment) for fragment in fragments[:per_task]]
+            for task_id, fragments in found.items()
+        }
@@ -0,0 +1,30 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from todo.models import Comment, Task
+from todo.search import get_search_backend
+
+
+@receiver(post_save, sender=Task)
+def index_saved_task(sender, instance, raw=False, **kwargs):
+    if raw:
+        # Fixture loading; run `rebuild_search_index` afterwards.
+        return
+    get_search_backend().index_task(instance)
+
+
+@receiver(post_delete, sender=Task)
+def unindex_deleted_task(sender, instance, **kwargs):
+    get_search_backend().remove_task(instance.pk)
+
+
+@receiver(post_save, sender=Comment)
+def index_saved_comment(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    get_search_backend().index_comment(instance)
+
+
+@receiver(post_delete, sender=Comment)
+def unindex_deleted_comment(sender, instance, **kwargs):
+    get_search_backend().remove_comment(instance.pk)
@@ -0,0 +1,49 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from todo.utils import EMAIL_USERS_CACHE_VERSION_KEY, GROUP_IDS_CACHE_VERSION_KEY
+
+
+def bump_version(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Not cached yet (or evicted); any new value is a new version.
+        cache.set(key, 2, None)
+
+
+def bump_group_ids_version():
+    """Invalidate every cached set of group IDs (see utils.user_group_ids)."""
+    bump_version(GROUP_IDS_CACHE_VERSION_KEY)
+
+
+@receiver(m2m_changed, sender=get_user_model().groups.through)
+def group_membership_changed(sender, instance, action, **kwargs):
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    # Also forget what was looked up on this very object (user.groups.add(...) etc).
+    instance.__dict__.pop("_todo_group_ids", None)
+    bump_group_ids_version()
+
+
+@receiver(pre_delete, sender=Group)
+def group_deleted(sender, instance, **kwargs):
+    # Memberships go with the group without sending m2m_changed.
+    bump_group_ids_version()
+
+
+@receiver(post_save, sender=get_user_model())
+def user_saved(sender, instance, update_fields=None, **kwargs):
+    # Saves that can't have changed the email (such as the last_login update on each login)
+    # keep the cached email lookups (see utils.email_user_ids).
+    if update_fields is not None and "email" not in update_fields:
+        return
+    bump_version(EMAIL_USERS_CACHE_VERSION_KEY)
+
+
+@receiver(post_delete, sender=get_user_model())
+def user_deleted(sender, instance, **kwargs):
+    bump_version(EMAIL_USERS_CACHE_VERSION_KEY)
@@ -0,0 +1,265 @@
+"""
+A small in-process IMAP server for exercising the IMAP producer. It speaks just enough of
+IMAP4rev1 (plus IDLE and UID commands) for `imaplib` and keeps one mailbox in memory.
+"""
+
+import re
+import select
+import socket
+import socketserver
+import threading
+import time
+
+
+class FakeMessage:
+    def __init__(self, uid, data):
+        self.uid = uid
+        self.data = data
+        self.flags = set()
+
+
+def parse_set(spec, last):
+    """Expand an IMAP sequence set such as "1:3,7,9:*" into a predicate on numbers."""
+    ranges = []
+    for part in spec.split(","):
+        start, _, stop = part.partition(":")
+        start = last if start == "*" else int(start)
+        stop = start if not stop else (last if stop == "*" else int(stop))
+        ranges.append((min(start, stop), max(start, stop)))
+    return lambda n: any(low <= n <= high for low, high in ranges)
+
+
+class FakeIMAPServer:
+    def __init__(self, capabilities=("IMAP4rev1", "IDLE")):
+        self.capabilities = capabilities
+        self.messages = []
+        self.uidvalidity = 1
+        self.next_uid = 1
+        self.logins = 0
+        self.commands = []
+        # Untagged lines sent in reply to IDLE before accepting it, as servers may.
+        self.before_idle = []
+        self.lock = threading.RLock()
+        self.handlers = set()
+
+        server = self
+
+        class Handler(IMAPHandler):
+            imap = server
+
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.disconnect_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add_message(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        with self.lock:
+            self.messages.append(FakeMessage(self.next_uid, data))
+            self.next_uid += 1
+
+    def reset_uidvalidity(self):
+        """Renumber every message, as a server does when a mailbox is recreated."""
+        with self.lock:
+            self.uidvalidity += 1
+            for uid, message in enumerate(self.messages, start=1):
+                message.uid = uid
+            self.next_uid = len(self.messages) + 1
+
+    def disconnect_all(self):
+        """Drop every client connection, as a server restart or network failure would."""
+        for handler in list(self.handlers):
+            try:
+                handler.request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def count(self, command):
+        return sum(1 for c in self.commands if c == command)
+
+
+class IMAPHandler(socketserver.StreamRequestHandler):
+    imap = None
+
+    def send(self, line):
+        if isinstance(line, str):
+            line = line.encode()
+        self.wfile.write(line + b"\r\n")
+
+    def handle(self):
+        self.imap.handlers.add(self)
+        # Messages the client has been told about, once it has selected the mailbox.
+        self.reported = None
+        try:
+            self.send("* OK fake IMAP ready")
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    return
+                tag, _, rest = line.decode().rstrip("\r\n").partition(" ")
+                command, _, args = rest.partition(" ")
+                command = command.upper()
+                uid = False
+                if command == "UID":
+                    uid = True
+                    command, _, args = args.partition(" ")
+                    command = command.upper()
+                self.imap.commands.append(("UID " if uid else "") + command)
+
+                handler = getattr(self, "do_" + command, None)
+                if handler is None:
+                    self.send(f"{tag} BAD unknown command")
+                    continue
+                with self.imap.lock:
+                    result = handler(tag, args, uid)
+                    if result is False:
+                        return
+                    # Like real servers, mention new mail in the response to any command.
+                    if self.reported is not None:
+                        self.report_exists()
+                self.send(f"{tag} OK {command} completed")
+        except OSError:
+            pass
+        finally:
+            self.imap.handlers.discard(self)
+
+    def report_exists(self):
+        if len(self.imap.messages) != self.reported:
+            self.reported = len(self.imap.messages)
+            self.send(f"* {self.reported} EXISTS")
+
+    def selected(self, spec, uid):
+        messages = self.imap.messages
+        if uid:
+            last = messages[-1].uid if messages else 0
+            wanted = parse_set(spec, last)
+            return [(n, m) for n, m in enumerate(messages, start=1) if wanted(m.uid)]
+        wanted = parse_set(spec, len(messages))
+        return [(n, m) for n, m in enumerate(messages, start=1) if wanted(n)]
+
+    def do_CAPABILITY(self, tag, args, uid):
+        self.send("* CAPABILITY " + " ".join(self.imap.capabilities))
+
+    def do_LOGIN(self, tag, args, uid):
+        self.imap.logins += 1
+
+    def do_LIST(self, tag, args, uid):
+        self.send('* LIST (\\HasNoChildren) "/" INBOX')
+
+    def do_SELECT(self, tag, args, uid):
+        self.reported = len(self.imap.messages)
+        self.send(f"* {self.reported} EXISTS")
+        self.send(f"* OK [UIDVALIDITY {self.imap.uidvalidity}] UIDs valid")
+        self.send(f"* OK [UIDNEXT {self.imap.next_uid}] Predicted next UID")
+
+    def do_NOOP(self, tag, args, uid):
+        self.report_exists()
+
+    def do_SEARCH(self, tag, args, uid):
+        tokens = args.replace("(", " ").replace(")", " ").upper().split()
+        found = list(enumerate(self.imap.messages, start=1))
+        while tokens:
+            token = tokens.pop(0)
+            if token == "UNSEEN":
+                found = [(n, m) for n, m in found if "\\Seen" not in m.flags]
+            elif token == "UNDELETED":
+                found = [(n, m) for n, m in found if "\\Deleted" not in m.flags]
+            elif token == "UID":
+                keep = {id(m) for n, m in self.selected(tokens.pop(0), True)}
+                found = [(n, m) for n, m in found if id(m) in keep]
+        numbers = [str(m.uid if uid else n) for n, m in found]
+        self.send(" ".join(["* SEARCH", *numbers]))
+
+    def do_FETCH(self, tag, args, uid):
+        spec, _, items = args.partition(" ")
+        items = items.upper()
+        for n, message in self.selected(spec, uid):
+            parts = []
+            if uid or "UID" in items:
+                parts.append(f"UID {message.uid}")
+            if "RFC822.SIZE" in items:
+                parts.append(f"RFC822.SIZE {len(message.data)}")
+            if re.search(r"RFC822(?![.\w])|BODY(\.PEEK)?\[\]", items):
+                if "PEEK" not in items:
+                    message.flags.add("\\Seen")
+                name = "BODY[]" if "BODY" in items else "RFC822"
+                head = f"* {n} FETCH ({' '.join(parts + [name])} {{{len(message.data)}}}"
+                self.wfile.write(head.encode() + b"\r\n" + message.data + b")\r\n")
+            else:
+                self.send(f"* {n} FETCH ({' '.join(parts)})")
+
+    def do_STORE(self, tag, args, uid):
+        spec, _, rest = args.partition(" ")
+        action, _, flags = rest.partition(" ")
+        flags = set(flags.strip("()").split())
+        for n, message in self.selected(spec, uid):
+            if action.upper().startswith("+"):
+                message.flags |= flags
+            else:
+                message.flags -= flags
+            if not action.upper().endswith(".SILENT"):
+                self.send(f"* {n} FETCH (FLAGS ({' '.join(sorted(message.flags))}))")
+
+    def expunge(self, report=True):
+        messages = self.imap.messages
+        for n in range(len(messages), 0, -1):
+            if "\\Deleted" in messages[n - 1].flags:
+                del messages[n - 1]
+                self.reported -= 1
+                if report:
+                    self.send(f"* {n} EXPUNGE")
+
+    def do_EXPUNGE(self, tag, args, uid):
+        self.expunge()
+
+    def do_CLOSE(self, tag, args, uid):
+        self.expunge(report=False)
+        self.reported = None
+
+    def do_LOGOUT(self, tag, args, uid):
+        self.send("* BYE logging out")
+        self.send(f"{tag} OK LOGOUT completed")
+        return False
+
+    def do_IDLE(self, tag, args, uid):
+        for line in self.imap.before_idle:
+            self.send(line)
+        self.send("+ idling")
+        # Release the mailbox while waiting, so messages can be added.
+        self.imap.lock.release()
+        try:
+            while True:
+                with self.imap.lock:
+                    self.report_exists()
+                readable, _, _ = select.select([self.request], [], [], 0.02)
+                if readable:
+                    break
+        finally:
+            self.imap.lock.acquire()
+        line = self.rfile.readline()
+        if line.strip().upper() != b"DONE":
+            return False
+
+    def finish(self):
+        try:
+            super().finish()
+        except OSError:
+            pass
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.01)
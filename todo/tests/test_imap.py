@@ -0,0 +1,300 @@
+import threading
+import time
+
+import pytest
+
+from todo.mail.producers import imap
+from todo.models import MailCheckpoint
+from todo.tests.fake_imap import FakeIMAPServer
+
+"""
+Exercise the IMAP producer against the fake server in fake_imap.py.
+"""
+
+
+def make_message(n):
+    return f"Subject: message {n}\r\nMessage-ID: <{n}@example.com>\r\n\r\nbody {n}\r\n"
+
+
+def producer(server, **kwargs):
+    kwargs.setdefault("nap_duration", 0.01)
+    return imap.imap_producer(
+        host="127.0.0.1", port=server.port, username="u", password="p", ssl=False, **kwargs
+    )
+
+
+def receive(gen):
+    """The next message from gen, skipping the None marking the end of each batch."""
+    message = next(gen)
+    while message is None:
+        message = next(gen)
+    return message
+
+
+def next_message(gen, timeout=5):
+    """receive(gen), failing instead of hanging if nothing arrives in time."""
+    result = []
+    thread = threading.Thread(target=lambda: result.append(receive(gen)), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert result, "no message arrived"
+    return result[0]
+
+
+def test_idle_delivers_new_messages_on_one_connection():
+    with FakeIMAPServer() as server:
+        server.add_message(make_message(1))
+        gen = producer(server)
+        assert next_message(gen)["subject"] == "message 1"
+
+        delivered = []
+        thread = threading.Thread(target=lambda: delivered.append(next_message(gen)))
+        thread.start()
+        time.sleep(0.3)
+        added = time.monotonic()
+        server.add_message(make_message(2))
+        thread.join()
+
+        assert delivered[0]["subject"] == "message 2"
+        assert time.monotonic() - added < 1
+        assert server.logins == 1
+        assert server.count("IDLE") >= 1
+        gen.close()
+
+    # Delivered messages were deleted.
+    assert [m.uid for m in server.messages] == [2]
+
+
+def test_idle_delivers_messages_that_arrived_during_a_batch():
+    with FakeIMAPServer() as server:
+        server.add_message(make_message(1))
+        gen = producer(server, idle_timeout=5)
+        assert next(gen)["subject"] == "message 1"
+        # The server announces this one while the first batch is deleted, not during IDLE.
+        server.add_message(make_message(2))
+
+        started = time.monotonic()
+        assert next_message(gen)["subject"] == "message 2"
+        assert time.monotonic() - started < 1
+        gen.close()
+
+
+def test_idle_allows_untagged_responses_before_continuation():
+    with FakeIMAPServer() as server:
+        server.before_idle = ["* OK still here"]
+        server.add_message(make_message(1))
+        gen = producer(server, idle_timeout=0.2)
+        assert next_message(gen)["subject"] == "message 1"
+
+        delivered = []
+        thread = threading.Thread(target=lambda: delivered.append(next_message(gen)))
+        thread.start()
+        # Long enough to renew the IDLE a few times.
+        time.sleep(0.7)
+        server.add_message(make_message(2))
+        thread.join()
+        assert delivered[0]["subject"] == "message 2"
+        gen.close()
+
+    assert server.count("IDLE") >= 2
+    assert server.logins == 1
+
+
+def test_stops_while_waiting_for_mail():
+    for capabilities in [("IMAP4rev1",), ("IMAP4rev1", "IDLE")]:
+        stop = threading.Event()
+        with FakeIMAPServer(capabilities=capabilities) as server:
+            server.add_message(make_message(1))
+            gen = producer(server, nap_duration=60, idle_timeout=60, stopped=stop.is_set)
+            assert next_message(gen)["subject"] == "message 1"
+
+            rest = []
+            thread = threading.Thread(target=lambda: rest.extend(gen), daemon=True)
+            thread.start()
+            time.sleep(0.3)
+            stopped = time.monotonic()
+            stop.set()
+            thread.join(5)
+
+            # The producer ends, logging out, without waiting for the nap or IDLE to finish.
+            assert not thread.is_alive()
+            assert time.monotonic() - stopped < 2
+            assert rest == [None]
+            assert server.count("LOGOUT") == 1
+
+
+def test_polling_without_idle():
+    with FakeIMAPServer(capabilities=("IMAP4rev1",)) as server:
+        server.add_message(make_message(1))
+        gen = producer(server)
+        assert next_message(gen)["subject"] == "message 1"
+        server.add_message(make_message(2))
+        assert next_message(gen)["subject"] == "message 2"
+        gen.close()
+
+    assert server.count("IDLE") == 0
+    # One connection throughout, checked with NOOP between polls.
+    assert server.logins == 1
+    assert server.count("NOOP") >= 1
+
+
+def test_reconnects_after_losing_the_connection():
+    for capabilities in [("IMAP4rev1",), ("IMAP4rev1", "IDLE")]:
+        with FakeIMAPServer(capabilities=capabilities) as server:
+            server.add_message(make_message(1))
+            gen = producer(server)
+            assert next_message(gen)["subject"] == "message 1"
+            time.sleep(0.1)
+            server.disconnect_all()
+            server.add_message(make_message(2))
+            assert next_message(gen)["subject"] == "message 2"
+            gen.close()
+
+        assert server.logins == 2
+
+
+def test_polling_backs_off_while_empty(monkeypatch):
+    naps = []
+
+    with FakeIMAPServer(capabilities=("IMAP4rev1",)) as server:
+
+        def sleep(duration):
+            naps.append(duration)
+            if len(naps) == 5:
+                server.add_message(make_message(1))
+
+        monkeypatch.setattr(imap.time, "sleep", sleep)
+        gen = producer(server, nap_duration=1, max_nap_duration=8)
+        next_message(gen)
+        server.add_message(make_message(2))
+        next_message(gen)
+        gen.close()
+
+    # Doubling while empty, capped; back to the start once messages arrive.
+    assert naps == [1, 2, 4, 8, 8, 1]
+
+
+def test_fetches_and_deletes_in_batches():
+    with FakeIMAPServer(capabilities=("IMAP4rev1",)) as server:
+        for n in range(25):
+            server.add_message(make_message(n))
+        gen = producer(server, fetch_batch_size=10)
+        subjects = [next_message(gen)["subject"] for n in range(25)]
+        server.add_message(make_message(25))
+        next_message(gen)
+        gen.close()
+
+    assert subjects == [f"message {n}" for n in range(25)]
+    # One FETCH for the sizes, then three for 25 messages; one more round for the 26th.
+    assert server.count("UID FETCH") == 1 + 3 + 2
+    assert server.count("UID STORE") == 3
+    assert server.count("FETCH") == server.count("STORE") == 0
+    # The last message was never finished with, so it stays.
+    assert [m.uid for m in server.messages] == [26]
+
+
+def test_preserved_messages_are_processed_once():
+    with FakeIMAPServer() as server:
+        server.add_message(make_message(1))
+        gen = producer(server, preserve=True, process_all=True)
+        assert next_message(gen)["subject"] == "message 1"
+        server.add_message(make_message(2))
+        assert next_message(gen)["subject"] == "message 2"
+        gen.close()
+
+    assert [m.uid for m in server.messages] == [1, 2]
+
+
+# The messages are already waiting, so these call receive() directly: the producer then
+# saves checkpoints on the test's own database connection.
+
+
+@pytest.mark.django_db
+def test_checkpoint_resumes_after_restart():
+    with FakeIMAPServer() as server:
+        for n in range(1, 4):
+            server.add_message(make_message(n))
+        gen = producer(
+            server, preserve=True, process_all=True, checkpoint="tracker", fetch_batch_size=1
+        )
+        receive(gen)
+        receive(gen)
+        # Stopped while handling message 2, so only message 1 is done.
+        gen.close()
+        checkpoint = MailCheckpoint.objects.get(tracker="tracker")
+        assert (checkpoint.uidvalidity, checkpoint.last_uid) == (1, 1)
+
+        gen = producer(server, preserve=True, process_all=True, checkpoint="tracker")
+        assert receive(gen)["subject"] == "message 2"
+        assert receive(gen)["subject"] == "message 3"
+        gen.close()
+
+
+@pytest.mark.django_db
+def test_checkpoint_ignored_after_uidvalidity_change():
+    MailCheckpoint.objects.create(tracker="tracker", uidvalidity=1, last_uid=5)
+    with FakeIMAPServer() as server:
+        for n in range(1, 3):
+            server.add_message(make_message(n))
+        server.reset_uidvalidity()
+        gen = producer(
+            server, preserve=True, process_all=True, checkpoint="tracker", fetch_batch_size=1
+        )
+        assert receive(gen)["subject"] == "message 1"
+        assert receive(gen)["subject"] == "message 2"
+        gen.close()
+
+    checkpoint = MailCheckpoint.objects.get(tracker="tracker")
+    assert (checkpoint.uidvalidity, checkpoint.last_uid) == (2, 1)
+
+
+def test_batches_are_marked_done_once_committed():
+    with FakeIMAPServer() as server:
+        for n in range(1, 4):
+            server.add_message(make_message(n))
+        gen = producer(server, fetch_batch_size=2)
+        assert [next(gen)["subject"], next(gen)["subject"]] == ["message 1", "message 2"]
+        # The end of the batch, which the consumer commits before asking for more.
+        assert next(gen) is None
+        assert server.count("UID STORE") == 0
+        assert next(gen)["subject"] == "message 3"
+        assert server.count("UID STORE") == 1
+        gen.close()
+
+    # Message 3 was never committed, so it stays.
+    assert [m.uid for m in server.messages] == [3]
+
+
+def test_uid_after_message_literal():
+    """Servers may send the UID after the message, and parts without one are skipped."""
+
+    class Conn:
+        def uid(self, command, *args):
+            if command == "SEARCH":
+                return "OK", [b"1 2 3"]
+            if args[1] == "(RFC822.SIZE)":
+                return "OK", [b"%d (UID %d RFC822.SIZE 10)" % (n, n) for n in (1, 2, 3)]
+            return "OK", [
+                (b"1 (RFC822 {48}", make_message(1).encode()),
+                b" UID 1)",
+                (b"2 (UID 2 RFC822 {48}", make_message(2).encode()),
+                b")",
+                (b"3 (RFC822 {48}", make_message(3).encode()),
+                b")",
+            ]
+
+    messages = next(imap.search_batches(Conn(), "(ALL)"))
+    assert [(uid, message["subject"]) for uid, message in messages] == [
+        (1, "message 1"),
+        (2, "message 2"),
+    ]
+
+
+def test_fetch_batches_respect_byte_cap():
+    sizes = {1: 400, 2: 400, 3: 400, 4: 5000, 5: 10}
+    batches = list(imap.fetch_batches([1, 2, 3, 4, 5], sizes, batch_size=10, max_bytes=1000))
+    assert batches == [[1, 2], [3], [4], [5]]
+
+
+def test_uid_set():
+    assert imap.uid_set([9, 1, 2, 3, 7, 10]) == "1:3,7,9:10"
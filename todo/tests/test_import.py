@@ -1,11 +1,24 @@
+import csv
 import datetime
+import io
+import json
+import os
+import time
+import tracemalloc
 from pathlib import Path
 
 import pytest
 from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.urls import reverse
+from django.utils import timezone
 
-from todo.models import Task, TaskList
-from todo.operations.csv_importer import CSVImporter
+from todo.admin import TaskAdmin, export_to_csv
+from todo.models import ImportJob, Task, TaskList
+from todo.operations.csv_importer import CSV_COLUMNS, CSVImporter
+from todo.operations.import_jobs import claim_import_job, run_import_job
+from todo.operations.task_exporter import csv_lines, export_rows
+from todo.search import get_search_backend
 
 
 """
@@ -73,3 +86,493 @@ def test_inserted_row(import_setup):
     assert task.note == "This is note one"
     assert task.priority == 3
     assert task.created_date == datetime.datetime.today().date()
+
+
+@pytest.mark.django_db
+def test_validation_queries_do_not_grow_with_rows(todo_setup, django_assert_max_num_queries):
+    """Lookups for users, groups and lists are made once for the whole file, not per row."""
+    row = {
+        "Title": "Make dinner",
+        "Group": "Workgroup One",
+        "Task List": "Zip",
+        "Created By": "u1",
+        "Created Date": "",
+        "Due Date": "",
+        "Completed": "No",
+        "Assigned To": "u1",
+        "Note": "",
+        "Priority": "",
+    }
+    rows = [dict(row) for _ in range(50)]
+    rows.append(dict(row, **{"Assigned To": "nobody", "Task List": "Nope"}))
+
+    importer = CSVImporter()
+    with django_assert_max_num_queries(4):
+        importer.prefetch(rows)
+        validated = [importer.validate_row(r) for r in rows]
+
+    assert all(validated[:50])
+    assert validated[-1] is False
+    assert importer.errors[0][0] == [
+        "Missing or invalid task assignee nobody",
+        "Task list Nope in group Workgroup One does not exist",
+    ]
+
+
+@pytest.mark.django_db
+def test_batch_size_does_not_change_results(todo_setup):
+    """Writing one row per batch reports exactly what one big batch does."""
+    filepath = Path(__file__).resolve().parent / "data" / "csv_import_data.csv"
+    with filepath.open(mode="r", encoding="utf-8-sig") as fileobj:
+        results = CSVImporter(batch_size=1).upsert(fileobj, as_string_obj=True)
+    assert "Upserted 2 rows" in results["summaries"]
+    assert (
+        'Upserted task 7: "Make dinner" in list "Zip" (group "Workgroup One")' in results["upserts"]
+    )
+    assert Task.objects.count() == 8
+
+
+@pytest.mark.django_db
+def test_reimport_updates_in_place(import_setup):
+    """Importing the same file again updates the tasks it created rather than adding more."""
+    Task.objects.get(title="Make dinner").assigned_to.clear()
+    filepath = Path(__file__).resolve().parent / "data" / "csv_import_data.csv"
+    with filepath.open(mode="r", encoding="utf-8-sig") as fileobj:
+        results = CSVImporter().upsert(fileobj, as_string_obj=True)
+    assert Task.objects.count() == 8
+    assert (
+        'Upserted task 7: "Make dinner" in list "Zip" (group "Workgroup One")' in results["upserts"]
+    )
+    task = Task.objects.get(title="Make dinner")
+    assert list(task.assigned_to.values_list("username", flat=True)) == ["u1"]
+
+
+@pytest.mark.django_db
+def test_write_queries_do_not_grow_with_rows(todo_setup, django_assert_max_num_queries):
+    """A batch is written with a fixed number of queries, whatever its size."""
+    header = "Title,Group,Task List,Created By,Created Date,Due Date,Completed,Assigned To,Note,Priority\n"
+    lines = [f"Task {i},Workgroup One,Zip,u1,,,Yes,u1,,{i}\n" for i in range(100)]
+    importer = CSVImporter()
+    with django_assert_max_num_queries(15):
+        results = importer.upsert(io.StringIO(header + "".join(lines)), as_string_obj=True)
+    assert "Upserted 100 rows" in results["summaries"]
+    task = Task.objects.get(title="Task 42")
+    assert task.completed_date is not None
+    assert task.assigned_to.get().username == "u1"
+
+
+@pytest.mark.django_db
+def test_imported_tasks_are_searchable(import_setup):
+    found = get_search_backend().search(Task.objects.all(), "dinner")
+    assert [task.title for task in found] == ["Make dinner"]
+
+
+def write_csv(path, rows, title="Imported"):
+    header = "Title,Group,Task List,Created By,Created Date,Due Date,Completed,Assigned To,Note,Priority\n"
+    with path.open("w", encoding="utf-8") as f:
+        f.write(header)
+        for i in range(rows):
+            f.write(f"{title} {i},Workgroup One,Zip,u1,2019-06-0{i % 9 + 1},,No,u1,Note {i},{i}\n")
+    return path
+
+
+@pytest.mark.django_db
+def test_streaming_import_logs_rows(todo_setup):
+    filepath = Path(__file__).resolve().parent / "data" / "csv_import_data.csv"
+    log = io.StringIO()
+    with filepath.open(mode="r", encoding="utf-8-sig") as fileobj:
+        results = CSVImporter(stream=True, log=log).upsert(fileobj, as_string_obj=True)
+
+    assert results["summaries"] == ["Processed 3 CSV rows", "Upserted 2 rows", "Skipped 1 rows"]
+    assert results["upserts"] == []
+    assert results["errors"] == []
+    # Rows are validated before their batch is written, so skips are logged first.
+    assert sorted(log.getvalue().splitlines()) == [
+        "1\tupserted\t7",
+        "2\tupserted\t8",
+        "3\tskipped\tCould not convert Created Date 2015-06-248 to valid date instance",
+    ]
+
+
+@pytest.mark.django_db
+def test_import_csv_command_streams(todo_setup, tmp_path, capsys):
+    source = write_csv(tmp_path / "tasks.csv", 5)
+    logpath = tmp_path / "log.tsv"
+    call_command("import_csv", file=str(source), stream=True, log=str(logpath), batch_size=2)
+
+    assert "Upserted 5 rows" in capsys.readouterr().out
+    assert len(logpath.read_text().splitlines()) == 5
+    assert Task.objects.filter(title__startswith="Imported ").count() == 5
+
+
+@pytest.mark.django_db
+def test_streaming_import_command_reports_bad_encoding(todo_setup, tmp_path, capsys):
+    """A bad byte past the first read buffer is reported after the earlier batches commit."""
+    source = write_csv(tmp_path / "bad.csv", 2000)
+    with source.open("ab") as f:
+        f.write(b"Bad \xff,Workgroup One,Zip,u1,,,No,,,\n")
+
+    call_command("import_csv", file=str(source), stream=True, batch_size=500)
+
+    # The batch being read when decoding failed isn't written.
+    out = capsys.readouterr().out
+    assert "Could not decode file as UTF-8 after row 1500." in out
+    assert Task.objects.filter(title__startswith="Imported ").count() == 1500
+
+
+@pytest.mark.django_db
+def test_streaming_import_memory_is_flat(todo_setup, tmp_path):
+    """Peak memory while streaming a file doesn't grow with the number of rows."""
+
+    def peak_memory(rows):
+        # Distinct titles, so that both runs only insert.
+        source = write_csv(tmp_path / f"tasks_{rows}.csv", rows, title=f"Run {rows}")
+        with source.open(encoding="utf-8") as fileobj:
+            tracemalloc.start()
+            try:
+                CSVImporter(batch_size=200, stream=True).upsert(fileobj, as_string_obj=True)
+                return tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+    # The first import pays one-off costs (imports, query compilation), and the peak settles
+    # after a few thousand rows, so compare two runs past that point.
+    peak_memory(200)
+    small = peak_memory(4000)
+    large = peak_memory(16000)
+    assert large < small * 1.25
+
+
+@pytest.fixture
+def background_import(todo_setup, settings, tmp_path):
+    settings.TODO_CSV_IMPORT_IN_BACKGROUND = True
+    settings.MEDIA_ROOT = str(tmp_path)
+
+
+def upload_job(client):
+    filepath = Path(__file__).resolve().parent / "data" / "csv_import_data.csv"
+    with filepath.open("rb") as fileobj:
+        response = client.post(reverse("todo:import_csv"), {"csvfile": fileobj})
+    assert response.status_code == 302
+    return ImportJob.objects.get()
+
+
+@pytest.mark.django_db
+def test_background_import(background_import, client):
+    client.login(username="u1", password="password")
+    job = upload_job(client)
+    # Nothing is imported until the worker runs.
+    assert job.status == ImportJob.PENDING
+    assert Task.objects.count() == 6
+    response = client.get(reverse("todo:import_csv"), {"job": job.id})
+    assert response.context["job"] == job
+
+    call_command("import_worker", once=True)
+
+    assert Task.objects.count() == 8
+    response = client.get(reverse("todo:import_job_status", kwargs={"job_id": job.id}))
+    status = response.json()
+    assert status["status"] == "done"
+    assert (status["total_rows"], status["rows_processed"], status["rows_upserted"]) == (3, 3, 2)
+    assert status["errors"] == [
+        {"3": ["Could not convert Created Date 2015-06-248 to valid date instance"]}
+    ]
+
+
+@pytest.mark.django_db
+def test_import_job_status_is_private(background_import, client):
+    client.login(username="u1", password="password")
+    job = upload_job(client)
+    client.login(username="u2", password="password")
+    response = client.get(reverse("todo:import_job_status", kwargs={"job_id": job.id}))
+    assert response.status_code == 403
+
+
+@pytest.mark.django_db
+def test_crashed_import_job_resumes(background_import, client):
+    client.login(username="u1", password="password")
+    job = upload_job(client)
+    # A worker committed the first row, then died.
+    job.status = ImportJob.RUNNING
+    job.rows_processed = job.rows_upserted = 1
+    job.started_date = job.updated_date = timezone.now() - datetime.timedelta(hours=1)
+    job.save()
+
+    call_command("import_worker", once=True, batch_size=1)
+
+    job.refresh_from_db()
+    assert job.status == ImportJob.DONE
+    assert (job.rows_processed, job.rows_upserted, job.error_count) == (3, 2, 1)
+    # The first row isn't imported again.
+    assert not Task.objects.filter(title="Make dinner").exists()
+    assert Task.objects.filter(title="Bake bread").exists()
+
+
+@pytest.mark.django_db
+def test_finished_import_job_deletes_file(background_import, client):
+    client.login(username="u1", password="password")
+    job = upload_job(client)
+    path = job.file.path
+    assert os.path.exists(path)
+
+    call_command("import_worker", once=True)
+
+    job.refresh_from_db()
+    assert job.status == ImportJob.DONE
+    assert not os.path.exists(path)
+    assert job.file.name
+
+
+@pytest.mark.django_db
+def test_taken_over_import_job_stops(background_import, client):
+    client.login(username="u1", password="password")
+    upload_job(client)
+    job = claim_import_job()
+    # The worker stalls long enough for another to take the job over.
+    ImportJob.objects.filter(pk=job.pk).update(
+        updated_date=timezone.now() - datetime.timedelta(hours=1)
+    )
+    new_job = claim_import_job()
+
+    run_import_job(job, batch_size=1)
+    # The first worker committed nothing, left the job running and kept the file.
+    assert Task.objects.count() == 6
+    job.refresh_from_db()
+    assert (job.status, job.rows_processed) == (ImportJob.RUNNING, 0)
+    assert os.path.exists(job.file.path)
+
+    run_import_job(new_job, batch_size=1)
+    assert new_job.status == ImportJob.DONE
+    assert Task.objects.count() == 8
+
+
+@pytest.mark.django_db
+def test_taken_over_import_job_failing_leaves_job_alone(background_import, client, monkeypatch):
+    client.login(username="u1", password="password")
+    upload_job(client)
+    job = claim_import_job()
+    ImportJob.objects.filter(pk=job.pk).update(
+        updated_date=timezone.now() - datetime.timedelta(hours=1)
+    )
+    claim_import_job()
+
+    def crash(self, fileobj):
+        raise RuntimeError("worker crashed")
+
+    monkeypatch.setattr(CSVImporter, "upsert", crash)
+    run_import_job(job)
+
+    # The new owner's job is still running, with its file.
+    job.refresh_from_db()
+    assert job.status == ImportJob.RUNNING
+    assert os.path.exists(job.file.path)
+
+
+def test_import_job_eta_counts_rows_since_resuming():
+    now = timezone.now()
+    job = ImportJob(
+        status=ImportJob.RUNNING,
+        started_date=now - datetime.timedelta(seconds=10),
+        updated_date=now,
+        total_rows=1000,
+        resumed_from=800,
+        rows_processed=900,
+    )
+    # 100 rows in 10 seconds, 100 to go.
+    assert job.eta() == 10
+    job.rows_processed = job.resumed_from
+    assert job.eta() is None
+
+
+@pytest.mark.django_db
+def test_running_import_job_is_left_alone(background_import, client):
+    client.login(username="u1", password="password")
+    job = upload_job(client)
+    job.status = ImportJob.RUNNING
+    job.updated_date = timezone.now()
+    job.save()
+
+    call_command("import_worker", once=True)
+    assert Task.objects.count() == 6
+
+
+@pytest.mark.django_db
+def test_parallel_validation_matches_serial(todo_setup, tmp_path):
+    """Validating in worker processes gives the same errors, in the same order, and the same writes."""
+    source = tmp_path / "mixed.csv"
+    write_csv(source, 30)
+    with source.open("a", encoding="utf-8") as f:
+        f.write("Bad date,Workgroup One,Zip,u1,2019-13-01,,No,,,\n")
+        f.write("Wrong group,Workgroup Two,Zap,u1,,,No,,,\n")
+
+    with source.open(encoding="utf-8") as fileobj:
+        results = CSVImporter(batch_size=4, workers=2).upsert(fileobj, as_string_obj=True)
+
+    assert results["summaries"] == ["Processed 32 CSV rows", "Upserted 30 rows", "Skipped 2 rows"]
+    assert [list(error) for error in results["errors"]] == [[31], [32]]
+    assert results["errors"][1][32] == ["u1 is not in group Workgroup Two"]
+    assert results["upserts"][0].startswith('Upserted task 7: "Imported 0"')
+    assert Task.objects.filter(title__startswith="Imported ").count() == 30
+
+
+@pytest.mark.django_db
+def test_parallel_validation_sends_only_needed_lookups(todo_setup):
+    """Each worker gets the lookups its own rows need, not everything prefetched so far."""
+    row = dict.fromkeys(CSV_COLUMNS, "")
+    rows = [
+        dict(row, **{"Created By": "u1", "Group": "Workgroup One", "Task List": "Zip"}),
+        dict(row, **{"Created By": "u2", "Group": "Workgroup Two", "Task List": "Zap"}),
+    ]
+    importer = CSVImporter()
+    importer.prefetch(rows)
+
+    users, groups, task_lists, memberships = importer.lookups_for(rows[1:])
+    u2, group = users["u2"], groups["Workgroup Two"]
+    assert (list(users), list(groups)) == (["u2"], ["Workgroup Two"])
+    assert list(task_lists) == [(group.id, "Zap")]
+    assert memberships == {(u2.id, group.id)}
+
+
+@pytest.mark.skipif(not os.environ.get("TODO_BENCHMARK"), reason="Set TODO_BENCHMARK=1 to run.")
+@pytest.mark.django_db
+def test_benchmark_parallel_validation(todo_setup, tmp_path):
+    """Time validating a 500k-row file with one worker and with several. Validation only;
+    the writes are the same either way."""
+    source = write_csv(tmp_path / "big.csv", 500_000)
+    workers = min(os.cpu_count() or 1, 8)
+
+    for count in sorted({1, workers}):
+        with source.open(encoding="utf-8") as fileobj:
+            importer = CSVImporter(batch_size=5000, stream=True, workers=count)
+            rows = csv.DictReader(fileobj)
+            validate = importer.validate_batches_in_parallel if count > 1 else importer.validate_batches
+            started = time.perf_counter()
+            for _ in validate(rows):
+                pass
+            print(f"\n{count} worker(s): {time.perf_counter() - started:.1f}s")
+
+
+def dry_run(**kwargs):
+    filepath = Path(__file__).resolve().parent / "data" / "csv_import_data.csv"
+    with filepath.open(mode="r", encoding="utf-8-sig") as fileobj:
+        return CSVImporter(dry_run=True, **kwargs).upsert(fileobj, as_string_obj=True)
+
+
+@pytest.mark.django_db
+def test_dry_run_writes_nothing(todo_setup):
+    results = dry_run()
+    assert Task.objects.count() == 6
+    assert results["summaries"] == [
+        "Processed 3 CSV rows",
+        "Would create 2 tasks",
+        "Would update 0 tasks",
+        "Would leave 0 tasks unchanged",
+        "Would skip 1 rows",
+    ]
+    assert results["changes"][0] == 'CSV row 1. Would create "Make dinner" in list "Zip"'
+
+
+@pytest.mark.django_db
+def test_dry_run_after_import(import_setup):
+    task = Task.objects.get(title="Make dinner")
+    task.priority = 1
+    task.save()
+    task.assigned_to.clear()
+
+    results = dry_run()
+    assert "Would update 1 tasks" in results["summaries"]
+    assert "Would leave 1 tasks unchanged" in results["summaries"]
+    assert results["changes"] == [
+        'CSV row 1. Would update "Make dinner" in list "Zip": priority, assigned_to'
+    ]
+
+
+@pytest.mark.django_db
+def test_dry_run_queries_do_not_grow_with_rows(todo_setup, tmp_path, django_assert_max_num_queries):
+    source = write_csv(tmp_path / "tasks.csv", 300)
+    with source.open(encoding="utf-8") as fileobj, django_assert_max_num_queries(8):
+        results = CSVImporter(dry_run=True).upsert(fileobj, as_string_obj=True)
+    assert "Would create 300 tasks" in results["summaries"]
+
+
+@pytest.mark.django_db
+def test_dry_run_from_web(todo_setup, client):
+    client.login(username="u1", password="password")
+    filepath = Path(__file__).resolve().parent / "data" / "csv_import_data.csv"
+    with filepath.open("rb") as fileobj:
+        response = client.post(reverse("todo:import_csv"), {"csvfile": fileobj, "dry_run": "on"})
+    assert response.context["dry_run"]
+    assert "Would create 2 tasks" in response.context["results"]["summaries"]
+    assert Task.objects.count() == 6
+
+
+@pytest.mark.django_db
+def test_export_round_trips(todo_setup, tmp_path):
+    """An export imports straight back in, updating every task in place."""
+    task = Task.objects.get(title="Task 1", created_by__username="u1")
+    task.assigned_to.add(task.created_by)
+    task.due_date = datetime.date(2020, 1, 31)
+    task.save()
+
+    exported = tmp_path / "tasks.csv"
+    call_command("export_tasks", file=str(exported))
+    results = CSVImporter(dry_run=True).upsert(exported.open(encoding="utf-8"), as_string_obj=True)
+    assert "Would leave 6 tasks unchanged" in results["summaries"]
+
+    results = CSVImporter().upsert(exported.open(encoding="utf-8"), as_string_obj=True)
+    assert "Upserted 6 rows" in results["summaries"]
+    assert Task.objects.count() == 6
+    task.refresh_from_db()
+    assert task.due_date == datetime.date(2020, 1, 31)
+    assert list(task.assigned_to.values_list("username", flat=True)) == ["u1"]
+
+
+@pytest.mark.django_db
+def test_export_jsonl(todo_setup, capsys):
+    call_command("export_tasks", format="jsonl", group="Workgroup Two")
+    rows = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert len(rows) == 3
+    assert rows[0] == {
+        "Title": "Task 1",
+        "Group": "Workgroup Two",
+        "Task List": "Zap",
+        "Created By": "u2",
+        "Created Date": datetime.date.today().strftime("%Y-%m-%d"),
+        "Due Date": "",
+        "Completed": "No",
+        "Assigned To": "",
+        "Note": "",
+        "Priority": 1,
+    }
+
+
+@pytest.mark.django_db
+def test_export_admin_action_streams(todo_setup, rf):
+    response = export_to_csv(TaskAdmin, rf.post("/"), Task.objects.all())
+    assert response.streaming
+    lines = b"".join(response.streaming_content).decode().splitlines()
+    assert lines[0] == ",".join(CSV_COLUMNS)
+    assert len(lines) == 7
+
+
+@pytest.mark.django_db
+def test_export_memory_is_flat(todo_setup):
+    """Peak memory while exporting doesn't grow with the number of tasks."""
+    u1 = get_user_model().objects.get(username="u1")
+    task_list = TaskList.objects.get(slug="zip")
+
+    def peak_memory(count):
+        Task.objects.bulk_create(
+            [Task(title=f"Export {i}", created_by=u1, task_list=task_list) for i in range(count)]
+        )
+        tracemalloc.start()
+        try:
+            for line in csv_lines(export_rows(Task.objects.all(), chunk_size=500)):
+                pass
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    small = peak_memory(2000)
+    large = peak_memory(14000)
+    assert large < small * 1.5
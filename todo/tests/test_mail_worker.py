@@ -0,0 +1,266 @@
+import functools
+import threading
+import time
+
+from datetime import timedelta
+
+import pytest
+
+from django.core.management import call_command
+from django.utils import timezone
+
+from todo.management.commands import mail_worker
+from todo.mail.consumers import tracker_consumer
+from todo.mail.worker import (
+    Leases,
+    TrackerStopped,
+    acquire_lease,
+    release_lease,
+    run_tracker,
+    supervise,
+)
+from todo.models import MailTrackerLease, Task
+from todo.tests.test_tracker import reply
+from todo.tests.fake_imap import wait_for
+
+
+def fake_tracker(runs, fail=0, barrier=None):
+    """A tracker recording the name it was started under; its first `fail` runs raise, and
+    its first run waits at `barrier`."""
+
+    def producer(tracker_name=None):
+        yield tracker_name
+
+    def consumer(messages):
+        for name in messages:
+            if barrier is not None and not runs:
+                barrier.wait(timeout=5)
+            runs.append(name)
+            if len(runs) <= fail:
+                raise RuntimeError("tracker failed")
+
+    return {"producer": producer, "consumer": consumer}
+
+
+def run_supervisor(trackers, until):
+    stop = threading.Event()
+    thread = threading.Thread(
+        target=supervise, args=(trackers,), kwargs={"stop": stop, "backoff": 0.01}
+    )
+    thread.start()
+    try:
+        wait_for(until)
+    finally:
+        stop.set()
+        thread.join(5)
+    assert not thread.is_alive()
+
+
+def test_supervisor_runs_trackers_concurrently():
+    # Each consumer waits for the other one, which only works if they run side by side.
+    barrier = threading.Barrier(2)
+    runs_a, runs_b = [], []
+    trackers = {
+        "a": fake_tracker(runs_a, barrier=barrier),
+        "b": fake_tracker(runs_b, barrier=barrier),
+    }
+    run_supervisor(trackers, lambda: runs_a and runs_b)
+    assert runs_a[0] == "a" and runs_b[0] == "b"
+
+
+def test_supervisor_restarts_failing_trackers():
+    runs_a, runs_b = [], []
+    trackers = {"a": fake_tracker(runs_a, fail=3), "b": fake_tracker(runs_b)}
+    run_supervisor(trackers, lambda: len(runs_a) > 3 and len(runs_b) > 3)
+
+
+def test_mail_worker_all(monkeypatch, settings):
+    settings.TODO_MAIL_TRACKERS = {"a": fake_tracker([]), "b": fake_tracker([])}
+    supervised = []
+    monkeypatch.setattr(
+        mail_worker, "supervise", lambda trackers, **kwargs: supervised.append(trackers)
+    )
+    call_command("mail_worker", "--all", "--imap_timeout", "0")
+    assert list(supervised[0]) == ["a", "b"]
+
+    with pytest.raises(SystemExit):
+        call_command("mail_worker", "a", "--all")
+    with pytest.raises(SystemExit):
+        call_command("mail_worker")
+
+
+def endless_tracker(runs):
+    """A tracker that keeps receiving messages, recording each one."""
+
+    def producer(tracker_name=None):
+        while True:
+            time.sleep(0.01)
+            yield tracker_name
+
+    def consumer(messages):
+        for name in messages:
+            runs.append(name)
+
+    return {"producer": producer, "consumer": consumer}
+
+
+def start_worker(runs, owner, duration=0.3):
+    stop = threading.Event()
+    leases = Leases(owner=owner, duration=duration)
+    thread = threading.Thread(
+        target=supervise,
+        args=({"t": endless_tracker(runs)},),
+        kwargs={"stop": stop, "backoff": 0.01, "leases": leases},
+    )
+    thread.start()
+    return stop, thread
+
+
+@pytest.mark.django_db
+def test_leases_are_exclusive():
+    assert acquire_lease("t", "a", 10)
+    assert not acquire_lease("t", "b", 10)
+    # Renewing
+    assert acquire_lease("t", "a", 10)
+
+    MailTrackerLease.objects.update(expires=timezone.now() - timedelta(seconds=1))
+    assert acquire_lease("t", "b", 10)
+    assert not acquire_lease("t", "a", 10)
+
+    release_lease("t", "a")
+    assert MailTrackerLease.objects.get().owner == "b"
+    release_lease("t", "b")
+    assert acquire_lease("t", "a", 10)
+
+
+@pytest.mark.django_db
+def test_leases_limit_trackers_per_worker():
+    leases = Leases(owner="a", duration=0.3, max_trackers=1)
+    stop = threading.Event()
+    assert leases.wait_for("t1", stop)
+    threading.Timer(0.2, stop.set).start()
+    assert not leases.wait_for("t2", stop)
+    assert [lease.tracker for lease in MailTrackerLease.objects.all()] == ["t1"]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_standby_worker_takes_over():
+    runs_a, runs_b = [], []
+    stop_a, thread_a = start_worker(runs_a, "a")
+    stop_b, thread_b = start_worker(runs_b, "b")
+    try:
+        wait_for(lambda: runs_a or runs_b)
+        # Only one of the workers runs the tracker.
+        time.sleep(0.5)
+        assert not (runs_a and runs_b)
+        if runs_b:
+            runs_a, runs_b = runs_b, runs_a
+            stop_a, stop_b = stop_b, stop_a
+            thread_a, thread_b = thread_b, thread_a
+
+        # The standby takes over once the owner stops.
+        stop_a.set()
+        thread_a.join(5)
+        wait_for(lambda: runs_b)
+    finally:
+        stop_a.set()
+        stop_b.set()
+        thread_a.join(5)
+        thread_b.join(5)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_expired_lease_is_taken_over():
+    # A worker that died without releasing its lease.
+    MailTrackerLease.objects.create(
+        tracker="t", owner="dead", expires=timezone.now() + timedelta(seconds=0.5)
+    )
+    runs = []
+    stop, thread = start_worker(runs, "b")
+    try:
+        time.sleep(0.3)
+        assert not runs
+        wait_for(lambda: runs, timeout=2)
+        assert MailTrackerLease.objects.get().owner == "b"
+
+        # Losing the lease to another worker stops the tracker.
+        MailTrackerLease.objects.update(
+            owner="other", expires=timezone.now() + timedelta(seconds=60)
+        )
+        time.sleep(0.3)
+        received = len(runs)
+        time.sleep(0.3)
+        assert len(runs) == received
+    finally:
+        stop.set()
+        thread.join(5)
+
+
+def test_run_tracker_with_older_producers():
+    """Producers not taking a tracker name are still supported"""
+    received = []
+
+    def producer(messages=("hello",)):
+        yield from messages
+
+    for configured in [producer, functools.partial(producer, ["hi"])]:
+        run_tracker("t", {"producer": configured, "consumer": received.extend})
+    assert received == ["hello", "hi"]
+
+
+def test_producers_waiting_for_messages_are_stopped():
+    lost = threading.Event()
+
+    def producer(stopped):
+        # Waiting for mail when the lease is lost.
+        threading.Timer(0.1, lost.set).start()
+        wait_for(stopped)
+        yield from ()
+
+    with pytest.raises(TrackerStopped):
+        run_tracker("t", {"producer": producer, "consumer": list}, lost)
+
+
+def tracker_config(producer):
+    return {
+        "producer": producer,
+        "consumer": tracker_consumer(group="Workgroup One", task_list_slug="zip"),
+    }
+
+
+def test_stopped_tracker_drops_uncommitted_batch(todo_setup):
+    stopped = threading.Event()
+
+    def producer():
+        yield reply(1, references="")
+        # Lost the lease before the batch was committed.
+        stopped.set()
+        yield reply(2, references="")
+        yield None
+
+    with pytest.raises(TrackerStopped):
+        run_tracker("t", tracker_config(producer), stopped)
+    assert not Task.objects.filter(title__startswith="[MAIL] reply").exists()
+
+
+def test_lease_checked_before_commit(todo_setup):
+    MailTrackerLease.objects.create(
+        tracker="t", owner="other", expires=timezone.now() + timedelta(seconds=60)
+    )
+    lost = threading.Event()
+    check = Leases(owner="me").checker("t", lost)
+
+    def producer():
+        yield reply(1, references="")
+        yield None
+
+    with pytest.raises(TrackerStopped):
+        run_tracker("t", tracker_config(producer), lost, before_commit=check)
+    assert lost.is_set()
+    assert not Task.objects.filter(title__startswith="[MAIL] reply").exists()
+
+    # While the lease is held, batches are committed.
+    MailTrackerLease.objects.update(owner="me")
+    lost.clear()
+    run_tracker("t", tracker_config(producer), lost, before_commit=check)
+    assert Task.objects.filter(title="[MAIL] reply 1").exists()
@@ -0,0 +1,119 @@
+import pytest
+
+from django.core.management import call_command
+from django.db import connection
+from django.urls import reverse
+
+from todo.models import Comment, Task, TaskList
+from todo.search import get_search_backend
+from todo.search.backends import SQLiteSearchBackend
+
+"""
+The test database is SQLite, so these exercise the FTS5 backend end to end.
+"""
+
+
+@pytest.fixture
+def search_setup(todo_setup, django_user_model):
+    u1 = django_user_model.objects.get(username="u1")
+    u2 = django_user_model.objects.get(username="u2")
+    zip_list = TaskList.objects.get(slug="zip")
+    zap_list = TaskList.objects.get(slug="zap")
+    Task.objects.create(created_by=u1, task_list=zip_list, title="Feed the aardvark")
+    Task.objects.create(
+        created_by=u1, task_list=zip_list, title="Clean up", note="The aardvark made a mess"
+    )
+    Task.objects.create(created_by=u2, task_list=zap_list, title="Walk the aardvark")
+
+
+def search_titles(client, **params):
+    response = client.get(reverse("todo:search"), params)
+    assert response.status_code == 200
+    return [task.title for task in response.context["found_tasks"]]
+
+
+@pytest.mark.django_db
+def test_default_backend_for_sqlite():
+    assert isinstance(get_search_backend(), SQLiteSearchBackend)
+
+
+def test_search_ranks_title_above_note(search_setup, client):
+    client.login(username="u1", password="password")
+    assert search_titles(client, q="aardvark") == ["Feed the aardvark", "Clean up"]
+
+
+def test_search_only_shows_my_groups(search_setup, client, admin_client):
+    client.login(username="u2", password="password")
+    assert search_titles(client, q="aardvark") == ["Walk the aardvark"]
+    # Superusers see everything
+    assert len(search_titles(admin_client, q="aardvark")) == 3
+
+
+def test_search_tracks_edits_and_deletes(search_setup, client):
+    client.login(username="u1", password="password")
+    task = Task.objects.get(title="Feed the aardvark")
+    task.title = "Feed the anteater"
+    task.save()
+    assert search_titles(client, q="anteater") == ["Feed the anteater"]
+    assert search_titles(client, q="aardvark") == ["Clean up"]
+
+    task.delete()
+    assert search_titles(client, q="anteater") == []
+
+
+def test_search_query_syntax_is_not_interpreted(search_setup, client):
+    client.login(username="u1", password="password")
+    assert search_titles(client, q='aardvark"*:(') == ["Feed the aardvark", "Clean up"]
+    assert search_titles(client, q="***") == []
+
+
+def test_search_paginates(search_setup, client, django_user_model, settings):
+    settings.TODO_SEARCH_RESULTS_PER_PAGE = 1
+    client.login(username="u1", password="password")
+    assert search_titles(client, q="aardvark") == ["Feed the aardvark"]
+    assert search_titles(client, q="aardvark", page=2) == ["Clean up"]
+
+
+def test_rebuild_search_index(search_setup, client):
+    with connection.cursor() as cursor:
+        cursor.execute("DELETE FROM todo_task_fts")
+    client.login(username="u1", password="password")
+    assert search_titles(client, q="aardvark") == []
+
+    call_command("rebuild_search_index")
+    assert search_titles(client, q="aardvark") == ["Feed the aardvark", "Clean up"]
+
+
+def test_search_finds_comments_with_snippets(search_setup, client, django_user_model):
+    u1 = django_user_model.objects.get(username="u1")
+    task = Task.objects.get(title="Clean up")
+    Comment.objects.create(author=u1, task=task, body="Ordered a new <b>platypus</b> pen")
+    Comment.objects.create(author=u1, task=task, body="The platypus escaped again")
+    client.login(username="u1", password="password")
+
+    response = client.get(reverse("todo:search"), {"q": "platypus"})
+    results = list(response.context["found_tasks"])
+    # Several matching comments still make a single result for their task.
+    assert [t.title for t in results] == ["Clean up"]
+    snippets = results[0].search_snippets
+    assert len(snippets) == 2
+    assert "Ordered a new &lt;b&gt;<mark>platypus</mark>&lt;/b&gt; pen" in snippets
+
+
+def test_search_comments_follow_merges(search_setup, client, django_user_model):
+    u1 = django_user_model.objects.get(username="u1")
+    source = Task.objects.get(title="Clean up")
+    target = Task.objects.get(title="Feed the aardvark")
+    Comment.objects.create(author=u1, task=source, body="Wombat sighting")
+    source.merge_into(target)
+    client.login(username="u1", password="password")
+    assert search_titles(client, q="wombat") == ["Feed the aardvark"]
+
+
+def test_search_comments_respect_groups(search_setup, client, django_user_model):
+    u1 = django_user_model.objects.get(username="u1")
+    Comment.objects.create(
+        author=u1, task=Task.objects.get(title="Clean up"), body="Wombat sighting"
+    )
+    client.login(username="u2", password="password")
+    assert search_titles(client, q="wombat") == []
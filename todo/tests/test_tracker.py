@@ -1,15 +1,25 @@
+import os
+import time
+
 import pytest
 
 from django.core import mail
+from django.db import OperationalError, connection
+from django.test.utils import CaptureQueriesContext
 
-from todo.models import Task, Comment
+from todo.models import Task, Comment, TaskList
 from todo.mail.consumers import tracker_consumer
+from todo.mail.consumers.tracker import SeenMessageIds
 from email.message import EmailMessage
 
 
-def consumer(*args, title_format="[TEST] {subject}", **kwargs):
+def consumer(*args, title_format="[TEST] {subject}", batch_size=100, **kwargs):
     return tracker_consumer(
-        group="Workgroup One", task_list_slug="zip", priority=1, task_title_format=title_format
+        group="Workgroup One",
+        task_list_slug="zip",
+        priority=1,
+        task_title_format=title_format,
+        batch_size=batch_size,
     )(*args, **kwargs)
 
 
@@ -83,7 +93,7 @@ def test_tracker_email_match(todo_setup, django_user_model, settings):
     # Check no match
     msg = make_message("test2 subject", "test2 content")
     msg["From"] = "no-match-email@example.com"
-    msg["Message-ID"] = "<a@example.com>"
+    msg["Message-ID"] = "<b@example.com>"
 
     # test task creation
     task_count = Task.objects.count()
@@ -94,6 +104,22 @@ def test_tracker_email_match(todo_setup, django_user_model, settings):
     assert task.created_by == None
 
 
+def test_tracker_email_match_shared_email(todo_setup, django_user_model, settings):
+    """Several users sharing an email don't stop messages from being matched"""
+    settings.TODO_MAIL_USER_MAPPER = True
+    u1 = django_user_model.objects.get(username="u1")
+    django_user_model.objects.create_user(username="u1-again", email=u1.email)
+
+    msg = make_message("test1 subject", "test1 content")
+    msg["From"] = f"U1 <{u1.email.upper()}>"
+    msg["Message-ID"] = "<a@example.com>"
+    consumer([msg])
+
+    task = Task.objects.get(title="[TEST] test1 subject")
+    assert task.created_by == u1
+    assert task.comment_set.get().author == u1
+
+
 def test_tracker_match_users_false(todo_setup, django_user_model, settings):
     """
     Do not match users on incoming mail if TODO_MAIL_USER_MAPPER is False
@@ -114,3 +140,214 @@ def test_tracker_match_users_false(todo_setup, django_user_model, settings):
     task = Task.objects.filter(title="[TEST] test1 subject").first()
     assert task is not None, "task was created with the wrong name"
     assert task.created_by == None
+
+
+def reply(n, references="<a@example.com>", sender="test1@example.com"):
+    msg = make_message(f"reply {n}", f"reply {n} content")
+    msg["From"] = sender
+    msg["Message-ID"] = f"<reply-{n}@example.com>"
+    msg["References"] = references
+    return msg
+
+
+def test_tracker_batch_threads_messages_together(todo_setup):
+    first = make_message("first subject", "first content")
+    first["From"] = "test1@example.com"
+    first["Message-ID"] = "<a@example.com>"
+
+    task_count = Task.objects.count()
+    # The replies find the task created for the first message of the same batch.
+    consumer([first, reply(1), reply(2, references="<a@example.com> <reply-1@example.com>")])
+
+    assert Task.objects.count() == task_count + 1
+    task = Task.objects.get(title="[TEST] first subject")
+    assert task.comment_set.count() == 3
+
+    # Redelivered emails aren't added twice.
+    consumer([reply(1)])
+    assert task.comment_set.count() == 3
+
+
+def test_tracker_batch_keeps_messages_around_a_failure(todo_setup, monkeypatch):
+    from todo.mail.consumers import tracker
+
+    message_text = tracker.message_text
+
+    def failing_message_text(message):
+        if message["subject"] == "reply 2":
+            raise ValueError("broken message")
+        return message_text(message)
+
+    monkeypatch.setattr(tracker, "message_text", failing_message_text)
+    consumer([reply(n, references="") for n in range(1, 4)])
+    titles = Task.objects.filter(title__startswith="[TEST] reply").values_list("title", flat=True)
+    assert set(titles) == {"[TEST] reply 1", "[TEST] reply 3"}
+
+
+def test_tracker_batch_failure_leaves_messages_uncommitted(todo_setup, monkeypatch):
+    from todo.mail.consumers import tracker
+
+    def unreachable(*args, **kwargs):
+        raise OperationalError("database is gone")
+
+    monkeypatch.setattr(tracker, "find_message_tasks", unreachable)
+    asked_for_more = []
+
+    def producer():
+        yield reply(1, references="")
+        yield None
+        # The producer marks the batch done only when asked for more.
+        asked_for_more.append(True)
+
+    with pytest.raises(OperationalError):
+        consumer(producer())
+    assert not asked_for_more
+
+
+def test_tracker_batch_lookups(todo_setup, django_user_model, settings):
+    settings.TODO_MAIL_USER_MAPPER = True
+    u1 = django_user_model.objects.get(username="u1")
+    consumer([reply(0, references="", sender=u1.email)])
+    task = Task.objects.get(title="[TEST] reply 0")
+
+    references = f"<reply-0@example.com> <thread-{task.pk}@django-todo>"
+    messages = [reply(n, references=references, sender=u1.email) for n in range(1, 21)]
+    with CaptureQueriesContext(connection) as context:
+        consumer(messages)
+
+    assert task.comment_set.filter(author=u1).count() == 21
+    # References, answered tasks and users are looked up once for the whole batch.
+    queries = [q["sql"] for q in context.captured_queries]
+    assert sum('FROM "auth_user"' in q for q in queries) <= 1
+    assert sum(q.startswith("SELECT") and 'FROM "todo_task"' in q for q in queries) <= 2
+
+
+def test_tracker_commits_at_end_of_producer_batch(todo_setup):
+    committed = []
+
+    def producer():
+        yield reply(1, references="")
+        yield None
+        # The consumer committed the batch before asking for more.
+        committed.append(Task.objects.filter(title="[TEST] reply 1").exists())
+        yield reply(2, references="")
+
+    consumer(producer())
+    assert committed == [True]
+    assert Task.objects.filter(title="[TEST] reply 2").exists()
+
+
+@pytest.mark.skipif(not os.environ.get("TODO_BENCHMARK"), reason="Set TODO_BENCHMARK=1 to run.")
+def test_benchmark_tracker_batches(todo_setup, settings):
+    """Time replaying a backlog of 2000 replies one message at a time, and in batches."""
+    settings.TODO_MAIL_USER_MAPPER = True
+    consumer([reply(0, references="")])
+    for batch_size in [1, 100]:
+        messages = [
+            reply(f"{batch_size}-{n}", references="<reply-0@example.com>") for n in range(2000)
+        ]
+        started = time.perf_counter()
+        consumer(messages, batch_size=batch_size)
+        print(f"\nbatches of {batch_size}: {time.perf_counter() - started:.1f}s")
+
+
+def test_tracker_drops_redelivered_messages_before_querying(todo_setup):
+    queries = []
+
+    with CaptureQueriesContext(connection) as context:
+
+        def producer():
+            yield reply(1, references="")
+            yield None
+            queries.append(len(context.captured_queries))
+            yield reply(1, references="")
+            yield None
+            queries.append(len(context.captured_queries))
+
+        consumer(producer())
+
+    assert queries[0] == queries[1]
+    assert Task.objects.filter(title="[TEST] reply 1").count() == 1
+
+
+def test_seen_message_ids_are_bounded():
+    seen = SeenMessageIds(size=2)
+    seen.add("<a>")
+    seen.add("<b>")
+    assert "<a>" in seen
+    # "<b>" was used least recently, so it makes way.
+    seen.add("<c>")
+    assert "<b>" not in seen
+    assert "<a>" in seen and "<c>" in seen
+    assert len(seen) == 2
+
+
+@pytest.mark.django_db
+def test_comment_message_id_index():
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, Comment._meta.db_table)
+    assert any(
+        c["index"] and c["columns"] == ["email_message_id"] for c in constraints.values()
+    )
+
+
+@pytest.mark.skipif(not os.environ.get("TODO_BENCHMARK"), reason="Set TODO_BENCHMARK=1 to run.")
+def test_benchmark_threading_lookup(todo_setup):
+    """Time finding the tasks referenced by a batch of 100 replies as comments pile up, up to
+    TODO_BENCHMARK_COMMENTS (5 million by default)."""
+    from todo.mail.consumers.tracker import find_message_tasks
+
+    task_list = TaskList.objects.get(slug="zip")
+    task = Task.objects.filter(task_list=task_list).first()
+    total = int(os.environ.get("TODO_BENCHMARK_COMMENTS", 5_000_000))
+
+    count = 0
+    size = 10_000
+    while count < total:
+        size = min(size, total)
+        rows = (
+            (task.pk, "2020-01-01 00:00:00", "x@example.com", f"<bench-{n}@example.com>", "", None)
+            for n in range(count, size)
+        )
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                "INSERT INTO todo_comment (task_id, date, email_from, email_message_id, body, "
+                "author_id) VALUES (%s, %s, %s, %s, %s, %s)",
+                rows,
+            )
+        count = size
+        size *= 10
+
+        # spread over the comments so far
+        references = [f"<bench-{n * count // 100}@example.com>" for n in range(100)]
+        started = time.perf_counter()
+        for _ in range(10):
+            found = find_message_tasks(task_list, references)
+        elapsed = (time.perf_counter() - started) / 10
+        print(f"\n{count} comments: {elapsed * 1000:.2f}ms, {len(found)} found")
+
+
+def test_tracker_root_email_delivered_again(todo_setup):
+    """A first email delivered twice, with nothing remembering it in between, is added once"""
+    from todo.mail.consumers.tracker import insert_message
+
+    task_list = TaskList.objects.get(slug="zip")
+    for _ in range(2):
+        insert_message(task_list, reply(1, references=""), 1, "[TEST] {subject}")
+
+    task = Task.objects.get(title="[TEST] reply 1")
+    assert task.comment_set.count() == 1
+
+
+def test_tracker_batch_delivered_again(todo_setup):
+    """A batch delivered again (after a crash between committing it and deleting the emails)
+    doesn't add anything twice"""
+    first = make_message("first subject", "first content")
+    first["From"] = "test1@example.com"
+    first["Message-ID"] = "<a@example.com>"
+    batch = [first, reply(1), reply(2, references=""), reply(3, references="<reply-2@example.com>")]
+
+    consumer(batch)
+    counts = (Task.objects.count(), Comment.objects.count())
+    consumer(batch)
+    assert (Task.objects.count(), Comment.objects.count()) == counts
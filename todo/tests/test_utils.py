@@ -1,10 +1,23 @@
+import datetime
+
 import pytest
 
+from django.contrib.auth.models import Group
 from django.core import mail
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 
 from todo.defaults import defaults
 from todo.models import Comment, LockedAtomicTransaction, Task
-from todo.utils import send_email_to_thread_participants, send_notify_mail
+from todo.utils import (
+    email_user_ids,
+    send_email_to_thread_participants,
+    send_notify_mail,
+    toggle_task_completed,
+    unique_addresses,
+    user_group_ids,
+)
 
 
 @pytest.mark.django_db
@@ -65,6 +78,22 @@ def test_send_email_to_thread_participants(todo_setup, django_user_model, email_
     assert "u4@example.com" in mail.outbox[0].recipients()
 
 
+def test_thread_participants_get_one_copy(todo_setup, django_user_model, email_backend_setup):
+    u1 = django_user_model.objects.get(username="u1")
+    task = Task.objects.filter(created_by=u1).first()
+    u3 = django_user_model.objects.create_user(username="u3", email="U1@Example.com")
+    Comment.objects.create(author=u3, task=task, body="Hello")
+    Comment.objects.create(author=u1, task=task, body="Hello")
+
+    send_email_to_thread_participants(task, "test body", u1)
+    assert len(mail.outbox[0].recipients()) == 1
+
+
+def test_unique_addresses():
+    addresses = ["Bob <bob@example.com>", "", None, "BOB@example.com", "alice@example.com"]
+    assert unique_addresses(addresses) == ["Bob <bob@example.com>", "alice@example.com"]
+
+
 def test_defaults(settings):
     """todo's `defaults` module provides reasonable default values for unspecified settings.
     If a value is NOT set, it should be pulled from the hash in defaults.py.
@@ -88,3 +117,112 @@ def test_defaults(settings):
 
 # FIXME: Add tests for:
 # Attachments: Test whether allowed, test multiple, test extensions
+
+
+@pytest.mark.parametrize("returning", [True, False])
+def test_toggle_task_completed(todo_setup, monkeypatch, returning):
+    """Toggling flips the flag in one UPDATE, stamps completed_date and reports the new state.
+    Databases without UPDATE ... RETURNING read the new state back afterwards."""
+    monkeypatch.setattr(connection.features, "can_return_columns_from_insert", returning)
+    task = Task.objects.get(title="Task 1", created_by__username="u1")
+    assert not task.completed and task.completed_date is None
+
+    with CaptureQueriesContext(connection) as queries:
+        assert toggle_task_completed(task.id) is True
+    if returning:
+        assert len(queries) == 1
+
+    task.refresh_from_db()
+    assert task.completed
+    assert task.completed_date == datetime.date.today()
+
+    assert toggle_task_completed(task.id) is False
+    task.refresh_from_db()
+    assert not task.completed
+
+    assert toggle_task_completed(999999) is None
+
+
+def _group_queries(queries):
+    return [q for q in queries if "auth_user_groups" in q["sql"]]
+
+
+def test_user_group_ids_once_per_request(todo_setup, client):
+    """Permission checks in a view share one membership lookup."""
+    task = Task.objects.filter(created_by__username="u1").first()
+    client.login(username="u1", password="password")
+    with CaptureQueriesContext(connection) as queries:
+        response = client.post(reverse("todo:task_toggle_done", kwargs={"task_id": task.id}))
+    assert response.status_code == 302
+    assert len(_group_queries(queries)) <= 1
+
+
+def test_user_group_ids_cached_across_requests(todo_setup, django_user_model, settings):
+    settings.TODO_GROUP_CACHE_TIMEOUT = 60
+    g2 = Group.objects.get(name="Workgroup Two")
+    u1 = django_user_model.objects.get(username="u1")
+    expected = frozenset(u1.groups.values_list("id", flat=True))
+
+    assert user_group_ids(django_user_model.objects.get(pk=u1.pk)) == expected
+    with CaptureQueriesContext(connection) as queries:
+        assert user_group_ids(django_user_model.objects.get(pk=u1.pk)) == expected
+    assert not _group_queries(queries)
+
+    # Membership changes (from either side) invalidate the cached value.
+    u1.groups.add(g2)
+    assert user_group_ids(django_user_model.objects.get(pk=u1.pk)) == expected | {g2.id}
+    g2.user_set.remove(u1)
+    assert user_group_ids(django_user_model.objects.get(pk=u1.pk)) == expected
+    Group.objects.filter(pk__in=expected).delete()
+    assert user_group_ids(django_user_model.objects.get(pk=u1.pk)) == frozenset()
+
+
+def _user_queries(queries):
+    return [q["sql"] for q in queries.captured_queries if 'FROM "auth_user"' in q["sql"]]
+
+
+def test_email_user_ids(todo_setup, django_user_model):
+    u1 = django_user_model.objects.get(username="u1")
+    addresses = ["U1 <U1@Example.com>", "nobody@example.com", ""]
+    expected = {"U1 <U1@Example.com>": u1.pk, "nobody@example.com": None, "": None}
+    assert email_user_ids(addresses) == expected
+
+    # Known and unknown addresses alike are answered from the cache.
+    with CaptureQueriesContext(connection) as queries:
+        assert email_user_ids(addresses) == expected
+    assert not _user_queries(queries)
+
+    # Logging in doesn't forget them, while saving a user does.
+    u1.last_login = datetime.datetime.now(datetime.timezone.utc)
+    u1.save(update_fields=["last_login"])
+    with CaptureQueriesContext(connection) as queries:
+        email_user_ids(addresses)
+    assert not _user_queries(queries)
+
+    nobody = django_user_model.objects.create_user(username="nobody", email="nobody@example.com")
+    assert email_user_ids(["nobody@example.com"]) == {"nobody@example.com": nobody.pk}
+
+
+def test_email_user_ids_with_shared_email(todo_setup, django_user_model, settings):
+    settings.TODO_MAIL_USER_CACHE_TIMEOUT = None
+    u1 = django_user_model.objects.get(username="u1")
+    django_user_model.objects.create_user(username="u1-again", email="u1@example.com")
+    # The first user registered with an email wins.
+    assert email_user_ids(["u1@example.com"]) == {"u1@example.com": u1.pk}
+
+
+def test_email_user_ids_exact_matches_first(todo_setup, django_user_model, settings):
+    settings.TODO_MAIL_USER_CACHE_TIMEOUT = None
+    u1 = django_user_model.objects.get(username="u1")
+    mixed = django_user_model.objects.create_user(username="mixed", email="Mixed@Example.com")
+
+    # Emails stored as normalized need no case-insensitive scan...
+    with CaptureQueriesContext(connection) as queries:
+        assert email_user_ids(["U1@example.com"]) == {"U1@example.com": u1.pk}
+    assert len(_user_queries(queries)) == 1
+    assert "LOWER" not in _user_queries(queries)[0]
+
+    # ...which only the rest get.
+    with CaptureQueriesContext(connection) as queries:
+        assert email_user_ids(["mixed@example.com"]) == {"mixed@example.com": mixed.pk}
+    assert len(_user_queries(queries)) == 2
@@ -1,11 +1,19 @@
+import datetime
+import os
+import time
+
 import bleach
 import pytest
 
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
 from todo.models import Task, TaskList
+from todo.pagination import keyset_order
 
 """
 First the "smoketests" - do they respond at all for a logged in admin user?
@@ -25,6 +33,33 @@ def test_view_list_lists(todo_setup, admin_client):
     assert response.status_code == 200
 
 
+def test_view_list_lists_query_count(todo_setup, client):
+    """The homepage tallies tasks per list in SQL; adding lists must not add queries."""
+    g1 = Group.objects.get(name="Workgroup One")
+    u1 = get_user_model().objects.get(username="u1")
+    url = reverse("todo:lists")
+    client.login(username="u1", password="password")
+
+    with CaptureQueriesContext(connection) as before:
+        response = client.get(url)
+    assert response.status_code == 200
+
+    for i in range(10):
+        tlist = TaskList.objects.create(group=g1, name=f"Extra {i}", slug=f"extra-{i}")
+        Task.objects.create(created_by=u1, title="Open", task_list=tlist)
+        Task.objects.create(created_by=u1, title="Done", task_list=tlist, completed=True)
+
+    with CaptureQueriesContext(connection) as after:
+        response = client.get(url)
+    assert response.status_code == 200
+    assert len(after) == len(before)
+    assert response.context["list_count"] == 11
+    assert response.context["task_count"] == 12
+
+    tlist = next(l for l in response.context["lists"] if l.slug == "zip")
+    assert (tlist.task_count_undone, tlist.task_count_done, tlist.task_count_total) == (2, 1, 3)
+
+
 def test_view_reorder(todo_setup, admin_client):
     url = reverse("todo:reorder_tasks")
     response = admin_client.get(url)
@@ -39,6 +74,12 @@ def test_view_external_add(todo_setup, admin_client, settings):
     response = admin_client.get(url)
     assert response.status_code == 200
 
+    # Showing the form doesn't need to pick the list yet.
+    other_group = Group.objects.exclude(pk=default_list.group_id).first()
+    TaskList.objects.create(name="Again", slug=default_list.slug, group=other_group)
+    response = admin_client.get(url)
+    assert response.status_code == 200
+
 
 def test_view_mine(todo_setup, admin_client):
     url = reverse("todo:mine")
@@ -62,6 +103,275 @@ def test_view_list(todo_setup, admin_client):
     assert response.status_code == 200
 
 
+def test_view_list_query_count(todo_setup, client, django_user_model, settings):
+    """Rendering a list costs the same number of queries no matter how many tasks it holds."""
+    settings.TODO_TASKS_PER_PAGE = 500
+    tlist = TaskList.objects.get(slug="zip")
+    u1 = django_user_model.objects.get(username="u1")
+    url = reverse("todo:list_detail", kwargs={"list_id": tlist.id, "list_slug": tlist.slug})
+    client.login(username="u1", password="password")
+
+    with CaptureQueriesContext(connection) as before:
+        response = client.get(url)
+    assert response.status_code == 200
+
+    overdue = datetime.date.today() - datetime.timedelta(days=3)
+    for i in range(200):
+        task = Task.objects.create(
+            created_by=u1, title=f"Seeded {i}", task_list=tlist, due_date=overdue
+        )
+        task.assigned_to.add(u1)
+
+    with CaptureQueriesContext(connection) as after:
+        response = client.get(url)
+    assert response.status_code == 200
+    assert len(after) == len(before)
+
+    seeded = [t for t in response.context["tasks"] if t.title.startswith("Seeded")]
+    assert len(seeded) == 200
+    assert all(t.overdue_status() for t in seeded)
+
+
+def _walk_pages(client, url, direction="after", cursor=None):
+    """Follow list_detail cursors until the last page, returning task ids in display order."""
+    seen = []
+    while True:
+        response = client.get(url, {direction: cursor} if cursor else {})
+        assert response.status_code == 200
+        page = response.context["page"]
+        ids = [t.id for t in page]
+        seen = seen + ids if direction == "after" else ids + seen
+        cursor = page.next_cursor if direction == "after" else page.previous_cursor
+        if cursor is None:
+            return seen, response
+
+
+def test_view_list_keyset_pagination(todo_setup, client, django_user_model, settings):
+    settings.TODO_TASKS_PER_PAGE = 10
+    tlist = TaskList.objects.get(slug="zip")
+    u1 = django_user_model.objects.get(username="u1")
+    for i in range(35):
+        # Repeated priorities, some NULL, so the id tie-breaker matters.
+        Task.objects.create(
+            created_by=u1, title=f"Paged {i}", task_list=tlist, priority=(i % 4) or None
+        )
+    url = reverse("todo:list_detail", kwargs={"list_id": tlist.id, "list_slug": tlist.slug})
+    client.login(username="u1", password="password")
+
+    expected = sorted(
+        Task.objects.filter(task_list=tlist, completed=False),
+        key=lambda t: (t.priority is None, t.priority or 0, t.created_date, t.id),
+    )
+    expected = [t.id for t in expected]
+
+    forward, last_response = _walk_pages(client, url)
+    assert forward == expected
+
+    # Walking back from the last page reproduces the same order.
+    last_page = last_response.context["page"]
+    backward, _ = _walk_pages(client, url, "before", last_page.previous_cursor)
+    assert backward + [t.id for t in last_page] == expected
+
+    # A garbage cursor is treated as the first page.
+    response = client.get(url, {"after": "not-a-cursor"})
+    assert [t.id for t in response.context["page"]] == expected[:10]
+
+
+def test_view_mine_and_completed_paginated(todo_setup, client, django_user_model, settings):
+    settings.TODO_TASKS_PER_PAGE = 2
+    tlist = TaskList.objects.get(slug="zip")
+    u1 = django_user_model.objects.get(username="u1")
+    for task in Task.objects.filter(task_list=tlist):
+        task.assigned_to.add(u1)
+    Task.objects.create(created_by=u1, title="Done 2", task_list=tlist, completed=True)
+    Task.objects.create(created_by=u1, title="Done 3", task_list=tlist, completed=True)
+    client.login(username="u1", password="password")
+
+    mine, _ = _walk_pages(client, reverse("todo:mine"))
+    assert len(mine) == 2
+
+    completed_url = reverse(
+        "todo:list_detail_completed", kwargs={"list_id": tlist.id, "list_slug": tlist.slug}
+    )
+    completed, _ = _walk_pages(client, completed_url)
+    assert len(completed) == 3 == len(set(completed))
+
+
+def test_reorder_within_page(todo_setup, client, django_user_model):
+    """Reordering the rows of a later page keeps them after the rows on earlier pages."""
+    tlist = TaskList.objects.get(slug="zip")
+    u1 = django_user_model.objects.get(username="u1")
+    later = [
+        Task.objects.create(created_by=u1, title=f"Later {i}", task_list=tlist, priority=10 + i)
+        for i in range(3)
+    ]
+    client.login(username="u1", password="password")
+    new_order = [later[2].id, later[0].id, later[1].id]
+    response = client.post(
+        reverse("todo:reorder_tasks"), {"tasktable[]": [""] + [str(i) for i in new_order]}
+    )
+    assert response.status_code == 201
+
+    priorities = dict(Task.objects.filter(pk__in=new_order).values_list("pk", "priority"))
+    assert [priorities[pk] for pk in new_order] == [10, 11, 12]
+
+
+def test_reorder_single_bulk_update(todo_setup, client, django_user_model):
+    tlist = TaskList.objects.get(slug="zip")
+    u1 = django_user_model.objects.get(username="u1")
+    for i in range(50):
+        Task.objects.create(created_by=u1, title=f"Bulk {i}", task_list=tlist, priority=4 + i)
+    ids = list(
+        Task.objects.filter(task_list=tlist).order_by("priority").values_list("id", flat=True)
+    )
+    # Swap the first two; everything else keeps its priority.
+    new_order = [ids[1], ids[0]] + ids[2:]
+    client.login(username="u1", password="password")
+
+    with CaptureQueriesContext(connection) as queries:
+        response = client.post(
+            reverse("todo:reorder_tasks"), {"tasktable[]": [""] + [str(i) for i in new_order]}
+        )
+    assert response.status_code == 201
+    updates = [q["sql"] for q in queries if q["sql"].startswith("UPDATE")]
+    assert len(updates) == 1
+    assert "CASE" in updates[0]
+
+    priorities = dict(Task.objects.filter(task_list=tlist).values_list("id", "priority"))
+    assert [priorities[pk] for pk in new_order] == list(range(1, len(new_order) + 1))
+
+
+def test_reorder_rejects_other_groups_and_mixed_lists(todo_setup, client):
+    zip_ids = [str(t.id) for t in Task.objects.filter(task_list__slug="zip")]
+    zap_ids = [str(t.id) for t in Task.objects.filter(task_list__slug="zap")]
+    before = dict(Task.objects.values_list("id", "priority"))
+    client.login(username="u1", password="password")
+    url = reverse("todo:reorder_tasks")
+
+    response = client.post(url, {"tasktable[]": [""] + list(reversed(zap_ids))})
+    assert response.status_code == 403
+
+    response = client.post(url, {"tasktable[]": [""] + list(reversed(zip_ids)) + zap_ids})
+    assert response.status_code == 400
+
+    assert dict(Task.objects.values_list("id", "priority")) == before
+
+
+def test_reorder_skips_tasks_without_list(todo_setup, client):
+    orphan = Task.objects.filter(task_list__slug="zip").first()
+    Task.objects.filter(pk=orphan.pk).update(task_list=None, priority=7)
+    client.login(username="u1", password="password")
+
+    response = client.post(reverse("todo:reorder_tasks"), {"tasktable[]": ["", str(orphan.id)]})
+    assert response.status_code == 201
+    orphan.refresh_from_db()
+    assert orphan.priority == 7
+
+
+def _list_order(tlist):
+    return list(
+        Task.objects.filter(task_list=tlist, completed=False)
+        .order_by(*keyset_order())
+        .values_list("title", flat=True)
+    )
+
+
+def test_move_task_writes_one_row(todo_setup, client, django_user_model):
+    tlist = TaskList.objects.get(slug="zip")
+    u1 = django_user_model.objects.get(username="u1")
+    for i, title in enumerate("ABCD"):
+        Task.objects.create(created_by=u1, title=title, task_list=tlist, priority=(i + 1) * 1024)
+    Task.objects.filter(task_list=tlist, title__startswith="Task").delete()
+    tasks = {t.title: t for t in Task.objects.filter(task_list=tlist)}
+    client.login(username="u1", password="password")
+
+    with CaptureQueriesContext(connection) as queries:
+        response = client.post(
+            reverse("todo:move_task"),
+            {"task": tasks["D"].id, "after": tasks["A"].id, "before": tasks["B"].id},
+        )
+    assert response.status_code == 201
+    updates = [q["sql"] for q in queries if q["sql"].startswith("UPDATE")]
+    assert len(updates) == 1
+    assert _list_order(tlist) == ["A", "D", "B", "C"]
+
+    # Dropped at the bottom of a page: the neighbour below is found server-side.
+    client.post(reverse("todo:move_task"), {"task": tasks["A"].id, "after": tasks["B"].id})
+    assert _list_order(tlist) == ["D", "B", "A", "C"]
+
+
+def test_move_task_rebalances_when_crowded(todo_setup, client, django_user_model):
+    tlist = TaskList.objects.get(slug="zip")
+    client.login(username="u1", password="password")
+    # The fixture's open tasks sit at priorities 1 and 3, with nothing free above "Task 1".
+    task1 = Task.objects.get(task_list=tlist, title="Task 1")
+    task3 = Task.objects.get(task_list=tlist, title="Task 3")
+    response = client.post(reverse("todo:move_task"), {"task": task3.id, "before": task1.id})
+    assert response.status_code == 201
+    assert _list_order(tlist) == ["Task 3", "Task 1"]
+    task1.refresh_from_db()
+    task3.refresh_from_db()
+    assert (task3.priority, task1.priority) == (512, 1024)
+
+
+def test_move_task_rejects_stale_neighbours(todo_setup, client):
+    tlist = TaskList.objects.get(slug="zip")
+    client.login(username="u1", password="password")
+    task1 = Task.objects.get(task_list=tlist, title="Task 1")
+    task3 = Task.objects.get(task_list=tlist, title="Task 3")
+    task4 = Task.objects.create(created_by=task1.created_by, title="Task 4", task_list=tlist)
+    before = dict(Task.objects.values_list("id", "priority"))
+
+    # "after" sorts below "before", as happens when another user reordered the list meanwhile.
+    response = client.post(
+        reverse("todo:move_task"), {"task": task4.id, "after": task3.id, "before": task1.id}
+    )
+    assert response.status_code == 400
+    assert dict(Task.objects.values_list("id", "priority")) == before
+
+
+def test_new_task_goes_to_end_of_list(todo_setup, client):
+    tlist = TaskList.objects.get(slug="zip")
+    Task.objects.filter(task_list=tlist, title="Task 3").update(priority=5000)
+    data = {
+        "task_list": tlist.id,
+        "priority": 999,
+        "title": "Newest",
+        "note": "",
+        "add_edit_task": "Submit",
+    }
+    client.login(username="u1", password="password")
+    url = reverse("todo:list_detail", kwargs={"list_id": tlist.id, "list_slug": tlist.slug})
+    assert client.get(url).context["form"].initial["priority"] == 5000 + 1024
+
+    response = client.post(url, data)
+    assert response.status_code == 302
+    assert Task.objects.get(title="Newest").priority == 5000 + 1024
+    assert _list_order(tlist)[-1] == "Newest"
+
+
+def test_move_task_permissions(todo_setup, client):
+    zap = list(Task.objects.filter(task_list__slug="zap", completed=False))
+    client.login(username="u1", password="password")
+    response = client.post(reverse("todo:move_task"), {"task": zap[1].id, "before": zap[0].id})
+    assert response.status_code == 403
+    response = client.get(reverse("todo:move_task"))
+    assert response.status_code == 405
+
+    Task.objects.filter(pk=zap[1].pk).update(task_list=None)
+    response = client.post(reverse("todo:move_task"), {"task": zap[1].id, "before": zap[0].id})
+    assert response.status_code == 404
+
+
+def test_rebalance_priorities_command(todo_setup):
+    tlist = TaskList.objects.get(slug="zip")
+    before = _list_order(tlist)
+    call_command("rebalance_priorities")
+    assert _list_order(tlist) == before
+    priorities = sorted(Task.objects.filter(task_list=tlist).values_list("priority", flat=True))
+    assert priorities == [1024, 2048, 3072]
+
+
 def test_view_add_list(todo_setup, admin_client):
     url = reverse("todo:add_list")
     response = admin_client.get(url)
@@ -350,3 +660,85 @@ def test_setting_TODO_STAFF_ONLY_True(todo_setup, client, settings, django_user_
     client.login(username="u2", password="password")
     response = client.get(url)
     assert response.status_code == 302  # Redirected to login view
+
+
+# ### VISIBILITY ###
+
+
+def test_visible_to_many_groups(todo_setup, django_user_model, admin_user):
+    """visible_to() is a single EXISTS query however many groups the user is in."""
+    u1 = django_user_model.objects.get(username="u1")
+    groups = [Group(name=f"Bulk group {i}") for i in range(300)]
+    Group.objects.bulk_create(groups)
+    u1.groups.add(*Group.objects.filter(name__startswith="Bulk group"))
+    TaskList.objects.create(group=Group.objects.get(name="Bulk group 7"), name="Far", slug="far")
+
+    with CaptureQueriesContext(connection) as queries:
+        names = sorted(TaskList.objects.visible_to(u1).values_list("name", flat=True))
+        tasks = list(Task.objects.visible_to(u1).values_list("task_list__slug", flat=True))
+    assert len(queries) == 2
+    assert all("EXISTS" in q["sql"] for q in queries)
+    assert names == ["Far", "Zip"]
+    assert set(tasks) == {"zip"}
+
+    # Superusers skip the membership check altogether.
+    with CaptureQueriesContext(connection) as queries:
+        qs = Task.objects.visible_to(admin_user)
+    assert not queries
+    assert qs.count() == Task.objects.count()
+
+
+def test_mine_only_visible_tasks(todo_setup, client, django_user_model):
+    u1 = django_user_model.objects.get(username="u1")
+    # Assigned to u1, but in a list of a group they've since left.
+    hidden = Task.objects.filter(task_list__slug="zap").first()
+    hidden.assigned_to.add(u1)
+    shown = Task.objects.filter(task_list__slug="zip", completed=False).first()
+    shown.assigned_to.add(u1)
+    client.login(username="u1", password="password")
+
+    response = client.get(reverse("todo:mine"))
+    assert [task.id for task in response.context["tasks"]] == [shown.id]
+
+
+@pytest.mark.skipif(not os.environ.get("TODO_BENCHMARK"), reason="Set TODO_BENCHMARK=1 to run.")
+def test_benchmark_visible_to(todo_setup, django_user_model):
+    """Time the "mine" list for a user in many groups, filtering with visible_to() and with the
+    group__in filter it replaced."""
+    u1 = django_user_model.objects.get(username="u1")
+    groups = Group.objects.bulk_create([Group(name=f"Bench group {i}") for i in range(1000)])
+    u1.groups.add(*groups)
+    lists = TaskList.objects.bulk_create(
+        [TaskList(group=group, name=group.name, slug=f"bench-{i}") for i, group in enumerate(groups)]
+    )
+    tasks = Task.objects.bulk_create(
+        [
+            Task(created_by=u1, title=f"Bench {i}", task_list=lists[i % len(lists)])
+            for i in range(50_000)
+        ]
+    )
+    Task.assigned_to.through.objects.bulk_create(
+        [Task.assigned_to.through(task_id=task.id, user_id=u1.id) for task in tasks[::2]]
+    )
+
+    querysets = {
+        "visible_to": lambda: Task.objects.visible_to(u1),
+        "group__in": lambda: Task.objects.filter(task_list__group__in=u1.groups.all()),
+    }
+    for name, queryset in querysets.items():
+        started = time.perf_counter()
+        for _ in range(20):
+            page = queryset().filter(assigned_to=u1).order_by(*keyset_order())[:100]
+            list(page.values_list("id", flat=True))
+        print(f"\n{name}: {(time.perf_counter() - started) / 20 * 1000:.1f}ms per page")
+
+
+def test_autocomplete_only_visible_tasks(todo_setup, client):
+    task = Task.objects.filter(task_list__slug="zip").first()
+    client.login(username="u1", password="password")
+    response = client.get(reverse("todo:task_autocomplete", kwargs={"task_id": task.id}))
+    assert response.status_code == 200
+    ids = {int(r["id"]) for r in response.json()["results"]}
+    assert ids == set(
+        Task.objects.filter(task_list__slug="zip").exclude(pk=task.pk).values_list("id", flat=True)
+    )
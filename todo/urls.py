@@ -10,6 +10,8 @@ urlpatterns = [
     path("", views.list_lists, name="lists"),
     # View reorder_tasks is only called by JQuery for drag/drop task ordering.
     path("reorder_tasks/", views.reorder_tasks, name="reorder_tasks"),
+    # Single-task moves from drag/drop, writing only the moved task.
+    path("move_task/", views.move_task, name="move_task"),
     # Allow users to post tasks from outside django-todo (e.g. for filing tickets - see docs)
     path("ticket/add/", views.external_add, name="external_add"),
     # Three paths into `list_detail` view
@@ -45,5 +47,10 @@ urlpatterns.extend(
         path("delete/<int:task_id>/", views.delete_task, name="delete_task"),
         path("search/", views.search, name="search"),
         path("import_csv/", views.import_csv, name="import_csv"),
+        path(
+            "import_csv/<int:job_id>/status/",
+            views.import_job_status,
+            name="import_job_status",
+        ),
     ]
 )
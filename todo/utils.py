@@ -1,15 +1,24 @@
+import datetime
 import email.utils
+import hashlib
 import logging
 import os
 import time
+from typing import Optional
 
 from django.conf import settings
+from django.contrib.auth import get_user_model
 from django.contrib.sites.models import Site
 from django.core import mail
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Case, F, Max, Value, When
+from django.db.models.functions import Lower
 from django.template.loader import render_to_string
 
 from todo.defaults import defaults
-from todo.models import Attachment, Comment, Task
+from todo.models import Attachment, Comment, Task, TaskList
+from todo.pagination import adjacent, keyset_order
 
 log = logging.getLogger(__name__)
 
@@ -27,8 +36,116 @@ def staff_check(user):
         return True
 
 
+GROUP_IDS_CACHE_VERSION_KEY = "todo:group_ids:version"
+
+
+def group_ids_cache_key(user_id):
+    version = cache.get_or_set(GROUP_IDS_CACHE_VERSION_KEY, 1, None)
+    return f"todo:group_ids:{version}:{user_id}"
+
+
+def user_group_ids(user) -> frozenset:
+    """IDs of the groups `user` belongs to, for permission checks.
+
+    Looked up at most once per user object (i.e. once per request for `request.user`). If
+    TODO_GROUP_CACHE_TIMEOUT is set, also kept in Django's cache between requests; any change
+    to group memberships invalidates every cached entry (see todo.signals), which only reaches
+    other processes if they share the cache.
+    """
+    group_ids = getattr(user, "_todo_group_ids", None)
+    if group_ids is not None:
+        return group_ids
+
+    timeout = defaults("TODO_GROUP_CACHE_TIMEOUT")
+    if not user.is_authenticated:
+        group_ids = frozenset()
+    elif timeout:
+        key = group_ids_cache_key(user.pk)
+        group_ids = cache.get(key)
+        if group_ids is None:
+            group_ids = frozenset(user.groups.values_list("id", flat=True))
+            cache.set(key, group_ids, timeout)
+    else:
+        group_ids = frozenset(user.groups.values_list("id", flat=True))
+
+    user._todo_group_ids = group_ids
+    return group_ids
+
+
+def user_in_group(user, group_id) -> bool:
+    return group_id in user_group_ids(user)
+
+
+EMAIL_USERS_CACHE_VERSION_KEY = "todo:email_users:version"
+
+
+def normalize_email(address) -> str:
+    """The bare, lower-cased email address in `address` (which may include a name)."""
+    return email.utils.parseaddr(str(address))[1].strip().lower()
+
+
+def unique_addresses(addresses) -> list:
+    """`addresses` without blanks, keeping the first of those normalizing to the same email."""
+    unique = {}
+    for address in addresses:
+        normalized = normalize_email(address) if address else ""
+        if normalized and normalized not in unique:
+            unique[normalized] = address
+    return list(unique.values())
+
+
+def email_user_cache_key(version, normalized):
+    # emails may hold characters some cache backends don't allow in keys
+    digest = hashlib.sha1(normalized.encode()).hexdigest()
+    return f"todo:email_users:{version}:{digest}"
+
+
+def email_user_ids(addresses) -> dict:
+    """Map each of `addresses` to the id of the user having that email, or None.
+
+    Emails are compared normalized (see normalize_email); if several users share one, the
+    first registered wins. Users whose email is stored normalized are looked up first, which
+    an index on the email column can answer; only addresses left over need a case-insensitive
+    scan. Answers, including misses, are kept in Django's cache for
+    TODO_MAIL_USER_CACHE_TIMEOUT seconds, and dropped whenever a user is saved or deleted (see
+    todo.signals; QuerySet.update() goes unnoticed).
+    """
+    normalized = {address: normalize_email(address) for address in addresses}
+    emails = set(normalized.values()) - {""}
+    timeout = defaults("TODO_MAIL_USER_CACHE_TIMEOUT")
+
+    found = {}
+    if timeout and emails:
+        version = cache.get_or_set(EMAIL_USERS_CACHE_VERSION_KEY, 1, None)
+        keys = {email_user_cache_key(version, e): e for e in emails}
+        for key, user_id in cache.get_many(keys).items():
+            # 0 marks an email known not to belong to anyone
+            found[keys[key]] = user_id or None
+
+    missing = emails - found.keys()
+    if missing:
+        users = get_user_model().objects.order_by("-pk")
+        looked_up = dict.fromkeys(missing)
+        looked_up.update(users.filter(email__in=missing).values_list("email", "pk"))
+        unmatched = {e for e, user_id in looked_up.items() if user_id is None}
+        if unmatched:
+            looked_up.update(
+                users.annotate(normalized_email=Lower("email"))
+                .filter(normalized_email__in=unmatched)
+                .values_list("normalized_email", "pk")
+            )
+        found.update(looked_up)
+        if timeout:
+            cache.set_many(
+                {email_user_cache_key(version, e): i or 0 for e, i in looked_up.items()},
+                timeout,
+            )
+
+    return {address: found.get(email) for address, email in normalized.items()}
+
+
 def user_can_read_task(task, user):
-    return task.task_list.group in user.groups.all() or user.is_superuser
+    return user.is_superuser or user_in_group(user, task.task_list.group_id)
 
 
 def todo_get_backend(task):
@@ -118,7 +235,7 @@ def send_notify_mail(new_task):
         "todo/email/assigned_body.txt", {"task": new_task, "site": current_site}
     )
 
-    recip_list = list(assignees.values_list("email", flat=True))
+    recip_list = unique_addresses(assignees.values_list("email", flat=True))
     todo_send_mail(new_task.created_by, new_task, subject, body, recip_list)
 
 
@@ -136,28 +253,145 @@ def send_email_to_thread_participants(task, msg_body, user, subject=None):
     )
 
     # Get all thread participants
-    commenters = Comment.objects.filter(task=task)
-    recip_list = set(ca.author.email for ca in commenters if ca.author is not None)
+    commenters = Comment.objects.filter(task=task, author__isnull=False).select_related("author")
+    recip_list = [ca.author.email for ca in commenters]
     if task.created_by:
-        recip_list.add(task.created_by.email)
-    for assignee in task.assigned_to.all():
-        recip_list.add(assignee.email)
-    recip_list = list(m for m in recip_list if m)
+        recip_list.append(task.created_by.email)
+    recip_list.extend(assignee.email for assignee in task.assigned_to.all())
+    # the same person only gets one copy, however their address is spelled
+    recip_list = unique_addresses(recip_list)
 
     todo_send_mail(user, task, email_subject, email_body, recip_list)
 
 
-def toggle_task_completed(task_id: int) -> bool:
-    """Toggle the `completed` bool on Task from True to False or vice versa."""
-    try:
-        task = Task.objects.get(id=task_id)
-        task.completed = not task.completed
-        task.save()
-        return True
+def toggle_task_completed(task_id: int) -> Optional[bool]:
+    """Toggle the `completed` bool on Task from True to False or vice versa.
 
-    except Task.DoesNotExist:
+    Done as one conditional UPDATE (stamping `completed_date` when completing), so two clicks
+    arriving together flip the task twice rather than racing on a stale read, and Task.save()
+    doesn't rewrite every column. Returns the new `completed` value, or None if there is no
+    such task.
+    """
+    today = datetime.date.today()
+
+    if connection.vendor == "postgresql" or (
+        connection.vendor == "sqlite" and connection.features.can_return_columns_from_insert
+    ):
+        # One round trip: let the database hand back the state it just wrote.
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {Task._meta.db_table} SET completed = NOT completed, "
+                "completed_date = CASE WHEN completed THEN completed_date ELSE %s END "
+                "WHERE id = %s RETURNING completed",
+                [today, task_id],
+            )
+            row = cursor.fetchone()
+        completed = None if row is None else bool(row[0])
+    else:
+        with transaction.atomic():
+            updated = Task.objects.filter(pk=task_id).update(
+                completed=Case(When(completed=True, then=Value(False)), default=Value(True)),
+                completed_date=Case(
+                    When(completed=False, then=Value(today)), default=F("completed_date")
+                ),
+            )
+            completed = (
+                Task.objects.filter(pk=task_id).values_list("completed", flat=True).first()
+                if updated
+                else None
+            )
+
+    if completed is None:
         log.info(f"Task {task_id} not found.")
-        return False
+    return completed
+
+
+def rebalance_task_priorities(task_list) -> int:
+    """Renumber every task in `task_list` TODO_PRIORITY_GAP apart, keeping the current order, so
+    that any task can later be moved between two neighbours by writing just that one row.
+    Returns the number of tasks whose priority changed."""
+    gap = defaults("TODO_PRIORITY_GAP")
+    tasks = (
+        Task.objects.filter(task_list=task_list).only("id", "priority").order_by(*keyset_order())
+    )
+
+    changed = []
+    for position, task in enumerate(tasks.iterator(), start=1):
+        if task.priority != position * gap:
+            task.priority = position * gap
+            changed.append(task)
+
+    with transaction.atomic():
+        Task.objects.bulk_update(changed, ["priority"], batch_size=1000)
+    return len(changed)
+
+
+def _keyset_position(task):
+    """`task`'s place in TASK_KEYSET_ORDERING (NULL priorities last), for comparing in Python."""
+    return (task.priority is None, task.priority or 0, task.created_date, task.pk)
+
+
+def next_task_priority(task_list) -> int:
+    """A priority that puts a new task at the end of `task_list`, TODO_PRIORITY_GAP after the
+    last numbered task, so it can later be moved without rebalancing."""
+    last = Task.objects.filter(task_list=task_list).aggregate(last=Max("priority"))["last"]
+    return (last or 0) + defaults("TODO_PRIORITY_GAP")
+
+
+def reposition_task(task, after=None, before=None) -> int:
+    """Move `task` so it directly follows `after` and/or precedes `before` (tasks in the same list),
+    by giving it a priority between theirs. Only `task` is written, unless there's no gap left
+    between the neighbours, in which case the list is rebalanced first. Returns the new priority.
+
+    Raises ValueError if `after` doesn't sort before `before`, e.g. when the page the move was
+    made on is out of date.
+    """
+    gap = defaults("TODO_PRIORITY_GAP")
+    with transaction.atomic():
+        # Moves within one list take turns, so two of them can't pick the same midpoint.
+        TaskList.objects.select_for_update().filter(pk=task.task_list_id).first()
+
+        siblings = Task.objects.filter(task_list=task.task_list_id, completed=task.completed)
+        siblings = siblings.exclude(pk=task.pk)
+        # Read the neighbours again now that we hold the lock; ones deleted or completed
+        # meanwhile are ignored.
+        after, before = (
+            None if neighbour is None else siblings.filter(pk=neighbour.pk).first()
+            for neighbour in (after, before)
+        )
+        if after and before and _keyset_position(after) >= _keyset_position(before):
+            raise ValueError(f"Task {after.pk} doesn't come before task {before.pk}.")
+
+        for attempt in range(2):
+            # Dropped at the top or bottom of a page: find the real neighbour, which may be on
+            # another page.
+            if after is None and before is not None:
+                after = adjacent(siblings, before, forward=False)
+            if before is None and after is not None:
+                before = adjacent(siblings, after, forward=True)
+            if after is None and before is None:
+                return task.priority
+
+            low = 0 if after is None else after.priority
+            high = None if before is None else before.priority
+            # Unprioritized tasks sort last, so anything numbered comes before them.
+            if low is not None and high is None:
+                high = low + 2 * gap
+            if low is not None and high - low >= 2:
+                task.priority = (low + high) // 2
+                Task.objects.filter(pk=task.pk).update(priority=task.priority)
+                return task.priority
+
+            # No room between the neighbours (or they aren't numbered yet): spread the list out,
+            # then place the task after the same neighbour, whose successor is now `gap` away.
+            rebalance_task_priorities(task.task_list_id)
+            if after is not None:
+                after.refresh_from_db(fields=["priority"])
+                before = None
+            else:
+                before.refresh_from_db(fields=["priority"])
+
+    raise ValueError(f"TODO_PRIORITY_GAP ({gap}) leaves no room to move task {task.pk}.")
 
 
 def remove_attachment_file(attachment_id: int) -> bool:
@@ -2,9 +2,10 @@ from todo.views.add_list import add_list  # noqa: F401
 from todo.views.del_list import del_list  # noqa: F401
 from todo.views.delete_task import delete_task  # noqa: F401
 from todo.views.external_add import external_add  # noqa: F401
-from todo.views.import_csv import import_csv  # noqa: F401
+from todo.views.import_csv import import_csv, import_job_status  # noqa: F401
 from todo.views.list_detail import list_detail  # noqa: F401
 from todo.views.list_lists import list_lists  # noqa: F401
+from todo.views.move_task import move_task  # noqa: F401
 from todo.views.remove_attachment import remove_attachment  # noqa: F401
 from todo.views.reorder_tasks import reorder_tasks  # noqa: F401
 from todo.views.search import search  # noqa: F401
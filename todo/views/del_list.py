@@ -5,7 +5,7 @@ from django.http import HttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
 
 from todo.models import Task, TaskList
-from todo.utils import staff_check
+from todo.utils import staff_check, user_in_group
 
 
 @login_required
@@ -17,7 +17,7 @@ def del_list(request, list_id: int, list_slug: str) -> HttpResponse:
 
     # Ensure user has permission to delete list. Get the group this list belongs to,
     # and check whether current user is a member of that group AND a staffer.
-    if task_list.group not in request.user.groups.all():
+    if not user_in_group(request.user, task_list.group_id):
         raise PermissionDenied    
     if not request.user.is_staff:
         raise PermissionDenied
@@ -11,7 +11,7 @@ from django.template.loader import render_to_string
 from todo.defaults import defaults
 from todo.forms import AddExternalTaskForm
 from todo.models import TaskList
-from todo.utils import staff_check
+from todo.utils import next_task_priority, staff_check
 
 
 @login_required
@@ -43,6 +43,7 @@ def external_add(request) -> HttpResponse:
             task = form.save(commit=False)
             task.task_list = TaskList.objects.get(slug=settings.TODO_DEFAULT_LIST_SLUG)
             task.created_by = request.user
+            task.priority = next_task_priority(task.task_list)
             task.save()
             if defaults("TODO_DEFAULT_ASSIGNEE"):
                 assignee = get_user_model().objects.get(username=settings.TODO_DEFAULT_ASSIGNEE)
@@ -75,6 +76,7 @@ def external_add(request) -> HttpResponse:
             return redirect(defaults("TODO_PUBLIC_SUBMIT_REDIRECT"))
 
     else:
+        # Replaced with the end of the list when the task is saved.
         form = AddExternalTaskForm(initial={"priority": 999})
 
     context = {"form": form}
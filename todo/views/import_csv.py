@@ -1,8 +1,11 @@
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required, user_passes_test
-from django.http import HttpResponse
-from django.shortcuts import redirect, render, reverse
+from django.core.exceptions import PermissionDenied
+from django.http import HttpResponse, JsonResponse
+from django.shortcuts import get_object_or_404, redirect, render, reverse
 
+from todo.defaults import defaults
+from todo.models import ImportJob
 from todo.operations.csv_importer import CSVImporter
 from todo.utils import staff_check
 
@@ -13,7 +16,7 @@ def import_csv(request) -> HttpResponse:
     """Import a specifically formatted CSV into stored tasks.
     """
 
-    ctx = {"results": None}
+    ctx = {"results": None, "job": None}
 
     if request.method == "POST":
         filepath = request.FILES.get("csvfile")
@@ -22,13 +25,53 @@ def import_csv(request) -> HttpResponse:
             messages.error(request, "You must supply a CSV file to import.")
             return redirect(reverse("todo:import_csv"))
 
-        importer = CSVImporter()
+        dry_run = bool(request.POST.get("dry_run"))
+
+        if defaults("TODO_CSV_IMPORT_IN_BACKGROUND") and not dry_run:
+            # Hand the file to `import_worker` and let the page poll for progress.
+            job = ImportJob.objects.create(file=filepath, created_by=request.user)
+            return redirect(reverse("todo:import_csv") + f"?job={job.id}")
+
+        importer = CSVImporter(dry_run=dry_run)
         results = importer.upsert(filepath)
 
         if results:
             ctx["results"] = results
+            ctx["dry_run"] = dry_run
         else:
             messages.error(request, "Could not parse provided CSV file.")
             return redirect(reverse("todo:import_csv"))
 
+    elif request.GET.get("job", "").isdigit():
+        ctx["job"] = get_import_job(request, int(request.GET["job"]))
+
     return render(request, "todo/import_csv.html", context=ctx)
+
+
+def get_import_job(request, job_id) -> ImportJob:
+    job = get_object_or_404(ImportJob, pk=job_id)
+    if not (request.user.is_superuser or job.created_by_id == request.user.id):
+        raise PermissionDenied
+    return job
+
+
+@login_required
+@user_passes_test(staff_check)
+def import_job_status(request, job_id: int) -> HttpResponse:
+    """Progress of a background CSV import, polled by import_csv.html.
+    """
+
+    job = get_import_job(request, job_id)
+    return JsonResponse(
+        {
+            "status": job.status,
+            "total_rows": job.total_rows,
+            "rows_processed": job.rows_processed,
+            "rows_upserted": job.rows_upserted,
+            "rows_skipped": job.rows_processed - job.rows_upserted,
+            "error_count": job.error_count,
+            "errors": job.errors,
+            "eta_seconds": job.eta(),
+            "message": job.message,
+        }
+    )
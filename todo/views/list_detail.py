@@ -1,14 +1,19 @@
+import datetime
+
 import bleach
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.core.exceptions import PermissionDenied
+from django.db.models import BooleanField, Case, Value, When
 from django.http import HttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.utils import timezone
 
+from todo.defaults import defaults
 from todo.forms import AddEditTaskForm
 from todo.models import Task, TaskList
-from todo.utils import send_notify_mail, staff_check
+from todo.pagination import keyset_paginate
+from todo.utils import next_task_priority, send_notify_mail, staff_check
 
 
 @login_required
@@ -23,12 +28,13 @@ def list_detail(request, list_id=None, list_slug=None, view_completed=False) ->
 
     # Which tasks to show on this list view?
     if list_slug == "mine":
-        tasks = Task.objects.filter(assigned_to=request.user)
+        tasks = Task.objects.visible_to(request.user).filter(assigned_to=request.user)
 
     else:
         # Show a specific list, ensuring permissions.
-        task_list = get_object_or_404(TaskList, id=list_id)
-        if task_list.group not in request.user.groups.all() and not request.user.is_superuser:
+        task_list = TaskList.objects.visible_to(request.user).filter(id=list_id).first()
+        if task_list is None:
+            get_object_or_404(TaskList, id=list_id)
             raise PermissionDenied
         tasks = Task.objects.filter(task_list=task_list.id)
 
@@ -38,6 +44,29 @@ def list_detail(request, list_id=None, list_slug=None, view_completed=False) ->
     else:
         tasks = tasks.filter(completed=False)
 
+    # Fetch everything the template shows per row up front, so the number of queries
+    # doesn't grow with the number of tasks in the list.
+    tasks = (
+        tasks.select_related("created_by", "task_list__group")
+        .prefetch_related("assigned_to")
+        .annotate(
+            is_overdue=Case(
+                When(due_date__lt=datetime.date.today(), then=Value(True)),
+                default=Value(False),
+                output_field=BooleanField(),
+            )
+        )
+    )
+
+    # Keyset pagination: "after"/"before" cursors mark the edge of the neighbouring page,
+    # so deep pages of long-lived lists cost the same as the first.
+    page = keyset_paginate(
+        tasks,
+        after=request.GET.get("after"),
+        before=request.GET.get("before"),
+        per_page=defaults("TODO_TASKS_PER_PAGE"),
+    )
+
     # ######################
     #  Add New Task Form
     # ######################
@@ -46,12 +75,15 @@ def list_detail(request, list_id=None, list_slug=None, view_completed=False) ->
         form = AddEditTaskForm(
             request.user,
             request.POST,
-            initial={"assigned_to": [request.user.id], "priority": 999, "task_list": task_list},
+            initial={"assigned_to": [request.user.id], "task_list": task_list},
         )
 
         if form.is_valid():
             new_task = form.save(commit=False)
             new_task.created_by = request.user
+            # New tasks go to the end of the list, whatever the list looked like when the form
+            # was rendered.
+            new_task.priority = next_task_priority(new_task.task_list)
             new_task.note = bleach.clean(form.cleaned_data["note"], strip=True)
             form.save()
 
@@ -69,7 +101,11 @@ def list_detail(request, list_id=None, list_slug=None, view_completed=False) ->
         if list_slug not in ["mine", "recent-add", "recent-complete"]:
             form = AddEditTaskForm(
                 request.user,
-                initial={"assigned_to": [request.user.id], "priority": 999, "task_list": task_list},
+                initial={
+                    "assigned_to": [request.user.id],
+                    "priority": next_task_priority(task_list),
+                    "task_list": task_list,
+                },
             )
 
     context = {
@@ -77,7 +113,8 @@ def list_detail(request, list_id=None, list_slug=None, view_completed=False) ->
         "list_slug": list_slug,
         "task_list": task_list,
         "form": form,
-        "tasks": tasks,
+        "tasks": page,
+        "page": page,
         "view_completed": view_completed,
     }
 
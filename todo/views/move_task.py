@@ -0,0 +1,46 @@
+from django.contrib.auth.decorators import login_required, user_passes_test
+from django.core.exceptions import PermissionDenied
+from django.http import HttpResponse, HttpResponseBadRequest
+from django.shortcuts import get_object_or_404
+from django.views.decorators.http import require_POST
+
+from todo.models import Task
+from todo.utils import reposition_task, staff_check, user_in_group
+
+
+@login_required
+@user_passes_test(staff_check)
+@require_POST
+def move_task(request) -> HttpResponse:
+    """Handle a single drag/drop move in list_detail.html: put `task` after the task `after`
+    and/or before the task `before`. Unlike reorder_tasks, this writes one row however long
+    the list is.
+    """
+    ids = {key: request.POST.get(key, "") for key in ("task", "after", "before")}
+    if not ids["task"].isdigit() or any(v and not v.isdigit() for v in ids.values()):
+        return HttpResponseBadRequest("Task ids must be integers.")
+
+    # Tasks outside any list have nowhere to be moved within.
+    task = get_object_or_404(
+        Task.objects.select_related("task_list"), pk=ids["task"], task_list__isnull=False
+    )
+    if not (
+        request.user.is_superuser
+        or user_in_group(request.user, task.task_list.group_id)
+    ):
+        raise PermissionDenied
+
+    # Neighbours from other lists (or deleted meanwhile) are ignored.
+    neighbours = {
+        key: Task.objects.filter(pk=ids[key], task_list=task.task_list_id).first()
+        if ids[key]
+        else None
+        for key in ("after", "before")
+    }
+    try:
+        reposition_task(task, after=neighbours["after"], before=neighbours["before"])
+    except ValueError as e:
+        # Usually a page that's out of date; reloading it shows the current order.
+        return HttpResponseBadRequest(str(e))
+
+    return HttpResponse(status=201)
@@ -6,7 +6,7 @@ from django.shortcuts import get_object_or_404, redirect
 from django.urls import reverse
 
 from todo.models import Attachment
-from todo.utils import remove_attachment_file
+from todo.utils import remove_attachment_file, user_in_group
 
 
 @login_required
@@ -16,13 +16,15 @@ def remove_attachment(request, attachment_id: int) -> HttpResponse:
     """
 
     if request.method == "POST":
-        attachment = get_object_or_404(Attachment, pk=attachment_id)
+        attachment = get_object_or_404(
+            Attachment.objects.select_related("task__task_list"), pk=attachment_id
+        )
 
         redir_url = reverse("todo:task_detail", kwargs={"task_id": attachment.task.id})
 
         # Permissions
         if not (
-            attachment.task.task_list.group in request.user.groups.all()
+            user_in_group(request.user, attachment.task.task_list.group_id)
             or request.user.is_superuser
         ):
             raise PermissionDenied
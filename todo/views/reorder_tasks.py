@@ -1,9 +1,11 @@
 from django.contrib.auth.decorators import login_required, user_passes_test
-from django.http import HttpResponse
+from django.core.exceptions import PermissionDenied
+from django.db import transaction
+from django.http import HttpResponse, HttpResponseBadRequest
 from django.views.decorators.csrf import csrf_exempt
 
 from todo.models import Task
-from todo.utils import staff_check
+from todo.utils import staff_check, user_in_group
 
 
 @csrf_exempt
@@ -16,19 +18,49 @@ def reorder_tasks(request) -> HttpResponse:
     if newtasklist:
         # First task in received list is always empty - remove it
         del newtasklist[0]
+        ids = [int(id) for id in newtasklist if id.isdigit()]
 
-        # Re-prioritize each task in list
-        i = 1
-        for id in newtasklist:
-            try:
-                task = Task.objects.get(pk=id)
+        # Tasks can be deleted behind the scenes during re-ordering. Not easy to remove them
+        # from the UI without page refresh, so just skip any we can't find. Tasks outside any
+        # list can't be on the page, so they're skipped too.
+        tasks = (
+            Task.objects.filter(pk__in=ids, task_list__isnull=False)
+            .select_related("task_list")
+            .only("id", "priority", "task_list__group")
+        )
+        tasks_by_id = {task.id: task for task in tasks}
+        if not tasks_by_id:
+            return HttpResponse(status=201)
+
+        # A drop only ever reorders the rows of one list, which the user must be able to see.
+        task_lists = {task.task_list for task in tasks_by_id.values()}
+        if len(task_lists) != 1:
+            return HttpResponseBadRequest("Tasks must all belong to the same list.")
+        task_list = task_lists.pop()
+        if not (
+            request.user.is_superuser
+            or user_in_group(request.user, task_list.group_id)
+        ):
+            raise PermissionDenied
+
+        # The table may be one page of a longer list. Number from the page's current lowest
+        # priority so that reordering within a page doesn't move tasks onto other pages.
+        priorities = [t.priority for t in tasks_by_id.values() if t.priority is not None]
+        i = min(priorities, default=1)
+
+        # Re-prioritize each task in list, writing only the rows that actually moved.
+        changed = []
+        for id in ids:
+            task = tasks_by_id.get(id)
+            if task is None:
+                continue
+            if task.priority != i:
                 task.priority = i
-                task.save()
-                i += 1
-            except Task.DoesNotExist:
-                # Can occur if task is deleted behind the scenes during re-ordering.
-                # Not easy to remove it from the UI without page refresh, but prevent crash.
-                pass
+                changed.append(task)
+            i += 1
+
+        with transaction.atomic():
+            Task.objects.bulk_update(changed, ["priority"])
 
     # All views must return an httpresponse of some kind ... without this we get
     # error 500s in the log even though things look peachy in the browser.
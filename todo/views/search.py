@@ -1,9 +1,11 @@
 from django.contrib.auth.decorators import login_required, user_passes_test
-from django.db.models import Q
+from django.core.paginator import Paginator
 from django.http import HttpResponse
 from django.shortcuts import render
 
+from todo.defaults import defaults
 from todo.models import Task
+from todo.search import get_search_backend
 from todo.utils import staff_check
 
 
@@ -14,6 +16,8 @@ def search(request) -> HttpResponse:
     """
 
     query_string = ""
+    page = None
+    backend = get_search_backend()
 
     if request.GET:
 
@@ -21,23 +25,36 @@ def search(request) -> HttpResponse:
         if ("q" in request.GET) and request.GET["q"].strip():
             query_string = request.GET["q"]
 
-            found_tasks = Task.objects.filter(
-                Q(title__icontains=query_string) | Q(note__icontains=query_string)
-            )
+            # Ranked full-text matches on task text and comments, best first.
+            found_tasks = backend.search(Task.objects.visible_to(request.user), query_string)
         else:
             # What if they selected the "completed" toggle but didn't enter a query string?
             # We still need found_tasks in a queryset so it can be "excluded" below.
-            found_tasks = Task.objects.all()
+            found_tasks = Task.objects.visible_to(request.user)
 
         if "inc_complete" in request.GET:
             found_tasks = found_tasks.exclude(completed=True)
 
+        found_tasks = found_tasks.select_related("task_list").prefetch_related("assigned_to")
+        paginator = Paginator(found_tasks, defaults("TODO_SEARCH_RESULTS_PER_PAGE"))
+        page = paginator.get_page(request.GET.get("page"))
+
+        # Highlighted fragments showing where each task on this page matched.
+        snippets = backend.snippets([task.id for task in page], query_string)
+        for task in page:
+            task.search_snippets = snippets.get(task.id, [])
+
     else:
         found_tasks = None
 
-    # Only include tasks that are in groups of which this user is a member:
-    if not request.user.is_superuser:
-        found_tasks = found_tasks.filter(task_list__group__in=request.user.groups.all())
+    # Keep the search terms in pagination links.
+    params = request.GET.copy()
+    params.pop("page", None)
 
-    context = {"query_string": query_string, "found_tasks": found_tasks}
+    context = {
+        "query_string": query_string,
+        "found_tasks": page,
+        "page": page,
+        "page_params": params.urlencode(),
+    }
     return render(request, "todo/search_results.html", context)
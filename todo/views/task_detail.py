@@ -50,7 +50,7 @@ def task_detail(request, task_id: int) -> HttpResponse:
     """View task details. Allow task details to be edited. Process new comments on task.
     """
 
-    task = get_object_or_404(Task, pk=task_id)
+    task = get_object_or_404(Task.objects.select_related("task_list"), pk=task_id)
     comment_list = Comment.objects.filter(task=task_id).order_by("-date")
 
     # Ensure user has permission to view task. Superusers can view all tasks.
@@ -65,7 +65,7 @@ def task_detail(request, task_id: int) -> HttpResponse:
 
         class MergeForm(forms.Form):
             merge_target = forms.ModelChoiceField(
-                queryset=Task.objects.all(),
+                queryset=Task.objects.select_related("task_list"),
                 widget=autocomplete.ModelSelect2(
                     url=reverse("todo:task_autocomplete", kwargs={"task_id": task_id})
                 ),
@@ -108,8 +108,7 @@ def task_detail(request, task_id: int) -> HttpResponse:
 
     # Mark complete
     if request.POST.get("toggle_done"):
-        results_changed = toggle_task_completed(task.id)
-        if results_changed:
+        if toggle_task_completed(task.id) is not None:
             messages.success(request, f"Changed completion status for task {task.id}")
 
         return redirect("todo:task_detail", task_id=task.id)
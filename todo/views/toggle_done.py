@@ -6,8 +6,7 @@ from django.shortcuts import get_object_or_404, redirect
 from django.urls import reverse
 
 from todo.models import Task
-from todo.utils import toggle_task_completed
-from todo.utils import staff_check
+from todo.utils import staff_check, toggle_task_completed, user_in_group
 
 
 @login_required
@@ -18,7 +17,7 @@ def toggle_done(request, task_id: int) -> HttpResponse:
     """
 
     if request.method == "POST":
-        task = get_object_or_404(Task, pk=task_id)
+        task = get_object_or_404(Task.objects.select_related("task_list"), pk=task_id)
 
         redir_url = reverse(
             "todo:list_detail",
@@ -27,15 +26,17 @@ def toggle_done(request, task_id: int) -> HttpResponse:
 
         # Permissions
         if not (
-            (task.created_by == request.user)
+            (task.created_by_id == request.user.pk)
             or (request.user.is_superuser)
             or task.assigned_to.filter(pk=request.user.pk).exists()
-            or (task.task_list.group in request.user.groups.all())
+            or user_in_group(request.user, task.task_list.group_id)
         ):
             raise PermissionDenied
 
-        toggle_task_completed(task.id)
-        messages.success(request, "Task status changed for '{}'".format(task.title))
+        # The task loaded above is only used for permissions and the redirect; the toggle
+        # itself happens in the database.
+        if toggle_task_completed(task.id) is not None:
+            messages.success(request, "Task status changed for '{}'".format(task.title))
 
         return redirect(redir_url)
 